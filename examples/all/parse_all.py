@@ -1,26 +1,193 @@
-from nexusbuilder import NexusBuilder
+from nexusutils.nexusbuilder import NexusBuilder
+import argparse
+import hashlib
+import json
+import multiprocessing
 import os
-import inspect
+import time
+from collections import deque
+from multiprocessing.connection import wait
 
-if __name__ == '__main__':
-    passes = 0
-    failures = 0
-    for file in os.listdir(os.path.dirname(inspect.stack()[0][1])):
-        if file.endswith(".xml"):
-            output_filename = file[:-4] + ".hdf5"
+import h5py
+
+"""
+Attempts to convert every Mantid IDF in this directory to a NeXus file, to discover where the
+parser currently fails and how long it takes.
+
+IDFs are converted in parallel, each in its own process, which is killed if it takes longer than
+--timeout. IDFs which were converted successfully by a previous run and have not changed since
+(same SHA-256 hash) are skipped, unless --force is given. The duration, number of pixels,
+output file size and failure reason of each IDF are printed and written to a JSON report.
+
+python parse_all.py --workers 8 --timeout 300
+"""
+
+PASSED = 'passed'
+FAILED = 'failed'
+TIMED_OUT = 'timed out'
+UNCHANGED = 'unchanged'
+
+
+def file_hash(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as idf_file:
+        for block in iter(lambda: idf_file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def count_pixels(nexus_filename):
+    pixels = 0
+
+    def _count(name, node):
+        nonlocal pixels
+        if isinstance(node, h5py.Dataset) and name.split('/')[-1] == 'detector_number':
+            pixels += node.size
+
+    with h5py.File(nexus_filename, 'r') as nexus_file:
+        nexus_file.visititems(_count)
+    return pixels
+
+
+def convert_idf(idf_filename, output_filename):
+    """
+    :return: number of pixels in the output file
+    """
+    with NexusBuilder(output_filename, idf_file=idf_filename, compress_type='gzip', compress_opts=1) as builder:
+        detectors_added = builder.add_instrument_geometry_from_idf()
+    if not detectors_added:
+        raise RuntimeError('no detectors were added')
+    return count_pixels(output_filename)
+
+
+def _convert_in_child_process(idf_filename, output_filename, connection):
+    try:
+        connection.send((PASSED, convert_idf(idf_filename, output_filename), None))
+    except Exception as e:
+        connection.send((FAILED, None, f'{type(e).__name__}: {e}'))
+    connection.close()
 
-            builder = NexusBuilder(output_filename, idf_file=file, compress_type='gzip', compress_opts=1)
 
+def convert_all(jobs, workers, timeout):
+    """
+    Converts the IDFs with at most workers processes at a time
+
+    :param jobs: list of (idf filename, output filename)
+    :param timeout: seconds after which a conversion is stopped, None for no limit
+    :return: result dictionary for each job, in the order they finished
+    """
+    pending = deque(jobs)
+    running = {}
+    results = []
+
+    def _finish(connection, status, pixels, error):
+        process, (idf_filename, output_filename), start = running.pop(connection)
+        process.join()
+        connection.close()
+        results.append({'idf': os.path.basename(idf_filename),
+                        'status': status,
+                        'duration': time.perf_counter() - start,
+                        'pixels': pixels,
+                        'output_size': os.path.getsize(output_filename) if os.path.isfile(output_filename) else None,
+                        'error': error})
+        print(f'{results[-1]["idf"]}: {status} in {results[-1]["duration"]:.1f} s')
+
+    while pending or running:
+        while pending and len(running) < workers:
+            idf_filename, output_filename = job = pending.popleft()
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=_convert_in_child_process,
+                                              args=(idf_filename, output_filename, sender), daemon=True)
+            process.start()
+            sender.close()
+            running[receiver] = (process, job, time.perf_counter())
+
+        wait_time = None
+        if timeout is not None:
+            first_deadline = min(start for _, _, start in running.values()) + timeout
+            wait_time = max(first_deadline - time.perf_counter(), 0)
+        for connection in wait(list(running), wait_time):
             try:
-                detectors_added = builder.add_instrument_geometry_from_idf()
-                if detectors_added:
-                    passes += 1
-            except:
-                failures += 1
-
-    if passes + failures > 0:
-        percent_pass = '%s' % float('%.3g' % ((100. / (passes + failures)) * passes))
-        print(percent_pass + "% of all (" + str(passes + failures) +
+                status, pixels, error = connection.recv()
+            except EOFError:
+                process = running[connection][0]
+                process.join()
+                status, pixels, error = FAILED, None, f'process exited with code {process.exitcode}'
+            _finish(connection, status, pixels, error)
+
+        if timeout is not None:
+            now = time.perf_counter()
+            for connection, (process, _, start) in list(running.items()):
+                if now - start >= timeout:
+                    process.terminate()
+                    _finish(connection, TIMED_OUT, None, f'timed out after {timeout} s')
+    return results
+
+
+def load_previous_results(report_filename):
+    if not os.path.isfile(report_filename):
+        return {}
+    with open(report_filename, 'r') as report_file:
+        return {result['idf']: result for result in json.load(report_file)['results']}
+
+
+def print_report(results, wall_time):
+    for result in sorted(results, key=lambda result: result['duration'], reverse=True):
+        pixels = '' if result['pixels'] is None else result['pixels']
+        size = '' if result['output_size'] is None else f'{result["output_size"] / 1e6:.2f} MB'
+        print(f'{result["idf"]:<50} {result["status"]:<10} {result["duration"]:8.2f} s {pixels:>10} {size:>12}')
+    for result in results:
+        if result['error'] is not None:
+            print(f'{result["idf"]}: {result["error"]}')
+
+    passes = sum(result['status'] in (PASSED, UNCHANGED) for result in results)
+    if results:
+        percent_pass = '%s' % float('%.3g' % ((100. / len(results)) * passes))
+        print(percent_pass + "% of all (" + str(len(results)) +
               ") IDFs for which parsing was attempted resulted in NeXus files with at least one detector")
+        print(f'{sum(result["status"] == UNCHANGED for result in results)} unchanged IDFs were skipped, '
+              f'{sum(result["status"] == TIMED_OUT for result in results)} timed out, '
+              f'total time {wall_time:.1f} s')
     else:
         print("Found no IDFs to parse")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--idf-dir', type=str, default=os.path.dirname(os.path.abspath(__file__)),
+                        help='Directory containing the IDFs')
+    parser.add_argument('--output-dir', type=str, default='.', help='Directory to write the NeXus files to')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of IDFs to convert in parallel')
+    parser.add_argument('--timeout', type=float, default=600.,
+                        help='Seconds after which the conversion of an IDF is stopped, 0 for no limit')
+    parser.add_argument('--report', type=str, default='parse_all_report.json',
+                        help='JSON report file, also used to find IDFs which are unchanged since the last run')
+    parser.add_argument('--force', action='store_true', help='Convert all IDFs, even those which are unchanged')
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    previous_results = {} if args.force else load_previous_results(args.report)
+    os.makedirs(args.output_dir, exist_ok=True)
+    jobs = []
+    results = []
+    hashes = {}
+    for file in sorted(os.listdir(args.idf_dir)):
+        if file.endswith(".xml"):
+            idf_filename = os.path.join(args.idf_dir, file)
+            output_filename = os.path.join(args.output_dir, file[:-4] + ".hdf5")
+            hashes[file] = file_hash(idf_filename)
+            previous = previous_results.get(file)
+            if previous is not None and previous['status'] in (PASSED, UNCHANGED) and \
+                    previous['hash'] == hashes[file] and os.path.isfile(output_filename):
+                results.append(dict(previous, status=UNCHANGED))
+            else:
+                jobs.append((idf_filename, output_filename))
+
+    results += convert_all(jobs, max(args.workers, 1), args.timeout or None)
+    for result in results:
+        result['hash'] = hashes[result['idf']]
+    wall_time = time.perf_counter() - start_time
+    print_report(results, wall_time)
+    with open(args.report, 'w') as report_file:
+        json.dump({'wall_time': wall_time, 'results': sorted(results, key=lambda result: result['idf'])},
+                  report_file, indent=2)
@@ -2,10 +2,10 @@ import numpy as np
 import pandas as pd
 from tqdm import trange
 from nexusutils.nexusbuilder import NexusBuilder
-from nexusjson.nexus_to_json import NexusToDictConverter, object_to_json_file
-import nexusformat.nexus as nexus
-from contextlib import contextmanager
-from typing import Dict, Tuple
+from examples.common.instrumentation import instrumented
+from examples.common.streamingjson import group_to_json_file
+from typing import Dict, Optional, Tuple
+import argparse
 import h5py
 
 """
@@ -102,6 +102,7 @@ def create_winding_order() -> np.ndarray:
     return winding_order
 
 
+@instrumented
 def write_to_off_file(
     filename: str,
     vertices: np.ndarray,
@@ -215,15 +216,30 @@ def __add_attributes_to_group(group: h5py.Group, attributes: Dict):
             group.attrs.create(key, np.array(attributes[key]))
 
 
+@instrumented(hdf5_argument="filename")
 def write_to_nexus_file(
     filename: str,
     vertices: np.ndarray,
     voxels: np.ndarray,
     detector_ids: np.ndarray,
     offsets: Tuple[np.ndarray, np.ndarray, np.ndarray],
+    json_filename: Optional[str] = None,
+    file_in_memory: bool = False,
+    array_encoding: str = "json",
 ):
+    """
+    If json_filename is given the file-writer nexus_structure is written to it from the open file,
+    see streamingjson.create_array_encoder for array_encoding.
+    With file_in_memory the NeXus file is only built in memory, so it is never written to disk,
+    this is used to generate the JSON directly.
+    """
+    compress_type, compress_opts = ("gzip", 1) if not file_in_memory else (None, None)
     with NexusBuilder(
-        filename, compress_type="gzip", compress_opts=1, nx_entry_name="entry"
+        filename,
+        compress_type=compress_type,
+        compress_opts=compress_opts,
+        nx_entry_name="entry",
+        file_in_memory=file_in_memory,
     ) as builder:
         instrument_group = builder.add_instrument(INSTRUMENT_NAME)
         detector_group = builder.add_nx_group(
@@ -309,6 +325,11 @@ def write_to_nexus_file(
         # Remove link to event data in the NXentry
         del builder.root["event_data_multiblade_detector"]
 
+        if json_filename is not None:
+            write_structure_to_json_file(
+                builder.target_file, json_filename, array_encoding
+            )
+
 
 def add_shape_to_detector(
     builder: NexusBuilder,
@@ -361,67 +382,71 @@ def __add_data_stream(streams, topic, source, path, module, value_type=None):
     streams[path] = options
 
 
-@contextmanager
-def nexus_file(nexus_filename: str):
-    open_file = nexus.nxload(nexus_filename, mode="r+")
-    try:
-        yield open_file
-    finally:
-        open_file.close()
-
-
-def write_to_json_file(nexus_filename: str, json_filename: str):
-    converter = NexusToDictConverter()
-
-    with nexus_file(nexus_filename) as nxs_file:
-        nxs_file.entry.start_time = np.array(
-            ["8601TIME"], dtype=np.dtype("S9")
-        )  # NICOS replaces 8601TIME
-        nxs_file.entry.title = np.array(
-            ["TITLE"], dtype=np.dtype("S6")
-        )  # NICOS replaces TITLE
-
-        streams = {}
-        __add_data_stream(
-            streams,
-            EVENT_TOPIC,
-            EVENT_SOURCE_NAME,
-            "/entry/instrument/multiblade_detector/event_data",
-            "ev42",
-        )
-        __add_data_stream(
-            streams,
-            FORWARDER_TOPIC,
-            "COM",
-            "/entry/instrument/multiblade_detector/transformations/COM",
-            "f142",
-        )
-        __add_data_stream(
-            streams,
-            FORWARDER_TOPIC,
-            "COZ",
-            "/entry/instrument/multiblade_detector/transformations/COZ",
-            "f142",
-        )
-        __add_data_stream(
-            streams,
-            FORWARDER_TOPIC,
-            "SOM",
-            "/entry/sample/transformations/SOM",
-            "f142",
-        )
-        __add_data_stream(
-            streams,
-            FORWARDER_TOPIC,
-            "SOZ",
-            "/entry/sample/transformations/SOZ",
-            "f142",
-        )
-        links = {}
-        nexus_structure = converter.convert(nxs_file, streams, links)
-        object_to_json_file(nexus_structure, json_filename)
+def __replace_dataset(group: h5py.Group, name: str, data: np.ndarray):
+    if name in group:
+        del group[name]
+    group.create_dataset(name, data=data)
+
+
+@instrumented
+def write_to_json_file(
+    nexus_filename: str, json_filename: str, array_encoding: str = "json"
+):
+    with h5py.File(nexus_filename, "r+") as nxs_file:
+        write_structure_to_json_file(nxs_file, json_filename, array_encoding)
 
 
+def write_structure_to_json_file(
+    nxs_file: h5py.File, json_filename: str, array_encoding: str = "json"
+):
+    __replace_dataset(
+        nxs_file["entry"], "start_time", np.array(["8601TIME"], dtype=np.dtype("S9"))
+    )  # NICOS replaces 8601TIME
+    __replace_dataset(
+        nxs_file["entry"], "title", np.array(["TITLE"], dtype=np.dtype("S6"))
+    )  # NICOS replaces TITLE
+
+    streams = {}
+    __add_data_stream(
+        streams,
+        EVENT_TOPIC,
+        EVENT_SOURCE_NAME,
+        "/entry/instrument/multiblade_detector/event_data",
+        "ev42",
+    )
+    __add_data_stream(
+        streams,
+        FORWARDER_TOPIC,
+        "COM",
+        "/entry/instrument/multiblade_detector/transformations/COM",
+        "f142",
+    )
+    __add_data_stream(
+        streams,
+        FORWARDER_TOPIC,
+        "COZ",
+        "/entry/instrument/multiblade_detector/transformations/COZ",
+        "f142",
+    )
+    __add_data_stream(
+        streams,
+        FORWARDER_TOPIC,
+        "SOM",
+        "/entry/sample/transformations/SOM",
+        "f142",
+    )
+    __add_data_stream(
+        streams,
+        FORWARDER_TOPIC,
+        "SOZ",
+        "/entry/sample/transformations/SOZ",
+        "f142",
+    )
+    links = {}
+    group_to_json_file(nxs_file, json_filename, streams, links, array_encoding)
+
+
+@instrumented
 def create_detector_shape_info():
     total_vertices = None
     total_faces = None
@@ -440,6 +465,7 @@ def create_detector_shape_info():
     return total_vertices, total_faces, total_ids
 
 
+@instrumented
 def create_pixel_offsets():
     total_x_offsets = None
     total_y_offsets = None
@@ -461,18 +487,46 @@ def create_pixel_offsets():
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--json-only",
+        action="store_true",
+        help="Only generate the file-writer JSON, the NeXus file is built in memory and not written to disk",
+    )
+    parser.add_argument(
+        "--array-encoding",
+        choices=["json", "base64", "npz"],
+        default="json",
+        help="How large geometry arrays are written in the JSON: json numbers, inline base64 encoded "
+        "compressed .npy data, or a reference into an .npz file written next to the JSON",
+    )
+    args = parser.parse_args()
+
     total_vertices, total_faces, total_ids = create_detector_shape_info()
 
     write_to_off_file(f"{INSTRUMENT_NAME}_multiblade.off", total_vertices, total_faces)
 
     offsets = create_pixel_offsets()
     nexus_filename = f"{INSTRUMENT_NAME}_multiblade.nxs"
-    write_to_nexus_file(
-        nexus_filename,
-        total_vertices,
-        total_faces,
-        total_ids,
-        offsets,
-    )
+    json_filename = "AMOR_nexus_structure.json"
+    if args.json_only:
+        write_to_nexus_file(
+            nexus_filename,
+            total_vertices,
+            total_faces,
+            total_ids,
+            offsets,
+            json_filename=json_filename,
+            file_in_memory=True,
+            array_encoding=args.array_encoding,
+        )
+    else:
+        write_to_nexus_file(
+            nexus_filename,
+            total_vertices,
+            total_faces,
+            total_ids,
+            offsets,
+        )
 
-    write_to_json_file(nexus_filename, "AMOR_nexus_structure.json")
+        write_to_json_file(nexus_filename, json_filename, args.array_encoding)
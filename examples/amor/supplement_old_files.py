@@ -3,11 +3,19 @@ from examples.amor.amor import (
     create_detector_shape_info,
     create_pixel_offsets,
 )
+from examples.common.runcatalogue import RunCatalogue
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from glob import glob
+import os
+from shutil import copyfile
+import tempfile
 from nexusutils.nexusbuilder import NexusBuilder
 import h5py
 import datetime
 import numpy as np
+from typing import Dict, List
 
 """
 This script is intended to supplement old files from AMOR with detector geometry information
@@ -18,64 +26,246 @@ Tested with these files:
 amor2020n000346.hdf
 amor2020n000366.hdf
 from approx Dec 2021
+
+The input can be a single file, a directory or a glob pattern. The detector geometry is the
+same for every file, so it is only calculated once (or loaded from --geometry-cache) and
+files are then processed in parallel.
+
+The static part of the output (instrument, detector geometry, source and sample) is written
+once to a geometry template file. Each output file is either a clone of the template
+(--template-mode copy) or links to the detector geometry in it (--template-mode link),
+so per-file work is only copying the experiment data.
 """
 
+ENTRY_PATH = "/entry"
+DETECTOR_NAME = "multiblade_detector"
+
+
+def load_or_create_geometry(cache_filename: str = None) -> Dict[str, np.ndarray]:
+    """
+    Multiblade detector geometry, loaded from the cache file if it exists,
+    otherwise calculated and saved to the cache file if one is given
+    """
+    if cache_filename is not None and os.path.isfile(cache_filename):
+        with np.load(cache_filename) as cached:
+            return dict(cached)
+
+    vertices, voxels, detector_ids = create_detector_shape_info()
+    x_offsets, y_offsets, z_offsets = create_pixel_offsets()
+    geometry = {
+        "vertices": vertices,
+        "voxels": voxels,
+        "detector_ids": detector_ids,
+        "x_offsets": x_offsets,
+        "y_offsets": y_offsets,
+        "z_offsets": z_offsets,
+    }
+    if cache_filename is not None:
+        np.savez_compressed(cache_filename, **geometry)
+    return geometry
+
+
+def find_input_files(input_path: str) -> List[str]:
+    if os.path.isdir(input_path):
+        return sorted(glob(os.path.join(input_path, "*.hdf")))
+    if os.path.isfile(input_path):
+        return [input_path]
+    return sorted(glob(input_path))
+
+
+def output_filename_for(input_filename: str) -> str:
+    return f"{''.join(input_filename.split('.')[:-1])}_tweaked.nxs"
+
+
+def create_geometry_template(template_filename: str, geometry: Dict[str, np.ndarray]):
+    """
+    Write the static part of the output files, which is the same for every run, once.
+    Each output file then starts as a clone of this template.
+    """
+    with NexusBuilder(
+        template_filename, compress_type="gzip", compress_opts=1, nx_entry_name="entry"
+    ) as builder:
+        instrument_group = builder.add_instrument("AMOR", "instrument")
+        detector_group = builder.add_nx_group(
+            instrument_group, "multiblade_detector", "NXdetector"
+        )
+        offsets = (geometry["x_offsets"], geometry["y_offsets"], geometry["z_offsets"])
+        add_shape_to_detector(
+            builder,
+            detector_group,
+            geometry["detector_ids"],
+            geometry["voxels"],
+            geometry["vertices"],
+            offsets,
+        )
+
+        # Required for loading geometry in Mantid
+        builder.add_dataset(builder.root, "name", "AMOR")
+        builder.add_source(
+            "SINQ_source", position=[0, 0, 30.0]
+        )  # TODO add correct position!
+        builder.add_sample()
+
+
+def _copy_attributes(source: h5py.HLObject, target: h5py.HLObject):
+    for key, value in source.attrs.items():
+        target.attrs[key] = value
+
+
+def _link_to_template(template_filename: str, output_file: h5py.File):
+    """
+    Copy the small groups of the template but use external links for the detector geometry,
+    so that it is stored only once, in the template file
+    """
+    link_target = os.path.relpath(
+        template_filename, os.path.dirname(os.path.abspath(output_file.filename))
+    )
+    with h5py.File(template_filename, "r") as template_file:
+        _copy_attributes(template_file, output_file)
+        parent = output_file
+        template_parent = template_file
+        # Recreate the groups down to the detector, copying everything else as it is small
+        for group_name in (ENTRY_PATH.strip("/"), "instrument", DETECTOR_NAME):
+            template_group = template_parent[group_name]
+            group = parent.create_group(group_name)
+            _copy_attributes(template_group, group)
+            if group_name != DETECTOR_NAME:
+                for name, node in template_group.items():
+                    if name not in ("instrument", DETECTOR_NAME):
+                        template_file.copy(node, group)
+            parent = group
+            template_parent = template_group
+        for name, node in template_parent.items():
+            parent[name] = h5py.ExternalLink(link_target, node.name)
+
+
+def _add_string_dataset(group: h5py.Group, name: str, value: str):
+    group.create_dataset(name, data=np.array(value).astype("|S" + str(len(value))))
+
+
+def supplement_file(
+    input_filename: str, template_filename: str, template_mode: str = "copy"
+) -> str:
+    output_filename = output_filename_for(input_filename)
+    if template_mode == "copy":
+        # Whole file clone, the geometry datasets are already compressed in the template
+        copyfile(template_filename, output_filename)
+        output_file = h5py.File(output_filename, "r+")
+    elif template_mode == "link":
+        output_file = h5py.File(output_filename, "w")
+        _link_to_template(template_filename, output_file)
+    else:
+        raise ValueError(f"Unknown template mode: {template_mode}")
+
+    with output_file, h5py.File(input_filename, "r") as input_file:
+        entry = output_file[ENTRY_PATH]
+        detector_group = entry[f"instrument/{DETECTOR_NAME}"]
+        input_file.copy("/instrument/stages", entry)
+        input_file.copy("/experiment/user", entry)
+        input_file.copy("/experiment/data", detector_group)
+        input_file.copy("/experiment/proposal_id", entry)
+        input_file.copy("/experiment/title", entry)
+        input_file.copy("/instrument/facility", entry)
+
+        # Fix groups mislabelled as NXevent_data when they should be NXlog
+        for log_dataset_name, log_dataset in entry["stages"].items():
+            if log_dataset_name != "diaphragms":
+                del log_dataset.attrs["NX_class"]
+                log_dataset.attrs.create("NX_class", np.array("NXlog").astype("|S5"))
+            else:
+                for _, dataset in entry["stages/diaphragms/middle focus"].items():
+                    del dataset.attrs["NX_class"]
+                    dataset.attrs.create("NX_class", np.array("NXlog").astype("|S5"))
+                for _, dataset in entry["stages/diaphragms/virtual source"].items():
+                    del dataset.attrs["NX_class"]
+                    dataset.attrs.create("NX_class", np.array("NXlog").astype("|S5"))
+
+        time_str = input_file["/experiment/start_time"][...][0].decode("UTF-8")
+        date_time_obj = datetime.datetime.strptime(time_str, "%Y-%m-%d %H:%M:%S")
+        date_time_obj = date_time_obj - datetime.timedelta(hours=1)  # Change it to UTC
+        iso8601_time = date_time_obj.isoformat() + ".000000000"
+        _add_string_dataset(entry, "start_time", iso8601_time)
+
+    return output_filename
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process some integers.")
     parser.add_argument(
+        "--input",
         "--input-file",
+        dest="input",
         type=str,
-        help="Local filename or full path to input NeXus file from AMOR, "
-        "output file will be saved to save directory",
+        help="Local filename or full path to input NeXus file from AMOR, or a directory (all .hdf files "
+        "are processed) or glob pattern, output files will be saved next to the input files",
         required=True,
     )
+    parser.add_argument(
+        "--geometry-cache",
+        type=str,
+        help="npz file to load the detector geometry from, it is created if it does not exist",
+    )
+    parser.add_argument(
+        "--geometry-template",
+        type=str,
+        help="NeXus file containing the static instrument geometry which output files are cloned from, "
+        "it is created if it does not exist. By default a temporary template is used for each batch, "
+        "this must be given for --template-mode link",
+    )
+    parser.add_argument(
+        "--template-mode",
+        choices=["copy", "link"],
+        default="copy",
+        help="copy: each output file is a full clone of the template, "
+        "link: output files use external links to the detector geometry in the template",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of files to process in parallel",
+    )
+    parser.add_argument(
+        "--catalogue",
+        type=str,
+        help="Add the input and output files to this SQLite run catalogue, "
+        "see examples/common/runcatalogue.py",
+    )
     args = parser.parse_args()
-    output_filename = f"{''.join(args.input_file.split('.')[:-1])}_tweaked.nxs"
 
-    with NexusBuilder(
-        output_filename, compress_type="gzip", compress_opts=1, nx_entry_name="entry"
-    ) as builder:
-        instrument_group = builder.add_instrument("AMOR", "instrument")
-        detector_group = builder.add_nx_group(
-            instrument_group, "multiblade_detector", "NXdetector"
-        )
-        vertices, voxels, detector_ids = create_detector_shape_info()
-        offsets = create_pixel_offsets()
-        transforms_group = add_shape_to_detector(
-            builder, detector_group, detector_ids, voxels, vertices, offsets
+    if args.template_mode == "link" and args.geometry_template is None:
+        parser.error("--geometry-template is required with --template-mode link")
+
+    input_filenames = find_input_files(args.input)
+    if not input_filenames:
+        raise FileNotFoundError(f"No input files found matching {args.input}")
+
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        template_filename = args.geometry_template
+        if template_filename is None:
+            template_filename = os.path.join(temporary_directory, "AMOR_geometry_template.nxs")
+        if not os.path.isfile(template_filename):
+            create_geometry_template(
+                template_filename, load_or_create_geometry(args.geometry_cache)
+            )
+
+        _supplement_file = partial(
+            supplement_file,
+            template_filename=template_filename,
+            template_mode=args.template_mode,
         )
 
-        with h5py.File(args.input_file, "r") as input_file:
-            input_file.copy("/instrument/stages", builder.root)
-            input_file.copy("/experiment/user", builder.root)
-            input_file.copy("/experiment/data", detector_group)
-            input_file.copy("/experiment/proposal_id", builder.root)
-            input_file.copy("/experiment/title", builder.root)
-            input_file.copy("/instrument/facility", builder.root)
-
-            # Fix groups mislabelled as NXevent_data when they should be NXlog
-            for log_dataset_name, log_dataset in builder.root["stages"].items():
-                if log_dataset_name != "diaphragms":
-                    del log_dataset.attrs["NX_class"]
-                    log_dataset.attrs.create("NX_class", np.array("NXlog").astype("|S5"))
-                else:
-                    for _, dataset in builder.root["stages/diaphragms/middle focus"].items():
-                        del dataset.attrs["NX_class"]
-                        dataset.attrs.create("NX_class", np.array("NXlog").astype("|S5"))
-                    for _, dataset in builder.root["stages/diaphragms/virtual source"].items():
-                        del dataset.attrs["NX_class"]
-                        dataset.attrs.create("NX_class", np.array("NXlog").astype("|S5"))
-
-            time_str = input_file["/experiment/start_time"][...][0].decode("UTF-8")
-            date_time_obj = datetime.datetime.strptime(time_str, "%Y-%m-%d %H:%M:%S")
-            date_time_obj = date_time_obj - datetime.timedelta(hours=1)  # Change it to UTC
-            iso8601_time = date_time_obj.isoformat() + ".000000000"
-            builder.add_dataset(builder.root, "start_time", iso8601_time)
-
-            # Required for loading geometry in Mantid
-            builder.add_dataset(builder.root, "name", "AMOR")
-            builder.add_source(
-                "SINQ_source", position=[0, 0, 30.0]
-            )  # TODO add correct position!
-            builder.add_sample()
+        output_filenames = []
+        if len(input_filenames) == 1:
+            output_filenames.append(_supplement_file(input_filenames[0]))
+        else:
+            with ProcessPoolExecutor(max_workers=args.workers) as executor:
+                for input_filename, output_filename in zip(
+                    input_filenames, executor.map(_supplement_file, input_filenames)
+                ):
+                    print(f"{input_filename} -> {output_filename}")
+                    output_filenames.append(output_filename)
+
+    if args.catalogue:
+        with RunCatalogue(args.catalogue) as catalogue:
+            catalogue.update(input_filenames + output_filenames)
@@ -0,0 +1,318 @@
+import argparse
+import copy
+import importlib
+import json
+import os
+import platform
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+"""
+Benchmarks the example generators at several scales
+
+Each benchmark builds the file (or files) its example does, with the size of the instrument set by
+the scale, for example the number of AMOR blades or DREAM sectors. Every run is in a new Python
+process, in a temporary directory containing links to the example's input files, and records:
+- wall_time: seconds taken to generate the output, not counting starting Python and importing
+- peak_rss: peak resident set size in bytes of the largest process, including worker processes
+- output_size: total size in bytes of the files written
+
+Results can be saved as a baseline, later runs compared with it flag any metric which is more than
+--tolerance worse as a regression, and exit with status 1.
+
+python run_benchmarks.py --save-baseline baseline.json
+python run_benchmarks.py amor dream --baseline baseline.json
+python run_benchmarks.py voxel --scales voxel=10000,1000000 --repeats 3
+"""
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+EXAMPLES_DIR = os.path.join(REPOSITORY_ROOT, "examples")
+METRICS = ["wall_time", "peak_rss", "output_size"]
+
+
+def _amor(blades: int):
+    amor = importlib.import_module("amor")
+    amor.NUMBER_OF_BLADES = blades
+    vertices, faces, detector_ids = amor.create_detector_shape_info()
+    offsets = amor.create_pixel_offsets()
+    amor.write_to_nexus_file(f"{amor.INSTRUMENT_NAME}_multiblade.nxs", vertices, faces, detector_ids, offsets)
+
+
+def _dream(sectors: int):
+    dream = importlib.import_module("dream")
+    utils = importlib.import_module("utils")
+    geant_df = dream.load_geant_lookup_table("LookupTableDreamEndCap_noRRT.txt")
+    utils.write_to_nexus_file(f"DREAM_endcap_{sectors}_sectors.nxs", *dream.create_endcap(geant_df, sectors))
+
+
+def _loki(banks: int):
+    """
+    Banks after the last one in the data set are repeats of the earlier banks
+    """
+    loki = importlib.import_module("LOKI_geometry")
+    bank_ids = sorted(loki.det_banks_data)
+    data = loki.Entry(experiment_id="p1234", title="benchmark").get_nx_entry(start_time=datetime.now().isoformat())
+    instrument = data[loki.ENTRY][loki.VALUES][loki.INSTRUMENT][loki.VALUES]
+    for bank_number in range(banks):
+        # Bank modifies the geometry it is given
+        bank_geometry = copy.deepcopy(loki.det_banks_data[bank_ids[bank_number % len(bank_ids)]])
+        bank = loki.Bank(bank_geometry, bank_number)
+        bank.build_detector_bank()
+        detector_name = f"detector_{bank_number}"
+        bank.compound_detector_geometry(f"/{loki.ENTRY}/{loki.INSTRUMENT}/{detector_name}/{loki.TRANSFORMATIONS}/")
+        instrument[detector_name] = bank.get_nexus_dict()
+    loki.NexusFileBuilder(data, filename="loki").construct_nxs_file()
+
+
+def _find_wish_idfs() -> Dict[int, str]:
+    """
+    :return: WISH IDF filename in examples/all for each number of panels
+    """
+    idfs = {}
+    for filename in os.listdir(os.path.join(EXAMPLES_DIR, "all")):
+        match = re.fullmatch(r"WISH_Definition_(\d+)Panels?\.xml", filename)
+        if match:
+            idfs[int(match.group(1))] = filename
+    return idfs
+
+
+WISH_IDFS = _find_wish_idfs()
+
+
+def _wish(panels: int):
+    from nexusutils.nexusbuilder import NexusBuilder
+
+    with NexusBuilder(
+        f"WISH_{panels}_panels.nxs",
+        idf_file=WISH_IDFS[panels],
+        compress_type="gzip",
+        compress_opts=1,
+    ) as builder:
+        builder.add_instrument_geometry_from_idf()
+
+
+def _v20(events: int):
+    import h5py
+
+    event_aggregation = importlib.import_module("event_aggregation")
+    event_aggregation.create_benchmark_file("V20_events.nxs", events)
+    with h5py.File("V20_events.nxs", "r+") as nexus_file:
+        event_aggregation.aggregate_events_by_pulse(
+            nexus_file,
+            "/entry/instrument/chopper_1/top_dead_center/time",
+            "/entry/instrument/detector_1/raw_event_data",
+        )
+
+
+def _bigfake(cues: int):
+    from nexusutils.nexusbuilder import NexusBuilder
+
+    bigfake = importlib.import_module("bigfake")
+    with NexusBuilder("bigfake.nxs", nx_entry_name="entry", compress_type="gzip", compress_opts=1) as builder:
+        bigfake.add_nxlog(builder, "benchmark_log", number_of_cues=cues)
+
+
+def _voxel(n_voxels: int):
+    from nexusutils.nexusbuilder import NexusBuilder
+
+    voxel_example = importlib.import_module("VOXEL_example")
+    with NexusBuilder(f"VOXEL_example_{n_voxels}.nxs", compress_type="gzip", compress_opts=1,
+                      nx_entry_name="entry") as builder:
+        builder.add_instrument("VOXEL", "instrument")
+        voxel_example.add_voxel_detector(builder, n_voxels)
+
+
+class Benchmark(NamedTuple):
+    example_dir: str
+    scale_name: str
+    scales: List[int]
+    run: Callable[[int], None]
+    description: str
+
+
+BENCHMARKS: Dict[str, Benchmark] = {
+    "amor": Benchmark("amor", "blades", [1, 9, 36], _amor, "multiblade quad grid mesh"),
+    "dream": Benchmark("dream", "sectors", [1, 4, 23], _dream, "endcap voxel mesh from GEANT4 table"),
+    "loki": Benchmark("loki", "banks", [1, 4, 9], _loki, "tube and straw object graph"),
+    "wish": Benchmark("all", "panels", sorted(WISH_IDFS), _wish, "IDF parsing"),
+    "v20": Benchmark("v20", "events", [1000000, 10000000], _v20, "event dataset copying by pulse"),
+    "bigfake": Benchmark("bigfake", "cues", [10, 100, 300], _bigfake, "NXlog synthesis"),
+    "voxel": Benchmark("voxel_detector", "voxels", [1000, 100000, 1000000], _voxel, "octahedron voxel mesh"),
+}
+
+
+def _peak_rss() -> int:
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_in_this_process(name: str, scale: int, result_filename: str):
+    """
+    Runs the benchmark in the current directory, and writes its wall time and peak RSS to the result file
+    """
+    sys.path.insert(0, os.path.join(EXAMPLES_DIR, BENCHMARKS[name].example_dir))
+    start = time.perf_counter()
+    BENCHMARKS[name].run(scale)
+    wall_time = time.perf_counter() - start
+    with open(result_filename, "w") as result_file:
+        json.dump({"wall_time": wall_time, "peak_rss": _peak_rss()}, result_file)
+
+
+def _output_size(directory: str) -> int:
+    size = 0
+    for parent, _, filenames in os.walk(directory):
+        for filename in filenames:
+            path = os.path.join(parent, filename)
+            if not os.path.islink(path):
+                size += os.path.getsize(path)
+    return size
+
+
+def run_benchmark(name: str, scale: int, timeout: Optional[float] = None) -> Dict:
+    """
+    Runs the benchmark in a new process and temporary directory
+
+    :return: metrics, or the error if the benchmark failed
+    """
+    example_dir = os.path.join(EXAMPLES_DIR, BENCHMARKS[name].example_dir)
+    with tempfile.TemporaryDirectory() as work_dir, tempfile.TemporaryDirectory() as result_dir:
+        for filename in os.listdir(example_dir):
+            if filename != "__pycache__":
+                os.symlink(os.path.join(example_dir, filename), os.path.join(work_dir, filename))
+        result_filename = os.path.join(result_dir, "result.json")
+        environment = dict(os.environ)
+        environment["PYTHONPATH"] = os.pathsep.join(filter(None, [REPOSITORY_ROOT, environment.get("PYTHONPATH")]))
+        try:
+            process = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--run", name, str(scale), result_filename],
+                cwd=work_dir,
+                env=environment,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                universal_newlines=True,
+                timeout=timeout,
+            )
+        except subprocess.TimeoutExpired:
+            return {"error": f"timed out after {timeout} s"}
+        if process.returncode != 0:
+            last_line = process.stdout.strip().splitlines()[-1:] or [f"exit status {process.returncode}"]
+            return {"error": last_line[0]}
+        with open(result_filename, "r") as result_file:
+            result = json.load(result_file)
+        result["output_size"] = _output_size(work_dir)
+    return result
+
+
+def find_regressions(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    regressions = []
+    for name, scales in results.items():
+        for scale, result in scales.items():
+            previous = baseline.get(name, {}).get(scale)
+            if previous is None or "error" in previous:
+                continue
+            if "error" in result:
+                regressions.append(f"{name} {scale}: failed, {result['error']}")
+                continue
+            for metric in METRICS:
+                if previous.get(metric) and result[metric] > previous[metric] * (1.0 + tolerance):
+                    regressions.append(
+                        f"{name} {scale}: {metric} {result[metric]:.4g} is "
+                        f"{result[metric] / previous[metric] - 1.0:.0%} worse than the baseline {previous[metric]:.4g}"
+                    )
+    return regressions
+
+
+def print_result(name: str, scale: int, result: Dict):
+    label = f"{name} {BENCHMARKS[name].scale_name}={scale}"
+    if "error" in result:
+        print(f"{label:<30} FAILED: {result['error']}")
+    else:
+        print(
+            f"{label:<30} {result['wall_time']:9.3f} s {result['peak_rss'] / 1e6:9.1f} MB RSS "
+            f"{result['output_size'] / 1e6:9.2f} MB output"
+        )
+
+
+def _parse_scales(values: List[str]) -> Dict[str, List[int]]:
+    scales = {}
+    for value in values:
+        name, _, numbers = value.partition("=")
+        if name not in BENCHMARKS or not numbers:
+            raise argparse.ArgumentTypeError(f"Expected <benchmark>=<scale>,<scale>... not {value}")
+        scales[name] = [int(float(number)) for number in numbers.split(",")]
+        if name == "wish" and not set(scales[name]) <= set(WISH_IDFS):
+            raise argparse.ArgumentTypeError(f"WISH IDFs are only available for {sorted(WISH_IDFS)} panels")
+    return scales
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 5 and sys.argv[1] == "--run":
+        run_in_this_process(sys.argv[2], int(sys.argv[3]), sys.argv[4])
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="\n".join(
+            f"  {name:<8} {benchmark.scale_name} {benchmark.scales}: {benchmark.description}"
+            for name, benchmark in BENCHMARKS.items()
+        ),
+    )
+    parser.add_argument("benchmarks", nargs="*", help="Benchmarks to run, all of them by default")
+    parser.add_argument("--scales", nargs="+", default=[], help="Scales to run at, for example amor=1,9 dream=23")
+    parser.add_argument("--repeats", type=int, default=1, help="Best result of this many runs is reported")
+    parser.add_argument("--timeout", type=float, default=3600.0, help="Seconds allowed for each run")
+    parser.add_argument("--baseline", type=str, help="Baseline JSON file to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Fraction by which a metric can be worse than the baseline before it is a regression")
+    parser.add_argument("--save-baseline", type=str, help="Write the results to this file to use as a baseline")
+    parser.add_argument("--output", type=str, help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"Unknown benchmarks {', '.join(unknown)}, choose from {', '.join(BENCHMARKS)}")
+    try:
+        scale_overrides = _parse_scales(args.scales)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+    results = {}
+    for name in args.benchmarks or list(BENCHMARKS):
+        results[name] = {}
+        for scale in scale_overrides.get(name, BENCHMARKS[name].scales):
+            runs = [run_benchmark(name, scale, args.timeout) for _ in range(max(args.repeats, 1))]
+            failures = [run for run in runs if "error" in run]
+            result = failures[0] if failures else {metric: min(run[metric] for run in runs) for metric in METRICS}
+            results[name][str(scale)] = result
+            print_result(name, scale, result)
+
+    report = {
+        "created": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "benchmarks": results,
+    }
+    for filename in filter(None, [args.output, args.save_baseline]):
+        with open(filename, "w") as report_file:
+            json.dump(report, report_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r") as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get("platform") != report["platform"]:
+            print(f"Baseline is from {baseline.get('platform')}, not this platform, comparisons may not be meaningful")
+        regressions = find_regressions(results, baseline["benchmarks"], args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions compared with {args.baseline}")
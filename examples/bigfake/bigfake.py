@@ -5,25 +5,41 @@ from nexusutils.detectorplotter import DetectorPlotter
 import numpy as np
 from datetime import datetime
 
+from examples.common.eventidmap import CHUNK_SIZE
+from examples.common.instrumentation import instrumented
+
 
 def __copy_and_transform_dataset(
-    source_file, source_path, target_path, transformation=None, dtype=None
+    source_file,
+    source_path,
+    target_path,
+    transformation=None,
+    dtype=None,
+    chunk_size=CHUNK_SIZE,
 ):
-    source_data = source_file[source_path][...]
-    if transformation is not None:
-        transformed_data = transformation(source_data)
-    else:
-        transformed_data = source_data
+    """
+    Copy a 1D dataset chunk by chunk, transformation is applied to each chunk so must work element-wise,
+    for example an event id map from eventidmap
+    """
+    source_dataset = source_file[source_path]
     if dtype is None:
-        dtype = transformed_data.dtype
+        dtype = (
+            source_dataset.dtype
+            if transformation is None
+            else transformation(source_dataset[:1]).dtype
+        )
     target_dataset = builder.target_file.create_dataset(
         target_path,
-        transformed_data.shape,
+        source_dataset.shape,
         dtype=dtype,
         compression=builder.compress_type,
         compression_opts=builder.compress_opts,
     )
-    target_dataset[...] = transformed_data
+    for chunk_start in range(0, source_dataset.shape[0], chunk_size):
+        source_data = source_dataset[chunk_start : chunk_start + chunk_size]
+        if transformation is not None:
+            source_data = transformation(source_data)
+        target_dataset[chunk_start : chunk_start + chunk_size] = source_data
     return target_dataset
 
 
@@ -471,6 +487,7 @@ def __add_attributes(node, attributes):
             node.attrs.create(key, np.array(attributes[key]))
 
 
+@instrumented
 def add_nxlog(
     builder, nxlogname, parent_path="/", number_of_cues=1000, units="m", factor=1
 ):
@@ -0,0 +1,97 @@
+import argparse
+import time
+from typing import Tuple
+
+import numpy as np
+
+from examples.common.eventidmap import EventIdMap, lookup_ids
+
+"""
+Detector-spectrum map files, as used by NeXus-Streamer, which map detector ids to spectrum numbers
+
+The text format is:
+Number_of_entries
+<number of entries>
+Detector  Spectrum
+<detector id>    <spectrum number>
+...
+
+Files with a .npy extension are written and read as a binary (entries, 2) int64 array instead, which is
+faster to load again. Rows are formatted many at a time with a single string formatting
+operation rather than one write per detector, which is what makes writing maps for instruments
+with ~10^6 pixels, such as WISH, take well under a second.
+
+Time writing and reading a map with 778245 entries:
+python detspecmap.py --entries 778245
+"""
+
+HEADER = "Number_of_entries\n{}\nDetector  Spectrum\n"
+ROW_FORMAT = "{}    {}\n"
+# Rows formatted at a time
+CHUNK_SIZE = 65536
+
+
+def write_detspec_map(filename: str, detector_ids: np.ndarray, spectrum_numbers: np.ndarray):
+    detector_ids = np.asarray(detector_ids, dtype=np.int64).ravel()
+    spectrum_numbers = np.asarray(spectrum_numbers, dtype=np.int64).ravel()
+    if detector_ids.size != spectrum_numbers.size:
+        raise ValueError(
+            f"Detector-spectrum map needs a spectrum number for each of the {detector_ids.size} detectors, "
+            f"got {spectrum_numbers.size}"
+        )
+    if filename.endswith(".npy"):
+        np.save(filename, np.column_stack((detector_ids, spectrum_numbers)))
+        return
+
+    row_format = ROW_FORMAT.replace("{}", "%d")
+    with open(filename, "w", buffering=1 << 20) as map_file:
+        map_file.write(HEADER.format(detector_ids.size))
+        for chunk_start in range(0, detector_ids.size, CHUNK_SIZE):
+            chunk_end = min(chunk_start + CHUNK_SIZE, detector_ids.size)
+            rows = np.column_stack((detector_ids[chunk_start:chunk_end], spectrum_numbers[chunk_start:chunk_end]))
+            map_file.write((row_format * (chunk_end - chunk_start)) % tuple(rows.ravel().tolist()))
+
+
+def read_detspec_map(filename: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :return: detector ids and spectrum numbers
+    """
+    if filename.endswith(".npy"):
+        table = np.load(filename)
+    else:
+        with open(filename, "r") as map_file:
+            map_file.readline()
+            n_entries = int(map_file.readline())
+            map_file.readline()
+            table = np.loadtxt(map_file, dtype=np.int64, ndmin=2) if n_entries else np.empty((0, 2), np.int64)
+        if table.shape[0] != n_entries:
+            raise ValueError(f"{filename} has {table.shape[0]} entries but its header says {n_entries}")
+    return table[:, 0], table[:, 1]
+
+
+def detspec_id_map(filename: str) -> EventIdMap:
+    """
+    Event id map from detector ids to the spectrum numbers in the map file
+    """
+    return lookup_ids(*read_detspec_map(filename))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--entries", type=int, default=778245, help="Number of detectors in the map")
+    parser.add_argument("--output", type=str, default="benchmark_detspecmap", help="Map filename without extension")
+    args = parser.parse_args()
+
+    detector_ids = np.arange(1, args.entries + 1)
+    spectrum_numbers = np.arange(1, args.entries + 1)
+    for extension in (".dat", ".npy"):
+        filename = args.output + extension
+        start = time.perf_counter()
+        write_detspec_map(filename, detector_ids, spectrum_numbers)
+        written = time.perf_counter()
+        read_detector_ids, read_spectrum_numbers = read_detspec_map(filename)
+        read = time.perf_counter()
+        assert np.array_equal(read_detector_ids, detector_ids) and np.array_equal(
+            read_spectrum_numbers, spectrum_numbers
+        )
+        print(f"{filename}: written in {written - start:.3f} s, read in {read - written:.3f} s")
@@ -0,0 +1,172 @@
+from typing import Callable, Optional, Sequence, Tuple
+
+import h5py
+import numpy as np
+
+"""
+Remapping of event detector ids, applied to event_id data chunk by chunk as it is copied
+
+Each map is a function from an array of uint32 ids to an array of uint32 ids of the same length.
+Scaling and binning use integer arithmetic, masks and arbitrary maps (for example a
+detector-spectrum map) use a lookup table. Events whose id is masked, or has no entry in a map,
+are given MASKED_ID; where the event index is rebuilt, for example by aggregate_events_by_pulse,
+they are left out instead.
+
+Downscale raw 2^32 DENEX ids to a 150x150 grid, leaving out a dead pixel, for example:
+id_map = compose(scale_ids((2 ** 16) ** 2, 150 ** 2), mask_ids([4321]))
+copy_event_ids(source_file["raw/event_id"], target_group, "event_id", id_map)
+"""
+
+EventIdMap = Callable[[np.ndarray], np.ndarray]
+
+MASKED_ID = np.iinfo(np.uint32).max
+# Ids read and mapped at a time by copy_event_ids
+CHUNK_SIZE = 4194304
+# Largest range of ids a dense lookup table is used for, larger id ranges use a binary search
+MAX_DENSE_TABLE_SIZE = 1 << 24
+
+
+class _LookupTable:
+    """
+    Looks up values for keys, with default for keys which are not in the table
+    """
+
+    def __init__(self, keys: np.ndarray, values: np.ndarray, default):
+        keys = np.asarray(keys, dtype=np.int64).ravel()
+        values = np.asarray(values).ravel()
+        if keys.size != values.size:
+            raise ValueError(f"Lookup table has {keys.size} keys but {values.size} values")
+        order = np.argsort(keys, kind="stable")
+        keys, values = keys[order], values[order]
+        if keys.size and np.any(keys[1:] == keys[:-1]):
+            raise ValueError(f"Lookup table has repeated keys, for example {keys[1:][keys[1:] == keys[:-1]][0]}")
+        self._default = default
+        self._first_key = int(keys[0]) if keys.size else 0
+        span = int(keys[-1]) - self._first_key + 1 if keys.size else 0
+        if span <= MAX_DENSE_TABLE_SIZE:
+            self._dense = np.full(span, default, dtype=values.dtype)
+            self._dense[keys - self._first_key] = values
+        else:
+            self._dense = None
+            self._keys = keys
+            self._values = values
+
+    def __call__(self, keys: np.ndarray) -> np.ndarray:
+        keys = keys.astype(np.int64)
+        if self._dense is not None:
+            relative = keys - self._first_key
+            found = (relative >= 0) & (relative < self._dense.size)
+            result = np.full(keys.shape, self._default, dtype=self._dense.dtype)
+            result[found] = self._dense[relative[found]]
+            return result
+        positions = np.minimum(np.searchsorted(self._keys, keys), max(self._keys.size - 1, 0))
+        result = np.full(keys.shape, self._default, dtype=self._values.dtype)
+        if self._keys.size:
+            found = self._keys[positions] == keys
+            result[found] = self._values[positions[found]]
+        return result
+
+
+def scale_ids(source_size: int, target_size: int) -> EventIdMap:
+    """
+    Maps ids in [0, source_size) linearly onto [0, target_size), ids outside the range are masked
+
+    Uses exact integer arithmetic, id * target_size // source_size, rather than a float scale factor.
+    """
+    if source_size * target_size >= 2 ** 64:
+        raise ValueError(f"Scaling from {source_size} to {target_size} ids would overflow 64 bit integers")
+    source = np.uint64(source_size)
+    target = np.uint64(target_size)
+
+    def _scale(ids: np.ndarray) -> np.ndarray:
+        scaled = (ids.astype(np.uint64) * target // source).astype(np.uint32)
+        scaled[ids.astype(np.uint64) >= source] = MASKED_ID
+        return scaled
+
+    return _scale
+
+
+def bin_ids(shape: Tuple[int, int], bin_shape: Tuple[int, int], first_id: int = 0) -> EventIdMap:
+    """
+    Bins the pixels of a detector with shape (rows, columns) and ids numbered row by row from first_id
+    into bins of bin_shape (rows, columns) pixels, numbered row by row from first_id
+    """
+    rows, columns = shape
+    bin_rows, bin_columns = bin_shape
+    binned_columns = -(-columns // bin_columns)
+
+    def _bin(ids: np.ndarray) -> np.ndarray:
+        relative = ids.astype(np.int64) - first_id
+        row, column = np.divmod(relative, columns)
+        binned = ((row // bin_rows) * binned_columns + column // bin_columns + first_id).astype(np.uint32)
+        binned[(relative < 0) | (relative >= rows * columns)] = MASKED_ID
+        return binned
+
+    return _bin
+
+
+def mask_ids(masked_ids: Sequence[int]) -> EventIdMap:
+    """
+    Masks the given ids, other ids are unchanged
+    """
+    masked_ids = np.unique(np.asarray(masked_ids, dtype=np.int64))
+    is_masked = _LookupTable(masked_ids, np.ones(masked_ids.size, dtype=bool), False)
+
+    def _mask(ids: np.ndarray) -> np.ndarray:
+        masked = ids.astype(np.uint32)
+        masked[is_masked(ids)] = MASKED_ID
+        return masked
+
+    return _mask
+
+
+def lookup_ids(detector_ids: Sequence[int], mapped_ids: Sequence[int]) -> EventIdMap:
+    """
+    Maps each of detector_ids to the corresponding entry of mapped_ids, for example to spectrum numbers
+    with a detector-spectrum map, ids which are not in detector_ids are masked
+    """
+    table = _LookupTable(detector_ids, np.asarray(mapped_ids, dtype=np.uint32), MASKED_ID)
+
+    def _lookup(ids: np.ndarray) -> np.ndarray:
+        return table(ids)
+
+    return _lookup
+
+
+def compose(*id_maps: EventIdMap) -> EventIdMap:
+    """
+    Applies the maps in order, ids masked by one map stay masked
+    """
+
+    def _compose(ids: np.ndarray) -> np.ndarray:
+        ids = ids.astype(np.uint32)
+        for id_map in id_maps:
+            masked = ids == MASKED_ID
+            ids = id_map(ids)
+            ids[masked] = MASKED_ID
+        return ids
+
+    return _compose
+
+
+def copy_event_ids(
+    source: h5py.Dataset,
+    target_group: h5py.Group,
+    target_name: str,
+    id_map: Optional[EventIdMap] = None,
+    chunk_size: int = CHUNK_SIZE,
+    **dataset_options,
+) -> h5py.Dataset:
+    """
+    Copies an event_id dataset, applying id_map to each chunk, so memory use does not
+    depend on the number of events
+
+    :param dataset_options: passed to create_dataset, for example compression
+    """
+    n_events = source.shape[0]
+    target = target_group.create_dataset(target_name, (n_events,), dtype=np.uint32, **dataset_options)
+    for chunk_start in range(0, n_events, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, n_events)
+        ids = source[chunk_start:chunk_end]
+        target[chunk_start:chunk_end] = ids if id_map is None else id_map(ids)
+    return target
@@ -0,0 +1,154 @@
+"""
+Fast, read-only scanning of directories of NeXus (HDF5) run files
+
+Metadata read from each file is cached against the file's modification time and size,
+so repeated scans of large run directories only open files which are new or have changed.
+"""
+
+import csv
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+import h5py
+import numpy as np
+
+CACHE_VERSION = 1
+
+
+def open_read_only(filename: str) -> h5py.File:
+    """
+    Open a file only to read a few small metadata datasets:
+    no write access or file locking, and no raw data chunk cache
+    """
+    return h5py.File(filename, "r", locking=False, rdcc_nbytes=0)
+
+
+def decode_string(value) -> str:
+    """
+    String datasets are variously stored as fixed or variable length, scalar or single element arrays
+    """
+    if isinstance(value, np.ndarray):
+        value = value.flat[0] if value.size else ""
+    if isinstance(value, bytes):
+        value = value.decode("utf-8")
+    return str(value)
+
+
+def list_files(directory: str, extension: str = ".hdf") -> List[str]:
+    return sorted(
+        os.path.join(directory, f)
+        for f in os.listdir(directory)
+        if f.endswith(extension) and os.path.isfile(os.path.join(directory, f))
+    )
+
+
+def run_number_from_filename(filename: str) -> Optional[int]:
+    """
+    Run number is the trailing digits of the file name, for example amor2020n000346.hdf is run 346
+    """
+    match = re.search(r"(\d+)$", os.path.splitext(os.path.basename(filename))[0])
+    return int(match.group(1)) if match else None
+
+
+class RunFileScanner:
+    def __init__(
+        self,
+        read_metadata: Callable[[h5py.File], Dict],
+        cache_filename: Optional[str] = None,
+        max_workers: int = 8,
+    ):
+        """
+        :param read_metadata: called with each open file, returns a dictionary of JSON-serialisable metadata
+        :param cache_filename: JSON file to persist scanned metadata to, no caching if None
+        :param max_workers: number of threads used to open files
+        """
+        self._read_metadata = read_metadata
+        self._cache_filename = cache_filename
+        self._max_workers = max_workers
+        self._cache = self._load_cache()
+
+    def _load_cache(self) -> Dict[str, Dict]:
+        if self._cache_filename is None or not os.path.isfile(self._cache_filename):
+            return {}
+        try:
+            with open(self._cache_filename, "r") as cache_file:
+                cache = json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+        if cache.get("version") != CACHE_VERSION:
+            return {}
+        return cache.get("files", {})
+
+    def _save_cache(self):
+        if self._cache_filename is None:
+            return
+        temporary_filename = f"{self._cache_filename}.tmp"
+        with open(temporary_filename, "w") as cache_file:
+            json.dump({"version": CACHE_VERSION, "files": self._cache}, cache_file)
+        os.replace(temporary_filename, self._cache_filename)
+
+    def _scan_file(self, filename: str) -> Dict:
+        stat = os.stat(filename)
+        record = {
+            "filename": os.path.abspath(filename),
+            "run_number": run_number_from_filename(filename),
+            "file_size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+        }
+        try:
+            with open_read_only(filename) as run_file:
+                record.update(self._read_metadata(run_file))
+        except Exception as error:
+            # A corrupt or unusual file must not stop the scan of the others
+            record["error"] = f"{type(error).__name__}: {error}"
+        return record
+
+    def scan(self, filenames: List[str]) -> List[Dict]:
+        """
+        Returns a metadata record for each file, in the same order as filenames
+        """
+        records = {}
+        to_scan = []
+        for filename in filenames:
+            absolute_filename = os.path.abspath(filename)
+            cached = self._cache.get(absolute_filename)
+            if cached is not None:
+                stat = os.stat(absolute_filename)
+                if (
+                    cached["mtime_ns"] == stat.st_mtime_ns
+                    and cached["file_size"] == stat.st_size
+                ):
+                    records[filename] = cached
+                    continue
+            to_scan.append(filename)
+
+        if to_scan:
+            with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+                for filename, record in zip(to_scan, executor.map(self._scan_file, to_scan)):
+                    records[filename] = record
+                    # Don't cache failures, the file may still be being written
+                    if "error" not in record:
+                        self._cache[os.path.abspath(filename)] = record
+            self._save_cache()
+
+        return [records[filename] for filename in filenames]
+
+
+def write_index(records: List[Dict], index_filename: str, columns: List[str]):
+    """
+    Write the given columns of the scanned records to a CSV or JSON file, chosen by the file extension
+    """
+    rows = [{column: record.get(column) for column in columns} for record in records]
+    if index_filename.endswith(".json"):
+        with open(index_filename, "w") as index_file:
+            json.dump(rows, index_file, indent=2)
+    elif index_filename.endswith(".csv"):
+        with open(index_filename, "w", newline="") as index_file:
+            writer = csv.DictWriter(index_file, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(rows)
+    else:
+        raise ValueError(f"Index file must have a .csv or .json extension: {index_filename}")
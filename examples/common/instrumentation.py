@@ -0,0 +1,252 @@
+import atexit
+import functools
+import inspect
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import h5py
+
+"""
+Per-stage timing and memory instrumentation for the generator scripts
+
+Stages are marked with the instrumented decorator or the stage context manager, and nest:
+@instrumented
+def create_sector(...):
+    ...
+with stage("write geometry", hdf5_file=filename):
+    ...
+
+Instrumentation is off, and costs nothing more than a function call, unless the STAGE_REPORT
+environment variable is set, or enable() is called. Run any instrumented script with
+STAGE_REPORT=stages.json python dream.py
+to get, when the script exits:
+- stages.json, wall time, CPU time, peak RSS and bytes written for each stage, totalled over calls
+- stages.collapsed, the self wall time in microseconds of each stack of stages, in the collapsed
+  format of flamegraph.pl and speedscope
+
+For each stage:
+- cpu_time is the CPU time of the thread the stage ran in
+- peak_rss is the process's peak RSS when the stage ended, and peak_rss_increase how much the stage
+  raised it, so the stage which reached the peak is the one with the largest increase
+- bytes_written is what the process wrote to files (Linux only), in these scripts almost all HDF5,
+  and hdf5_bytes how much the stage's HDF5 file grew, if the stage was given the file
+Stages run in worker processes, for example by a ProcessPoolExecutor, are recorded as well, under
+"worker processes", and stages run in other threads under "worker threads", in both cases without the
+stages of the process or thread which started them. Threads share the process's bytes written, so
+overlapping stages in a thread pool all count each other's writes.
+"""
+
+REPORT_ENVIRONMENT_VARIABLE = "STAGE_REPORT"
+# Set by the process which writes the report, for it and its child processes to record stages to
+_RECORDS_ENVIRONMENT_VARIABLE = "_STAGE_RECORDS"
+_ROOT_PID_ENVIRONMENT_VARIABLE = "_STAGE_RECORDS_PID"
+
+_records_filename: Optional[str] = None
+_records_lock = threading.Lock()
+# Bytes this module has written to the records file, which are not counted as written by stages
+_record_bytes = 0
+_thread_state = threading.local()
+
+
+def _peak_rss() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _bytes_written() -> Optional[int]:
+    try:
+        with open("/proc/self/io", "r") as io_file:
+            for line in io_file:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1]) - _record_bytes
+    except OSError:
+        pass
+    return None
+
+
+def _hdf5_size(hdf5_file) -> int:
+    if isinstance(hdf5_file, h5py.File):
+        return hdf5_file.id.get_filesize() if hdf5_file.id.valid else 0
+    return os.path.getsize(hdf5_file) if os.path.isfile(hdf5_file) else 0
+
+
+def _append_record(record: Dict):
+    global _record_bytes
+    line = json.dumps(record) + "\n"
+    with _records_lock:
+        with open(_records_filename, "a") as records_file:
+            records_file.write(line)
+        _record_bytes += len(line)
+
+
+@contextmanager
+def stage(name: str, hdf5_file=None):
+    """
+    Records a stage if instrumentation is enabled
+
+    :param hdf5_file: h5py.File or filename, to record how much the file grows during the stage
+    """
+    if _records_filename is None:
+        yield
+        return
+
+    stack = getattr(_thread_state, "stack", None)
+    if stack is None:
+        stack = _thread_state.stack = []
+    frame = {"name": name, "child_time": 0.0}
+    stack.append(frame)
+    hdf5_size_before = _hdf5_size(hdf5_file) if hdf5_file is not None else None
+    bytes_written_before = _bytes_written()
+    peak_rss_before = _peak_rss()
+    cpu_start = time.thread_time()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        wall_time = time.perf_counter() - start
+        cpu_time = time.thread_time() - cpu_start
+        peak_rss = _peak_rss()
+        bytes_written = _bytes_written()
+        path = [stack_frame["name"] for stack_frame in stack]
+        stack.pop()
+        if stack:
+            stack[-1]["child_time"] += wall_time
+        if threading.current_thread() is not threading.main_thread():
+            path.insert(0, "worker threads")
+        if os.getpid() != _root_pid():
+            path.insert(0, "worker processes")
+        _append_record(
+            {
+                "path": path,
+                "wall_time": wall_time,
+                "self_time": wall_time - frame["child_time"],
+                "cpu_time": cpu_time,
+                "peak_rss": peak_rss,
+                "peak_rss_increase": peak_rss - peak_rss_before,
+                "bytes_written": None if bytes_written is None else bytes_written - bytes_written_before,
+                "hdf5_bytes": None if hdf5_file is None else _hdf5_size(hdf5_file) - hdf5_size_before,
+            }
+        )
+
+
+def instrumented(function=None, *, name: Optional[str] = None, hdf5_argument: Optional[str] = None):
+    """
+    Decorator which records each call of the function as a stage, named after the function by default
+
+    :param hdf5_argument: name of the function's argument which is the HDF5 file (or filename) it writes
+    """
+
+    def _decorate(function):
+        stage_name = name or function.__qualname__
+        signature = inspect.signature(function) if hdf5_argument is not None else None
+
+        @functools.wraps(function)
+        def _wrapper(*args, **kwargs):
+            if _records_filename is None:
+                return function(*args, **kwargs)
+            hdf5_file = None
+            if signature is not None:
+                hdf5_file = signature.bind(*args, **kwargs).arguments.get(hdf5_argument)
+            with stage(stage_name, hdf5_file):
+                return function(*args, **kwargs)
+
+        return _wrapper
+
+    return _decorate(function) if function is not None else _decorate
+
+
+def summarise(records: List[Dict]) -> List[Dict]:
+    """
+    :return: totals for each stack of stages, in the order they first finished
+    """
+    stages = OrderedDict()
+    for record in records:
+        key = tuple(record["path"])
+        if key not in stages:
+            stages[key] = {
+                "path": ";".join(key),
+                "calls": 0,
+                "wall_time": 0.0,
+                "self_time": 0.0,
+                "cpu_time": 0.0,
+                "peak_rss": 0,
+                "peak_rss_increase": 0,
+                "bytes_written": None,
+                "hdf5_bytes": None,
+            }
+        summary = stages[key]
+        summary["calls"] += 1
+        for metric in ("wall_time", "self_time", "cpu_time", "peak_rss_increase"):
+            summary[metric] += record[metric]
+        summary["peak_rss"] = max(summary["peak_rss"], record["peak_rss"])
+        for metric in ("bytes_written", "hdf5_bytes"):
+            if record[metric] is not None:
+                summary[metric] = (summary[metric] or 0) + record[metric]
+    return list(stages.values())
+
+
+def write_report(report_filename: str, records_filename: Optional[str] = None):
+    """
+    Writes the JSON report and, next to it with a .collapsed extension, the collapsed stacks for a flame graph
+    """
+    records_filename = records_filename or _records_filename
+    records = []
+    if records_filename is not None and os.path.isfile(records_filename):
+        with open(records_filename, "r") as records_file:
+            records = [json.loads(line) for line in records_file if line.strip()]
+    stages = summarise(records)
+    with open(report_filename, "w") as report_file:
+        json.dump({"stages": stages}, report_file, indent=2)
+    with open(os.path.splitext(report_filename)[0] + ".collapsed", "w") as collapsed_file:
+        for summary in stages:
+            collapsed_file.write(f"{summary['path']} {int(round(summary['self_time'] * 1e6))}\n")
+
+
+def _root_pid() -> int:
+    return int(os.environ.get(_ROOT_PID_ENVIRONMENT_VARIABLE, os.getpid()))
+
+
+def _reset_stack_in_child():
+    # A forked child inherits the stack of the thread which forked it, start afresh as
+    # spawned processes and threads do, since the parent's stages already include the child's time
+    _thread_state.stack = []
+
+
+def enable(report_filename: str):
+    """
+    Records stages in this process and its child processes, and writes the report to report_filename on exit
+    """
+    global _records_filename
+    records_file, _records_filename = tempfile.mkstemp(prefix="stages_", suffix=".jsonl")
+    os.close(records_file)
+    os.environ[_RECORDS_ENVIRONMENT_VARIABLE] = _records_filename
+    os.environ[_ROOT_PID_ENVIRONMENT_VARIABLE] = str(os.getpid())
+
+    def _write_report_on_exit(records_filename=_records_filename, pid=os.getpid()):
+        if os.getpid() != pid:
+            # Forked child process
+            return
+        write_report(report_filename, records_filename)
+        os.remove(records_filename)
+        print(f"Stage report written to {report_filename}")
+
+    atexit.register(_write_report_on_exit)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_stack_in_child)
+
+if _RECORDS_ENVIRONMENT_VARIABLE in os.environ:
+    # Child process of one with instrumentation enabled
+    _records_filename = os.environ[_RECORDS_ENVIRONMENT_VARIABLE]
+elif os.environ.get(REPORT_ENVIRONMENT_VARIABLE):
+    enable(os.environ[REPORT_ENVIRONMENT_VARIABLE])
@@ -0,0 +1,293 @@
+"""
+Replays the event and log data in existing NeXus files as ev42 and f142 messages,
+for example the output of the V20, AMOR or bigfake scripts, to test the file-writer
+with realistic data.
+
+NXevent_data and NXlog groups are read chunk by chunk, so files larger than memory can
+be replayed. Messages from all groups are merged in timestamp order and published
+at the original speed, N times faster, or as fast as possible.
+
+python nexusreplay.py V20_example.nxs --speed 10 --broker localhost:9092
+python nexusreplay.py V20_example.nxs --speed 0 --fake-broker
+"""
+
+import argparse
+import heapq
+import time
+from typing import Iterator, List, Optional, Tuple
+
+import h5py
+import numpy as np
+from streaming_data_types.eventdata_ev42 import serialise_ev42
+from streaming_data_types.logdata_f142 import serialise_f142
+
+from examples.common.filescanner import decode_string
+from examples.common.runcatalogue import iso8601_to_unix
+
+# Number of pulses, events or log entries read from the file at a time
+CHUNK_SIZE = 10000
+
+TIME_UNIT_SCALE_TO_NS = {
+    "s": 1_000_000_000,
+    "second": 1_000_000_000,
+    "seconds": 1_000_000_000,
+    "ms": 1_000_000,
+    "millisecond": 1_000_000,
+    "us": 1_000,
+    "microsecond": 1_000,
+    "microseconds": 1_000,
+    "ns": 1,
+    "nanosecond": 1,
+    "nanoseconds": 1,
+}
+
+EVENT_DATASETS = {"event_time_zero", "event_index", "event_id", "event_time_offset"}
+
+# (timestamp in ns since the unix epoch, topic, serialised message)
+Message = Tuple[int, str, bytes]
+
+
+def _nx_class(node) -> str:
+    return decode_string(node.attrs.get("NX_class", b""))
+
+
+def _scale_to_ns(dataset: h5py.Dataset) -> int:
+    units = decode_string(dataset.attrs.get("units", "ns"))
+    try:
+        return TIME_UNIT_SCALE_TO_NS[units]
+    except KeyError:
+        raise ValueError(f"Unsupported time units {units} of {dataset.name}")
+
+
+def _to_ns(times: np.ndarray, scale: int) -> np.ndarray:
+    """
+    Converts times to integer nanoseconds, integer times already in ns are returned as they are
+    """
+    if np.issubdtype(times.dtype, np.integer):
+        return times if scale == 1 else times.astype(np.int64) * scale
+    return np.round(times * scale).astype(np.int64)
+
+
+def _to_unix_ns(times: np.ndarray, dataset: h5py.Dataset, offset_attribute: str) -> np.ndarray:
+    """
+    Converts times in the dataset's units, relative to the ISO8601 time in the
+    offset attribute if it has one, to integer nanoseconds since the unix epoch
+    """
+    offset_ns = 0
+    if offset_attribute in dataset.attrs:
+        offset = iso8601_to_unix(decode_string(dataset.attrs[offset_attribute]))
+        if offset is not None:
+            offset_ns = int(round(offset * 1e9))
+    return _to_ns(times, _scale_to_ns(dataset)).astype(np.int64) + offset_ns
+
+
+def read_event_messages(
+    group: h5py.Group, topic: str, source_name: str, chunk_size: int = CHUNK_SIZE
+) -> Iterator[Message]:
+    """
+    One ev42 message per pulse of the NXevent_data group
+
+    Pulses and events are each read at most chunk_size at a time, events of a pulse which
+    runs past the end of a read are carried over to the next one. A pulse with more than
+    chunk_size events is read whole, as it is sent in one message.
+    """
+    event_time_zero = group["event_time_zero"]
+    event_index = group["event_index"]
+    event_id = group["event_id"]
+    event_time_offset = group["event_time_offset"]
+    n_pulses = event_time_zero.shape[0]
+    n_events = event_id.shape[0]
+    # ev42 time offsets are in ns
+    time_offset_scale = _scale_to_ns(event_time_offset)
+
+    # Events read from the file and not yet sent, starting at event number buffer_start
+    buffer_start = 0
+    ids = event_id[0:0]
+    time_offsets = _to_ns(event_time_offset[0:0], time_offset_scale)
+    for chunk_start in range(0, n_pulses, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, n_pulses)
+        pulse_times = _to_unix_ns(event_time_zero[chunk_start:chunk_end], event_time_zero, "offset")
+        indices = event_index[chunk_start:chunk_end].astype(np.int64)
+        last_event = int(event_index[chunk_end]) if chunk_end < n_pulses else n_events
+        boundaries = np.append(indices, last_event)
+        for pulse in range(chunk_end - chunk_start):
+            first, last = int(boundaries[pulse]), int(boundaries[pulse + 1])
+            buffer_end = buffer_start + ids.shape[0]
+            if last > buffer_end:
+                read_start = max(buffer_end, first)
+                read_end = min(max(last, first + chunk_size), n_events)
+                # Keep the events of this pulse which were already read
+                kept = slice(first - buffer_start, None)
+                ids = np.concatenate((ids[kept], event_id[read_start:read_end]))
+                time_offsets = np.concatenate(
+                    (time_offsets[kept], _to_ns(event_time_offset[read_start:read_end], time_offset_scale))
+                )
+                buffer_start = first
+            events = slice(first - buffer_start, last - buffer_start)
+            yield (
+                int(pulse_times[pulse]),
+                topic,
+                serialise_ev42(
+                    source_name,
+                    chunk_start + pulse,
+                    int(pulse_times[pulse]),
+                    time_offsets[events],
+                    ids[events],
+                ),
+            )
+
+
+def read_log_messages(
+    group: h5py.Group, topic: str, source_name: str, chunk_size: int = CHUNK_SIZE
+) -> Iterator[Message]:
+    """
+    One f142 message per value of the NXlog group
+    """
+    times = group["time"]
+    values = group["value"]
+    n_values = min(times.shape[0], values.shape[0])
+    for chunk_start in range(0, n_values, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, n_values)
+        timestamps = _to_unix_ns(times[chunk_start:chunk_end], times, "start")
+        chunk_values = values[chunk_start:chunk_end]
+        for timestamp, value in zip(timestamps, chunk_values):
+            yield int(timestamp), topic, serialise_f142(value, source_name, int(timestamp))
+
+
+def find_sources(nexus_file: h5py.File, event_topic: str, log_topic: str, chunk_size: int = CHUNK_SIZE):
+    """
+    :return: message iterator for each NXevent_data and NXlog group in the file,
+      the source name is the name of the group's parent for event data and of the group for logs
+    """
+    sources = []
+
+    def _visit(name, node):
+        if not isinstance(node, h5py.Group):
+            return
+        nx_class = _nx_class(node)
+        if nx_class == "NXevent_data" and EVENT_DATASETS <= set(node.keys()):
+            if node["event_time_zero"].shape[0]:
+                source_name = node.parent.name.split("/")[-1]
+                sources.append((node.name, read_event_messages(node, event_topic, source_name, chunk_size)))
+        elif nx_class == "NXlog" and {"time", "value"} <= set(node.keys()):
+            if node["time"].shape and node["time"].shape[0]:
+                sources.append((node.name, read_log_messages(node, log_topic, node.name.split("/")[-1], chunk_size)))
+
+    nexus_file.visititems(_visit)
+    return sources
+
+
+class MemorySink:
+    """
+    Keeps the messages in memory (or only counts them), for tests which should not need a broker
+    """
+
+    def __init__(self, keep_messages: bool = True):
+        self.keep_messages = keep_messages
+        self.messages: List[Message] = []
+        self.message_count = 0
+        self.bytes = 0
+
+    def send(self, topic: str, message: bytes, timestamp_ns: int):
+        self.message_count += 1
+        self.bytes += len(message)
+        if self.keep_messages:
+            self.messages.append((timestamp_ns, topic, message))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class KafkaSink:
+    def __init__(self, broker: str, linger_ms: int = 5, max_request_size: int = 20000000):
+        from kafka import KafkaProducer
+
+        self._producer = KafkaProducer(
+            bootstrap_servers=broker,
+            linger_ms=linger_ms,
+            max_request_size=max_request_size,
+        )
+
+    def send(self, topic: str, message: bytes, timestamp_ns: int):
+        self._producer.send(topic, message, timestamp_ms=timestamp_ns // 1_000_000)
+
+    def flush(self):
+        self._producer.flush()
+
+    def close(self):
+        self._producer.close()
+
+
+def replay(messages: Iterator[Message], sink, speed: Optional[float] = 1.0) -> Tuple[int, int, float]:
+    """
+    Sends the time ordered messages to the sink, with the same spacing in time as their
+    timestamps divided by speed, or as fast as possible if speed is None or 0
+
+    :return: number of messages and bytes sent and the time taken in seconds
+    """
+    message_count = 0
+    byte_count = 0
+    start = time.perf_counter()
+    first_timestamp = None
+    for timestamp, topic, message in messages:
+        if speed:
+            if first_timestamp is None:
+                first_timestamp = timestamp
+            delay = start + (timestamp - first_timestamp) / 1e9 / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        sink.send(topic, message, timestamp)
+        message_count += 1
+        byte_count += len(message)
+    sink.flush()
+    return message_count, byte_count, time.perf_counter() - start
+
+
+def replay_file(
+    nexus_filename: str,
+    sink,
+    event_topic: str,
+    log_topic: str,
+    speed: Optional[float] = 1.0,
+    chunk_size: int = CHUNK_SIZE,
+) -> Tuple[int, int, float]:
+    with h5py.File(nexus_filename, "r") as nexus_file:
+        sources = find_sources(nexus_file, event_topic, log_topic, chunk_size)
+        for path, _ in sources:
+            print(f"Replaying {path}")
+        # k-way merge of the time ordered messages from each group
+        messages = heapq.merge(*[source for _, source in sources], key=lambda message: message[0])
+        return replay(messages, sink, speed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("filename", type=str, help="NeXus file to replay")
+    parser.add_argument("--broker", type=str, default="localhost:9092")
+    parser.add_argument("--event-topic", type=str, default="replay_events", help="Topic for ev42 messages")
+    parser.add_argument("--log-topic", type=str, default="replay_logs", help="Topic for f142 messages")
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="Replay speed relative to the timestamps in the file, 0 to send as fast as possible",
+    )
+    parser.add_argument(
+        "--chunk-size", type=int, default=CHUNK_SIZE, help="Pulses, events or log values read at a time"
+    )
+    parser.add_argument("--fake-broker", action="store_true", help="Only count messages, do not connect to Kafka")
+    args = parser.parse_args()
+
+    sink = MemorySink(keep_messages=False) if args.fake_broker else KafkaSink(args.broker)
+    count, n_bytes, duration = replay_file(
+        args.filename, sink, args.event_topic, args.log_topic, args.speed, args.chunk_size
+    )
+    sink.close()
+    duration = max(duration, 1e-9)
+    print(
+        f"Sent {count} messages ({n_bytes / 1e6:.1f} MB) in {duration:.1f} s: "
+        f"{count / duration:.1f} messages/s, {n_bytes / duration / 1e6:.1f} MB/s"
+    )
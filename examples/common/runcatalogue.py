@@ -0,0 +1,302 @@
+"""
+Persistent SQLite catalogue of run file metadata
+
+Files are only opened when they are first seen or have changed since they were last indexed,
+after that selecting runs by time window, title or instrument is a database query.
+
+Index some directories:
+python runcatalogue.py index --catalogue runs.sqlite -d /data/v20 -d /data/amor
+Find runs overlapping a time window:
+python runcatalogue.py query --catalogue runs.sqlite --from 2019-01-01T00:00:00 --to 2019-01-02T00:00:00
+"""
+
+import argparse
+import os
+import re
+import sqlite3
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import h5py
+
+from examples.common.filescanner import RunFileScanner, decode_string, list_files
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    filename TEXT PRIMARY KEY,
+    run_number INTEGER,
+    file_size INTEGER,
+    mtime_ns INTEGER,
+    start_time TEXT,
+    start_unix REAL,
+    end_time TEXT,
+    end_unix REAL,
+    title TEXT,
+    instrument TEXT,
+    total_events INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_start_unix ON runs (start_unix);
+CREATE INDEX IF NOT EXISTS runs_end_unix ON runs (end_unix);
+CREATE INDEX IF NOT EXISTS runs_title ON runs (title);
+CREATE TABLE IF NOT EXISTS detectors (
+    filename TEXT REFERENCES runs (filename) ON DELETE CASCADE,
+    path TEXT,
+    pixel_count INTEGER,
+    event_count INTEGER
+);
+CREATE INDEX IF NOT EXISTS detectors_filename ON detectors (filename);
+"""
+
+RUN_COLUMNS = [
+    "filename",
+    "run_number",
+    "file_size",
+    "mtime_ns",
+    "start_time",
+    "start_unix",
+    "end_time",
+    "end_unix",
+    "title",
+    "instrument",
+    "total_events",
+]
+
+
+def iso8601_to_unix(time_str: Optional[str]) -> Optional[float]:
+    """
+    Times without a timezone are assumed to be UTC, fractions of a second beyond microseconds are dropped
+    """
+    if not time_str:
+        return None
+    time_str = re.sub(r"(\.\d{6})\d+", r"\1", time_str.strip()).replace("Z", "+00:00")
+    try:
+        date_time = datetime.fromisoformat(time_str)
+    except ValueError:
+        return None
+    if date_time.tzinfo is None:
+        date_time = date_time.replace(tzinfo=timezone.utc)
+    return date_time.timestamp()
+
+
+def _nx_class(node) -> str:
+    return decode_string(node.attrs.get("NX_class", b""))
+
+
+def _read_optional_string(group: h5py.Group, name: str) -> Optional[str]:
+    if name in group and isinstance(group[name], h5py.Dataset):
+        return decode_string(group[name][...])
+    return None
+
+
+def _find_entry(run_file: h5py.File) -> h5py.Group:
+    """
+    ESS files have an NXentry, old AMOR files keep run metadata in an "experiment" group
+    """
+    for name, node in run_file.items():
+        if isinstance(node, h5py.Group) and _nx_class(node) == "NXentry":
+            return node
+    for name in ("entry", "experiment", "raw_data_1"):
+        if name in run_file:
+            return run_file[name]
+    return run_file
+
+
+def read_run_metadata(run_file: h5py.File) -> Dict:
+    """
+    Reads run metadata from the file structure, only dataset shapes are read for detectors and event data
+    """
+    entry = _find_entry(run_file)
+    metadata = {
+        "start_time": _read_optional_string(entry, "start_time"),
+        "end_time": _read_optional_string(entry, "end_time"),
+        "title": _read_optional_string(entry, "title"),
+        "instrument": None,
+    }
+
+    detectors = []
+    event_counts = {}
+
+    def _visit(name, node):
+        if not isinstance(node, h5py.Group):
+            return
+        nx_class = _nx_class(node)
+        if nx_class == "NXinstrument" and metadata["instrument"] is None:
+            metadata["instrument"] = _read_optional_string(node, "name")
+        elif nx_class == "NXdetector":
+            pixel_count = node["detector_number"].size if "detector_number" in node else None
+            detectors.append({"path": node.name, "pixel_count": pixel_count})
+        elif nx_class == "NXevent_data":
+            for dataset_name in ("event_id", "event_time_offset"):
+                if dataset_name in node:
+                    event_counts[node.name] = node[dataset_name].size
+                    break
+
+    run_file.visititems(_visit)
+    if metadata["instrument"] is None:
+        metadata["instrument"] = _read_optional_string(entry, "name")
+
+    for detector in detectors:
+        detector["event_count"] = sum(
+            count
+            for path, count in event_counts.items()
+            if path.startswith(detector["path"] + "/")
+        )
+    metadata["detectors"] = detectors
+    metadata["total_events"] = sum(event_counts.values())
+    return metadata
+
+
+class RunCatalogue:
+    def __init__(self, catalogue_filename: str, max_workers: int = 8):
+        self._connection = sqlite3.connect(catalogue_filename)
+        self._connection.execute("PRAGMA foreign_keys = ON")
+        self._connection.executescript(SCHEMA)
+        self._scanner = RunFileScanner(read_run_metadata, max_workers=max_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self._connection.close()
+
+    def _is_up_to_date(self, filename: str) -> bool:
+        row = self._connection.execute(
+            "SELECT mtime_ns, file_size FROM runs WHERE filename = ?", (filename,)
+        ).fetchone()
+        if row is None:
+            return False
+        stat = os.stat(filename)
+        return row[0] == stat.st_mtime_ns and row[1] == stat.st_size
+
+    def update(self, filenames: List[str]) -> int:
+        """
+        Adds new files to the catalogue and re-indexes files which have changed
+
+        :return: number of files which were (re)indexed
+        """
+        filenames = [os.path.abspath(filename) for filename in filenames]
+        to_index = [filename for filename in filenames if not self._is_up_to_date(filename)]
+        indexed = 0
+        with self._connection:
+            for record in self._scanner.scan(to_index):
+                if "error" in record:
+                    print(f"Failed to index {record['filename']}: {record['error']}")
+                    continue
+                record["start_unix"] = iso8601_to_unix(record["start_time"])
+                record["end_unix"] = iso8601_to_unix(record["end_time"])
+                self._connection.execute(
+                    "DELETE FROM runs WHERE filename = ?", (record["filename"],)
+                )
+                self._connection.execute(
+                    f"INSERT INTO runs ({', '.join(RUN_COLUMNS)}) "
+                    f"VALUES ({', '.join('?' * len(RUN_COLUMNS))})",
+                    [record[column] for column in RUN_COLUMNS],
+                )
+                self._connection.executemany(
+                    "INSERT INTO detectors (filename, path, pixel_count, event_count) VALUES (?, ?, ?, ?)",
+                    [
+                        (record["filename"], detector["path"], detector["pixel_count"], detector["event_count"])
+                        for detector in record["detectors"]
+                    ],
+                )
+                indexed += 1
+        return indexed
+
+    def update_directory(self, directory: str, extension: str = ".hdf") -> int:
+        """
+        Indexes new and changed files in the directory and removes entries for files which no longer exist
+        """
+        filenames = list_files(directory, extension)
+        indexed = self.update(filenames)
+        directory = os.path.abspath(directory)
+        existing = set(os.path.abspath(filename) for filename in filenames)
+        with self._connection:
+            for (filename,) in self._connection.execute(
+                "SELECT filename FROM runs WHERE filename LIKE ?", (os.path.join(directory, "%"),)
+            ).fetchall():
+                if filename not in existing and os.path.dirname(filename) == directory:
+                    self._connection.execute("DELETE FROM runs WHERE filename = ?", (filename,))
+        return indexed
+
+    def find_runs(
+        self,
+        start: Optional[str] = None,
+        end: Optional[str] = None,
+        title: Optional[str] = None,
+        instrument: Optional[str] = None,
+    ) -> List[Dict]:
+        """
+        Find runs which overlap the time window from start to end (ISO8601 strings),
+        whose title contains the given text and which are from the given instrument.
+        Runs without an end time are treated as instantaneous at their start time.
+        """
+        conditions = []
+        parameters = []
+        if start is not None:
+            conditions.append("COALESCE(end_unix, start_unix) >= ?")
+            parameters.append(iso8601_to_unix(start))
+        if end is not None:
+            conditions.append("start_unix <= ?")
+            parameters.append(iso8601_to_unix(end))
+        if title is not None:
+            conditions.append("title LIKE ?")
+            parameters.append(f"%{title}%")
+        if instrument is not None:
+            conditions.append("instrument = ?")
+            parameters.append(instrument)
+        query = f"SELECT {', '.join(RUN_COLUMNS)} FROM runs"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY start_unix"
+        return [dict(zip(RUN_COLUMNS, row)) for row in self._connection.execute(query, parameters)]
+
+    def runs(self, filenames: List[str]) -> List[Optional[Dict]]:
+        """
+        Returns the catalogue entry of each file, in the same order as filenames, None for files which are not in it
+        """
+        query = f"SELECT {', '.join(RUN_COLUMNS)} FROM runs WHERE filename = ?"
+        runs = []
+        for filename in filenames:
+            row = self._connection.execute(query, (os.path.abspath(filename),)).fetchone()
+            runs.append(None if row is None else dict(zip(RUN_COLUMNS, row)))
+        return runs
+
+    def detectors(self, filename: str) -> List[Dict]:
+        rows = self._connection.execute(
+            "SELECT path, pixel_count, event_count FROM detectors WHERE filename = ?",
+            (os.path.abspath(filename),),
+        )
+        return [{"path": path, "pixel_count": pixels, "event_count": events} for path, pixels, events in rows]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--catalogue", type=str, help="SQLite catalogue file", required=True)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    index_parser = subparsers.add_parser("index", help="Add new and changed files to the catalogue")
+    index_parser.add_argument("-d", "--directory", type=str, action="append", required=True,
+                              help="Directory of run files, can be given more than once")
+    index_parser.add_argument("--extension", type=str, default=".hdf", help="Extension of run files")
+    index_parser.add_argument("--threads", type=int, default=8, help="Number of threads used to open files")
+
+    query_parser = subparsers.add_parser("query", help="Find runs in the catalogue")
+    query_parser.add_argument("--from", dest="start", type=str, help="Start of time window (ISO8601)")
+    query_parser.add_argument("--to", dest="end", type=str, help="End of time window (ISO8601)")
+    query_parser.add_argument("--title", type=str, help="Text contained in the run title")
+    query_parser.add_argument("--instrument", type=str, help="Instrument name")
+    args = parser.parse_args()
+
+    if args.command == "index":
+        with RunCatalogue(args.catalogue, max_workers=args.threads) as catalogue:
+            for directory in args.directory:
+                number_indexed = catalogue.update_directory(directory, args.extension)
+                print(f"Indexed {number_indexed} new or changed files in {directory}")
+    else:
+        with RunCatalogue(args.catalogue) as catalogue:
+            for run in catalogue.find_runs(args.start, args.end, args.title, args.instrument):
+                print(f"{run['filename']} start: {run['start_time']} end: {run['end_time']} "
+                      f"title: {run['title']} events: {run['total_events']}")
@@ -0,0 +1,380 @@
+import base64
+import json
+import os
+import zipfile
+import zlib
+from io import BytesIO
+from typing import Dict, Optional, TextIO
+
+import h5py
+import numpy as np
+
+"""
+Converts a NeXus file to the file-writer JSON "nexus_structure" by walking it with h5py,
+writing the JSON to the output as it goes.
+
+The output has the same layout as nexusjson's NexusToDictConverter, but no tree of the
+whole file is built in memory: datasets are read block by block and large numeric arrays
+are written compactly on a single line.
+
+Optionally, large numeric arrays can be written in a binary encoding instead of as JSON numbers,
+which makes command messages much smaller and faster to parse:
+- base64: a compressed .npy blob inlined in the JSON as {"encoding": "npy+zlib+base64", "data": ...}
+- npz: the array is stored in an .npz sidecar file and referenced as {"$ref": "<sidecar>#<dataset path>"}
+resolve_array_references() converts either back to plain values.
+"""
+
+# Number of elements read from a dataset at a time when writing its values
+BLOCK_SIZE = 65536
+
+_PLACEHOLDER = "__NEXUS_STRUCTURE_PLACEHOLDER__"
+
+INLINE_ENCODING = "npy+zlib+base64"
+
+
+def _decode(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _dtype_name(dtype: np.dtype) -> str:
+    if dtype.kind in ("S", "U", "O"):
+        return "string"
+    if dtype == np.float64:
+        return "double"
+    if dtype == np.float32:
+        return "float"
+    return str(dtype)
+
+
+def _compact(value) -> str:
+    return json.dumps(value, separators=(",", ":"))
+
+
+def _npy_header(dataset: h5py.Dataset) -> bytes:
+    header = BytesIO()
+    np.lib.format.write_array_header_1_0(
+        header,
+        {
+            "descr": np.lib.format.dtype_to_descr(dataset.dtype),
+            "fortran_order": False,
+            "shape": dataset.shape,
+        },
+    )
+    return header.getvalue()
+
+
+def _iterate_blocks(dataset: h5py.Dataset):
+    row_size = dataset.size // dataset.shape[0]
+    rows_per_block = max(BLOCK_SIZE // row_size, 1)
+    for start in range(0, dataset.shape[0], rows_per_block):
+        yield dataset[start : start + rows_per_block]
+
+
+class Base64ArrayEncoder:
+    """
+    Inline numeric arrays of at least threshold bytes as base64 encoded, compressed .npy data
+    """
+
+    def __init__(self, threshold: int = 65536):
+        self.threshold = threshold
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def write(self, dataset: h5py.Dataset, output: TextIO):
+        output.write(f'{{"encoding": "{INLINE_ENCODING}", "data": "')
+        compressor = zlib.compressobj()
+        pending = b""
+        for block in [[_npy_header(dataset)], _iterate_blocks(dataset)]:
+            for data in block:
+                pending += compressor.compress(data if isinstance(data, bytes) else data.tobytes())
+                # base64 encodes 3 bytes at a time, keep any remainder for the next block
+                whole = len(pending) - len(pending) % 3
+                output.write(base64.b64encode(pending[:whole]).decode("ascii"))
+                pending = pending[whole:]
+        pending += compressor.flush()
+        output.write(base64.b64encode(pending).decode("ascii"))
+        output.write('"}')
+
+
+class NpzSidecarArrayEncoder:
+    """
+    Store numeric arrays of at least threshold bytes in a compressed .npz file alongside the JSON
+    """
+
+    def __init__(self, sidecar_filename: str, threshold: int = 65536):
+        self.threshold = threshold
+        self._sidecar_filename = sidecar_filename
+        self._sidecar = None
+
+    def __enter__(self):
+        self._sidecar = zipfile.ZipFile(self._sidecar_filename, "w", compression=zipfile.ZIP_DEFLATED)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._sidecar.close()
+
+    def write(self, dataset: h5py.Dataset, output: TextIO):
+        with self._sidecar.open(dataset.name.lstrip("/") + ".npy", "w", force_zip64=True) as member:
+            member.write(_npy_header(dataset))
+            for block in _iterate_blocks(dataset):
+                member.write(block.tobytes())
+        reference = f"{os.path.basename(self._sidecar_filename)}#{dataset.name}"
+        output.write(json.dumps({"$ref": reference}))
+
+
+def create_array_encoder(encoding: str, json_filename: str, threshold: int = 65536):
+    """
+    :param encoding: "json" for plain JSON values, "base64" or "npz", see module docstring
+    :return: encoder to use as a context manager around writing the JSON, or None for plain JSON
+    """
+    if encoding == "json":
+        return None
+    if encoding == "base64":
+        return Base64ArrayEncoder(threshold)
+    if encoding == "npz":
+        return NpzSidecarArrayEncoder(f"{os.path.splitext(json_filename)[0]}_arrays.npz", threshold)
+    raise ValueError(f"Unknown array encoding: {encoding}")
+
+
+def resolve_array_references(structure, sidecar_directory: str = "."):
+    """
+    Replace encoded and referenced arrays in a loaded JSON structure with plain values
+    """
+    sidecars = {}
+
+    def _resolve(node):
+        if isinstance(node, list):
+            return [_resolve(item) for item in node]
+        if not isinstance(node, dict):
+            return node
+        if node.get("encoding") == INLINE_ENCODING:
+            return np.load(BytesIO(zlib.decompress(base64.b64decode(node["data"])))).tolist()
+        if "$ref" in node:
+            sidecar_name, dataset_path = node["$ref"].split("#", 1)
+            if sidecar_name not in sidecars:
+                sidecars[sidecar_name] = np.load(os.path.join(sidecar_directory, sidecar_name))
+            return sidecars[sidecar_name][dataset_path.lstrip("/")].tolist()
+        return {key: _resolve(value) for key, value in node.items()}
+
+    try:
+        return _resolve(structure)
+    finally:
+        for sidecar in sidecars.values():
+            sidecar.close()
+
+
+class _JsonWriter:
+    def __init__(self, output: TextIO, streams: Dict, links: Dict, indent: int, level: int, array_encoder=None):
+        self._output = output
+        self._streams = streams
+        self._links = links
+        self._indent = indent
+        self._level = level
+        self._array_encoder = array_encoder
+
+    def _newline(self, level: int):
+        if self._indent:
+            self._output.write("\n" + " " * (self._indent * level))
+
+    def _write_object(self, items, level: int):
+        """
+        items is an iterable of (key, callable writing the value at the given level) pairs
+        """
+        self._output.write("{")
+        for item_number, (key, write_value) in enumerate(items):
+            if item_number:
+                self._output.write(",")
+            self._newline(level + 1)
+            self._output.write(f"{json.dumps(key)}: ")
+            write_value(level + 1)
+        self._newline(level)
+        self._output.write("}")
+
+    def _write_list(self, writers, level: int):
+        self._output.write("[")
+        for item_number, write_item in enumerate(writers):
+            if item_number:
+                self._output.write(",")
+            self._newline(level + 1)
+            write_item(level + 1)
+        self._newline(level)
+        self._output.write("]")
+
+    def _write_plain(self, value):
+        def _write(level: int):
+            self._output.write(json.dumps(value))
+
+        return _write
+
+    def _write_nested(self, value):
+        def _write(level: int):
+            text = json.dumps(value, indent=self._indent if self._indent else None)
+            self._output.write(text.replace("\n", "\n" + " " * (self._indent * level)))
+
+        return _write
+
+    def _write_values(self, dataset: h5py.Dataset):
+        def _write(level: int):
+            if dataset.shape == ():
+                self._output.write(json.dumps(_decode(dataset[()])))
+            elif dataset.dtype.kind in ("S", "U", "O"):
+                self._output.write(_compact([_decode(item) for item in dataset[...].flat]))
+            elif dataset.size == 0:
+                self._output.write(_compact(np.empty(dataset.shape).tolist()))
+            elif self._array_encoder is not None and dataset.nbytes >= self._array_encoder.threshold:
+                self._array_encoder.write(dataset, self._output)
+            else:
+                # Read and write the outermost dimension in blocks, so only one block is ever held in memory
+                self._output.write("[")
+                for block_number, block in enumerate(_iterate_blocks(dataset)):
+                    if block_number:
+                        self._output.write(",")
+                    self._output.write(_compact(block.tolist())[1:-1])
+                self._output.write("]")
+
+        return _write
+
+    def _attribute_writers(self, node: h5py.HLObject):
+        attributes = []
+        if "NX_class" in node.attrs:
+            attributes.append({"name": "NX_class", "values": _decode(node.attrs["NX_class"])})
+        for name in node.attrs:
+            if name == "NX_class":
+                continue
+            value = node.attrs[name]
+            attribute = {"name": name}
+            if isinstance(value, np.ndarray):
+                attribute["type"] = _dtype_name(value.dtype)
+                attribute["values"] = [_decode(item) for item in value.tolist()]
+            else:
+                attribute["type"] = (
+                    "string" if isinstance(value, (bytes, str)) else _dtype_name(np.asarray(value).dtype)
+                )
+                attribute["values"] = _decode(value)
+            attributes.append(attribute)
+        return [self._write_nested(attribute) for attribute in attributes]
+
+    def write_node(self, node: h5py.HLObject, level: int):
+        name = node.name.split("/")[-1]
+        attribute_writers = self._attribute_writers(node)
+        if isinstance(node, h5py.Group):
+            items = [("type", self._write_plain("group")), ("name", self._write_plain(name))]
+            if node.name in self._streams:
+                children = [self._write_nested({"type": "stream", "stream": self._streams[node.name]})]
+            elif node.name in self._links:
+                link_name, link_target = self._links[node.name]
+                children = [self._write_nested({"type": "link", "name": link_name, "target": link_target})]
+            else:
+                children = [self._child_writer(child) for child in node.values()]
+            items.append(("children", lambda level: self._write_list(children, level)))
+        else:
+            dataset_info = {"type": _dtype_name(node.dtype)}
+            if node.shape != ():
+                dataset_info["size"] = list(node.shape)
+            items = [
+                ("type", self._write_plain("dataset")),
+                ("name", self._write_plain(name)),
+                ("dataset", self._write_nested(dataset_info)),
+                ("values", self._write_values(node)),
+            ]
+        if attribute_writers:
+            items.append(("attributes", lambda level: self._write_list(attribute_writers, level)))
+        self._write_object(items, level)
+
+    def _child_writer(self, child: h5py.HLObject):
+        return lambda level: self.write_node(child, level)
+
+    def write_structure(self, root: h5py.Group):
+        children = [self._child_writer(child) for child in root.values()]
+        self._write_object([("children", lambda level: self._write_list(children, level))], self._level)
+
+
+def write_nexus_structure(
+    root: h5py.Group,
+    output: TextIO,
+    streams: Optional[Dict] = None,
+    links: Optional[Dict] = None,
+    indent: int = 2,
+    level: int = 0,
+    array_encoder=None,
+):
+    """
+    Write the file-writer nexus_structure JSON for everything below root to the output stream
+
+    :param streams: options for the file-writer stream to put in place of the contents of a group, keyed by group path
+    :param links: (name, target) of a link to put in place of the contents of a group, keyed by group path
+    :param indent: indentation of the output, large arrays are always written on a single line
+    :param level: initial indentation level, for writing the structure nested in another JSON object
+    :param array_encoder: optional encoder for large numeric arrays, see create_array_encoder
+    """
+    _JsonWriter(
+        output, streams if streams else {}, links if links else {}, indent, level, array_encoder
+    ).write_structure(root)
+
+
+def nexus_to_json_file(
+    nexus_filename: str,
+    json_filename: str,
+    streams: Optional[Dict] = None,
+    links: Optional[Dict] = None,
+    array_encoding: str = "json",
+):
+    with h5py.File(nexus_filename, "r") as nexus_file:
+        group_to_json_file(nexus_file, json_filename, streams, links, array_encoding)
+
+
+def group_to_json_file(
+    root: h5py.Group,
+    json_filename: str,
+    streams: Optional[Dict] = None,
+    links: Optional[Dict] = None,
+    array_encoding: str = "json",
+):
+    array_encoder = create_array_encoder(array_encoding, json_filename)
+    with open(json_filename, "w") as json_file:
+        if array_encoder is None:
+            write_nexus_structure(root, json_file, streams, links)
+        else:
+            with array_encoder:
+                write_nexus_structure(root, json_file, streams, links, array_encoder=array_encoder)
+
+
+def write_command_to_json_file(
+    command: Dict,
+    root: h5py.Group,
+    json_filename: str,
+    streams: Optional[Dict] = None,
+    links: Optional[Dict] = None,
+    structure_key: str = "nexus_structure",
+    indent: int = 2,
+    array_encoding: str = "json",
+):
+    """
+    Write a file-writer command to file, streaming the nexus_structure from the NeXus file into it
+
+    :param command: the command, for example from nexusjson's create_writer_commands,
+     whatever value it has for structure_key is replaced
+    :param array_encoding: "json", "base64" or "npz", see create_array_encoder
+    """
+    command = dict(command)
+    command[structure_key] = _PLACEHOLDER
+    before, after = json.dumps(command, indent=indent).split(json.dumps(_PLACEHOLDER))
+    array_encoder = create_array_encoder(array_encoding, json_filename)
+    with open(json_filename, "w") as json_file:
+        json_file.write(before)
+        if array_encoder is None:
+            write_nexus_structure(root, json_file, streams, links, indent=indent, level=1)
+        else:
+            with array_encoder:
+                write_nexus_structure(
+                    root, json_file, streams, links, indent=indent, level=1, array_encoder=array_encoder
+                )
+        json_file.write(after)
@@ -0,0 +1,66 @@
+"""
+Stream definitions for file-writer commands, loaded from a table instead of being hardcoded
+
+Each row of the table is one stream, with the columns:
+path, topic, source, module and optionally type (the value type for f142 streams).
+Tables can be .csv files with a header row, or .json files containing a list of objects with those keys.
+"""
+
+import csv
+import json
+from typing import Dict, List, Set
+
+import h5py
+
+STREAM_COLUMNS = ["path", "topic", "source", "module", "type"]
+
+
+def load_stream_table(table_filename: str) -> List[Dict[str, str]]:
+    """
+    :return: list of rows, with type set to None where it is not given
+    """
+    if table_filename.endswith(".csv"):
+        with open(table_filename, "r", newline="") as table_file:
+            rows = list(csv.DictReader(table_file))
+    elif table_filename.endswith(".json"):
+        with open(table_filename, "r") as table_file:
+            rows = json.load(table_file)
+    else:
+        raise ValueError(f"Stream table must have a .csv or .json extension: {table_filename}")
+
+    streams = []
+    paths = set()
+    for row_number, row in enumerate(rows, start=1):
+        missing = [column for column in STREAM_COLUMNS[:-1] if not row.get(column)]
+        if missing:
+            raise ValueError(f"Row {row_number} of {table_filename} is missing {', '.join(missing)}")
+        if row["path"] in paths:
+            raise ValueError(f"Row {row_number} of {table_filename} repeats the path {row['path']}")
+        paths.add(row["path"])
+        stream = {column: row.get(column) for column in STREAM_COLUMNS}
+        if not stream["type"]:
+            stream["type"] = None
+        streams.append(stream)
+    return streams
+
+
+def group_paths(root: h5py.Group) -> Set[str]:
+    """
+    Absolute paths of all groups in the file, collected in one pass
+    """
+    paths = {root.name}
+
+    def _visit(name, node):
+        if isinstance(node, h5py.Group):
+            paths.add(node.name)
+
+    root.visititems(_visit)
+    return paths
+
+
+def find_unresolved_streams(root: h5py.Group, streams: Dict[str, Dict]) -> List[str]:
+    """
+    Stream paths which do not match a group in the file, these would be silently left out of the command
+    """
+    paths = group_paths(root)
+    return sorted(path for path in streams if path not in paths)
@@ -0,0 +1,250 @@
+"""
+Synthetic neutron event data at ESS-scale rates, for benchmarking NeXus readers and writers
+and load testing the file-writer
+
+Events are generated per pulse, with a Poisson distributed number of events per pulse for
+the requested event rate, detector ids drawn uniformly from a detector's detector_number
+and time-of-flight from a Maxwellian wavelength spectrum over the source-detector flight path,
+smeared by the ESS pulse length and wrapped into the pulse period.
+
+Write 10 seconds of 10^7 events/s for a detector in an existing file:
+python syntheticevents.py --detector-file V20_example.nxs --detector-path /entry/instrument/detector_1
+    --rate 1e7 --duration 10 --output events.nxs
+Stream at real speed to a broker:
+python syntheticevents.py --n-pixels 100000 --rate 1e6 --duration 60 --stream --broker localhost:9092
+"""
+
+import argparse
+import time
+from typing import Iterator, Optional, Tuple
+
+import h5py
+import numpy as np
+from streaming_data_types.eventdata_ev42 import serialise_ev42
+
+from examples.common.nexusreplay import KafkaSink, MemorySink, Message, replay
+
+PULSE_FREQUENCY = 14.0  # Hz
+PULSE_LENGTH = 2.86e-3  # s
+# Neutron time of flight per metre per Angstrom of wavelength, in seconds
+TOF_PER_METRE_ANGSTROM = 1.0 / 3956.034
+# Number of events between entries in the cue index
+CUE_INTERVAL = 1000000
+# Approximate number of events generated at a time
+BLOCK_EVENTS = 10000000
+
+
+class SyntheticEventGenerator:
+    def __init__(
+        self,
+        detector_ids: np.ndarray,
+        event_rate: float,
+        flight_path: float = 30.0,
+        peak_wavelength: float = 2.0,
+        pulse_frequency: float = PULSE_FREQUENCY,
+        start_time_ns: Optional[int] = None,
+        seed: Optional[int] = None,
+    ):
+        """
+        :param detector_ids: detector_number values events are assigned to
+        :param event_rate: mean number of events per second
+        :param flight_path: source to detector distance in metres
+        :param peak_wavelength: peak of the Maxwellian wavelength spectrum in Angstrom
+        :param start_time_ns: time of the first pulse in ns since the unix epoch, defaults to now
+        """
+        self._detector_ids = np.asarray(detector_ids, dtype=np.uint32).ravel()
+        self._pulse_period = 1.0 / pulse_frequency
+        self._events_per_pulse = event_rate / pulse_frequency
+        self._flight_path = flight_path
+        # Maxwellian in wavelength peaks at sqrt(2/5) of this scale
+        self._wavelength_scale = peak_wavelength / np.sqrt(0.4)
+        self._start_time_ns = time.time_ns() if start_time_ns is None else start_time_ns
+        self._rng = np.random.default_rng(seed)
+        self._next_pulse = 0
+
+    @property
+    def pulse_period(self) -> float:
+        return self._pulse_period
+
+    @property
+    def events_per_pulse(self) -> float:
+        return self._events_per_pulse
+
+    def _time_of_flight(self, n_events: int) -> np.ndarray:
+        # Maxwellian flux, proportional to exp(-a/lambda^2)/lambda^5, so a/lambda^2 is gamma distributed with shape 2
+        wavelength = self._wavelength_scale / np.sqrt(self._rng.gamma(2.0, 1.0, n_events))
+        tof = self._flight_path * TOF_PER_METRE_ANGSTROM * wavelength
+        tof += self._rng.uniform(0.0, PULSE_LENGTH, n_events)
+        # Slow neutrons arrive in a later frame, relative to the pulse they are recorded against
+        return (np.mod(tof, self._pulse_period) * 1e9).astype(np.uint32)
+
+    def generate(self, n_pulses: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Events for the next n_pulses pulses
+
+        :return: event_time_zero (ns since epoch), event_index, event_id and event_time_offset (ns),
+          event_index is relative to the first event of this block
+        """
+        pulse_numbers = np.arange(self._next_pulse, self._next_pulse + n_pulses, dtype=np.uint64)
+        self._next_pulse += n_pulses
+        event_time_zero = np.uint64(self._start_time_ns) + np.round(
+            pulse_numbers * (self._pulse_period * 1e9)
+        ).astype(np.uint64)
+        counts = self._rng.poisson(self._events_per_pulse, n_pulses)
+        event_index = np.zeros(n_pulses, dtype=np.uint64)
+        np.cumsum(counts[:-1], out=event_index[1:])
+        n_events = int(counts.sum())
+        event_id = self._detector_ids[self._rng.integers(0, self._detector_ids.size, n_events)]
+        event_time_offset = self._time_of_flight(n_events)
+        return event_time_zero, event_index, event_id, event_time_offset
+
+    def blocks(self, n_pulses: int, block_pulses: int) -> Iterator[Tuple[np.ndarray, ...]]:
+        for block_start in range(0, n_pulses, block_pulses):
+            yield self.generate(min(block_pulses, n_pulses - block_start))
+
+    def messages(
+        self, n_pulses: int, topic: str, source_name: str, block_pulses: int = 14
+    ) -> Iterator[Message]:
+        """
+        One ev42 message per pulse, to send with nexusreplay.replay
+        """
+        message_id = 0
+        for event_time_zero, event_index, event_id, event_time_offset in self.blocks(n_pulses, block_pulses):
+            boundaries = np.append(event_index, event_id.size)
+            for pulse in range(event_time_zero.size):
+                events = slice(int(boundaries[pulse]), int(boundaries[pulse + 1]))
+                pulse_time = int(event_time_zero[pulse])
+                yield pulse_time, topic, serialise_ev42(
+                    source_name, message_id, pulse_time, event_time_offset[events], event_id[events]
+                )
+                message_id += 1
+
+
+def read_detector_ids(filename: str, detector_path: str) -> np.ndarray:
+    with h5py.File(filename, "r") as nexus_file:
+        return nexus_file[detector_path]["detector_number"][...].ravel()
+
+
+def _require_group(parent: h5py.Group, path: str, nx_class: str) -> h5py.Group:
+    group = parent.require_group(path)
+    if "NX_class" not in group.attrs:
+        group.attrs.create("NX_class", np.array(nx_class).astype("|S" + str(len(nx_class))))
+    return group
+
+
+def write_event_data(
+    group: h5py.Group,
+    generator: SyntheticEventGenerator,
+    n_pulses: int,
+    block_pulses: Optional[int] = None,
+    compression: Optional[str] = None,
+) -> int:
+    """
+    Append generated events to chunked NXevent_data datasets in the group, block by block,
+    with cue_index and cue_timestamp_zero entries every CUE_INTERVAL events
+
+    :return: number of events written
+    """
+    if block_pulses is None:
+        block_pulses = max(int(BLOCK_EVENTS / max(generator.events_per_pulse, 1.0)), 1)
+    group.attrs.create("NX_class", np.array("NXevent_data").astype("|S12"))
+    pulse_chunk = min(block_pulses, 1 << 16)
+    event_chunk = min(max(int(generator.events_per_pulse * block_pulses), 1024), 1 << 20)
+
+    def _create(name, dtype, chunk, units=None):
+        dataset = group.create_dataset(
+            name, (0,), maxshape=(None,), dtype=dtype, chunks=(chunk,), compression=compression
+        )
+        if units is not None:
+            dataset.attrs.create("units", np.array(units).astype("|S" + str(len(units))))
+        return dataset
+
+    event_time_zero_ds = _create("event_time_zero", np.uint64, pulse_chunk, "ns")
+    event_time_zero_ds.attrs.create("offset", np.array("1970-01-01T00:00:00").astype("|S19"))
+    event_index_ds = _create("event_index", np.uint64, pulse_chunk)
+    event_id_ds = _create("event_id", np.uint32, event_chunk)
+    event_time_offset_ds = _create("event_time_offset", np.uint32, event_chunk, "ns")
+    cue_index_ds = _create("cue_index", np.uint64, 1024)
+    cue_timestamp_zero_ds = _create("cue_timestamp_zero", np.uint64, 1024, "ns")
+
+    def _append(dataset, data):
+        start = dataset.shape[0]
+        dataset.resize((start + data.size,))
+        dataset[start:] = data
+
+    n_events = 0
+    for event_time_zero, event_index, event_id, event_time_offset in generator.blocks(n_pulses, block_pulses):
+        event_index = event_index + np.uint64(n_events)
+        _append(event_time_zero_ds, event_time_zero)
+        _append(event_index_ds, event_index)
+        _append(event_id_ds, event_id)
+        _append(event_time_offset_ds, event_time_offset)
+        # Like the file-writer, cue at the end of the first pulse to pass each multiple of CUE_INTERVAL events
+        pulse_ends = np.append(event_index[1:], np.uint64(n_events + event_id.size))
+        cue_numbers = pulse_ends // CUE_INTERVAL
+        new_cues = np.diff(cue_numbers, prepend=np.uint64(n_events // CUE_INTERVAL)) > 0
+        if np.any(new_cues):
+            _append(cue_index_ds, pulse_ends[new_cues] - np.uint64(1))
+            _append(cue_timestamp_zero_ds, event_time_zero[new_cues])
+        n_events += event_id.size
+    return n_events
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--detector-file", type=str, help="NeXus file to read detector_number from")
+    parser.add_argument("--detector-path", type=str, default="/entry/instrument/detector_1",
+                        help="Detector group in --detector-file")
+    parser.add_argument("--n-pixels", type=int, default=100000,
+                        help="Use detector ids 1 to n-pixels if no --detector-file is given")
+    parser.add_argument("--rate", type=float, default=1e7, help="Events per second")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds of data to generate")
+    parser.add_argument("--flight-path", type=float, default=30.0, help="Source to detector distance in metres")
+    parser.add_argument("--peak-wavelength", type=float, default=2.0, help="Peak of the spectrum in Angstrom")
+    parser.add_argument("--seed", type=int, help="Random number generator seed")
+    parser.add_argument("--output", type=str, help="File to write the NXevent_data to, it is appended to if it exists")
+    parser.add_argument("--event-path", type=str, default="/entry/instrument/detector_1/events",
+                        help="NXevent_data group to create in --output")
+    parser.add_argument("--compression", choices=["none", "gzip", "lzf"], default="none")
+    parser.add_argument("--stream", action="store_true", help="Send ev42 messages instead of writing a file")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="Speed relative to real time when streaming, 0 for as fast as possible")
+    parser.add_argument("--broker", type=str, default="localhost:9092")
+    parser.add_argument("--topic", type=str, default="synthetic_events")
+    parser.add_argument("--source-name", type=str, default="synthetic_detector")
+    parser.add_argument("--fake-broker", action="store_true", help="Only count messages, do not connect to Kafka")
+    args = parser.parse_args()
+
+    if args.detector_file:
+        detector_ids = read_detector_ids(args.detector_file, args.detector_path)
+    else:
+        detector_ids = np.arange(1, args.n_pixels + 1)
+    generator = SyntheticEventGenerator(
+        detector_ids, args.rate, args.flight_path, args.peak_wavelength, seed=args.seed
+    )
+    n_pulses = int(np.ceil(args.duration * PULSE_FREQUENCY))
+
+    start = time.perf_counter()
+    if args.stream:
+        sink = MemorySink(keep_messages=False) if args.fake_broker else KafkaSink(args.broker)
+        count, n_bytes, _ = replay(generator.messages(n_pulses, args.topic, args.source_name), sink, args.speed)
+        sink.close()
+        summary = f"Sent {count} messages ({n_bytes / 1e6:.1f} MB)"
+    elif args.output:
+        with h5py.File(args.output, "a") as output_file:
+            parent_path, group_name = args.event_path.rstrip("/").rsplit("/", 1)
+            parent = output_file
+            nx_classes = ["NXentry", "NXinstrument", "NXdetector"]
+            for level, name in enumerate(parent_path.strip("/").split("/")):
+                parent = _require_group(parent, name, nx_classes[level] if level < len(nx_classes) else "NXcollection")
+            n_events = write_event_data(
+                parent.create_group(group_name),
+                generator,
+                n_pulses,
+                compression=None if args.compression == "none" else args.compression,
+            )
+        summary = f"Wrote {n_events} events to {args.output}{args.event_path}"
+    else:
+        parser.error("Give --output or --stream")
+    duration = time.perf_counter() - start
+    print(f"{summary} for {n_pulses} pulses in {duration:.1f} s")
@@ -1,3 +1,4 @@
+import argparse
 from concurrent.futures import ProcessPoolExecutor
 from functools import partial
 from typing import Dict, Tuple
@@ -6,6 +7,7 @@ import numpy as np
 import pandas as pd  # type:ignore
 from alive_progress import alive_bar
 
+from examples.common.instrumentation import instrumented
 from utils import write_to_nexus_file, write_to_off_file
 
 """
@@ -177,6 +179,7 @@ sumo_number_to_translation: Dict[int, np.ndarray] = {
 }
 
 
+@instrumented
 def create_voxelids_and_faces(geant_df: pd.DataFrame, max_face_index: int, max_vertex_index: int):
     number_of_voxels = len(geant_df.index)
     vertices_in_voxel = 8
@@ -204,6 +207,7 @@ def create_voxelids_and_faces(geant_df: pd.DataFrame, max_face_index: int, max_v
     return faces, voxel_ids
 
 
+@instrumented
 def create_sector(geant_df: pd.DataFrame, z_rotation_angle: float):
     number_of_voxels = len(geant_df.index)
     vertices_in_voxel = 8
@@ -289,28 +293,36 @@ def create_sector(geant_df: pd.DataFrame, z_rotation_angle: float):
     )
 
 
-if __name__ == "__main__":
-    df = pd.read_csv(
-        "LookupTableDreamEndCap_noRRT.txt", delim_whitespace=True, header=None
-    )
-    df.columns = [
-        "sumo",
-        "sect-seg",
-        "strip",
-        "wire",
-        "counter",
-        "x_centre",
-        "y_centre",
-        "z_centre",
-        "x1",
-        "x2",
-        "y1",
-        "y2",
-        "z",
-    ]
+GEANT_COLUMNS = [
+    "sumo",
+    "sect-seg",
+    "strip",
+    "wire",
+    "counter",
+    "x_centre",
+    "y_centre",
+    "z_centre",
+    "x1",
+    "x2",
+    "y1",
+    "y2",
+    "z",
+]
 
-    faces_in_voxel = 6
 
+def load_geant_lookup_table(filename: str) -> pd.DataFrame:
+    df = pd.read_csv(filename, delim_whitespace=True, header=None)
+    df.columns = GEANT_COLUMNS
+    return df
+
+
+@instrumented
+def create_endcap(geant_df: pd.DataFrame, n_sectors: int, max_workers: int = 12):
+    """
+    Creates the voxel mesh of n_sectors sectors spread around the beam axis
+
+    :return: vertices, faces, voxel ids of each face and x, y, z voxel centre offsets
+    """
     total_vertices = None
     total_faces = None
     total_ids = None
@@ -321,13 +333,12 @@ if __name__ == "__main__":
     max_face_index = 0
 
     # TODO start and stop angle are inferred from diagrams, need to check
-    n_sectors = 23
     z_rotation_angles_degrees = np.linspace(-138.0, 138.0, num=n_sectors)
 
-    _create_sector = partial(create_sector, df)
-    _create_voxelids_and_faces = partial(create_voxelids_and_faces, df)
+    _create_sector = partial(create_sector, geant_df)
+    _create_voxelids_and_faces = partial(create_voxelids_and_faces, geant_df)
 
-    with ProcessPoolExecutor(max_workers=12) as executor:
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
         with alive_bar(
             len(z_rotation_angles_degrees), bar="blocks", spinner="triangles"
         ) as bar:
@@ -357,6 +368,33 @@ if __name__ == "__main__":
                 max_face_index = total_ids.shape[0]
                 bar()
 
+    return (
+        total_vertices,
+        total_faces,
+        total_ids,
+        x_offsets_total,
+        y_offsets_total,
+        z_offsets_total,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--sectors", type=int, default=23, help="Number of sectors")
+    parser.add_argument("--workers", type=int, default=12, help="Number of processes creating sectors")
+    args = parser.parse_args()
+
+    df = load_geant_lookup_table("LookupTableDreamEndCap_noRRT.txt")
+    n_sectors = args.sectors
+    (
+        total_vertices,
+        total_faces,
+        total_ids,
+        x_offsets_total,
+        y_offsets_total,
+        z_offsets_total,
+    ) = create_endcap(df, n_sectors, args.workers)
+
     write_to_off_file(
         f"DREAM_endcap_{n_sectors}_sectors.off",
         total_vertices.shape[0],
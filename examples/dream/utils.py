@@ -4,7 +4,10 @@ import numpy as np
 import pandas as pd  # type: ignore
 from nexusutils.nexusbuilder import NexusBuilder  # type: ignore
 
+from examples.common.instrumentation import instrumented
 
+
+@instrumented(hdf5_argument="filename")
 def write_to_nexus_file(
     filename: str,
     vertices: np.ndarray,
@@ -70,6 +73,7 @@ def write_to_nexus_file(
         builder.get_root()["start_time"] = datetime.datetime.now().isoformat()
 
 
+@instrumented
 def write_to_off_file(
     filename: str,
     number_of_vertices: int,
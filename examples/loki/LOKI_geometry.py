@@ -9,6 +9,7 @@ import random
 from enum import Enum
 from typing import Dict, List, Optional
 from nurf_data import load_one_spectro_file, nurf_file_creator
+from examples.common.instrumentation import instrumented
 IMPORT_LARMOR = True  # Change depending on what data set should be used.
 DEBUG_LARMOR_DET = False  #
 if IMPORT_LARMOR:
@@ -693,6 +694,7 @@ class Bank:
                 xyz_offsets.append(xyz_offset)
         return xyz_offsets
 
+    @instrumented
     def build_detector_bank(self):
         tube_point_offsets = self._get_tube_point_offsets()
         self._detector_tube.set_xyz_offsets(tube_point_offsets)
@@ -761,6 +763,7 @@ class Bank:
     def compound_data_in_list(self) -> List:
         return self._detector_tube.compound_data_in_list()
 
+    @instrumented
     def compound_detector_geometry(self, transform_path='',
                                    transform_as_nxlog=False):
         """
@@ -982,6 +985,7 @@ class NexusFileBuilder:
             filename = '.'.join([filename, file_format])
         self.hf5_file = h5py.File(filename, 'w')
 
+    @instrumented
     def construct_nxs_file(self):
         self._construct_nxs_file(self.data_struct, self.hf5_file)
         self.hf5_file.close()
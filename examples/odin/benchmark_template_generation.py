@@ -0,0 +1,147 @@
+import argparse
+import sys
+import time
+
+from examples.odin.generate_nxApplication_template import \
+    FileWriterNexusConfigCreator, ATTRIBUTES, CHILDREN, DATA_TYPE, GROUP, \
+    LINK, NAME, NX_CLASS, TYPE, VALUES
+
+"""
+Times FileWriterNexusConfigCreator on synthetic application definitions,
+in the xmltodict-shaped form NxApplicationXMLToJson passes to it, and compares
+the output and time with a compact equivalent of the previous recursive
+implementation.
+
+wide: every group has --fan-out child groups
+deep: a chain of groups, each with one extra leaf group
+"""
+
+DEVICE_CLASSES = ['NXsample', 'NXmonitor', 'NXdata', 'NXsource',
+                  'NXdetector', 'NXpositioner']
+
+
+def create_definition(n_nodes, shape='wide', fan_out=4):
+    """
+    ::return:: the definition's top level group and a device configuration
+    with a stream for every named group.
+    """
+    configuration = {}
+    created = 0
+
+    def _new_group():
+        nonlocal created
+        created += 1
+        name = f'group_{created}'
+        configuration[name] = [{
+            'module': 'f142', 'topic': 'odin_topic', 'source': name,
+            'dtype': 'double', 'value_units': 'mm', 'array_size': None,
+            'data_name': None, 'kind': 'group', 'static_value': None,
+        }]
+        return {'@type': DEVICE_CLASSES[created % len(DEVICE_CLASSES)]
+                if created % 3 == 0 else 'NXcollection', '@name': name}
+
+    root = _new_group()
+    root['@type'] = 'NXentry'
+    parents = [root]
+    while created < n_nodes:
+        parent = parents.pop(0) if shape == 'wide' else parents.pop()
+        # The converter expects repeated child groups as a list, like xmltodict
+        children = [_new_group() for _ in range(fan_out if shape == 'wide'
+                                                else 2)]
+        parent['group'] = children
+        parents.extend(children if shape == 'wide' else children[-1:])
+    return root, configuration
+
+
+def recursive_edit_dict_key_value_pair(creator, sub_dict, parent=None):
+    """
+    Equivalent of the previous, recursive, implementation of
+    FileWriterNexusConfigCreator.edit_dict_key_value_pair, for comparison.
+    """
+    data = {}
+    for key in sub_dict:
+        if key in creator.translator:
+            new_key, class_type = creator.translator[key]
+            if new_key == CHILDREN:
+                data[CHILDREN] = [recursive_edit_dict_key_value_pair(
+                    creator, item, CHILDREN) for item in sub_dict[key]]
+            elif new_key == LINK:
+                data[CHILDREN] = [creator.get_link(item)
+                                  for item in sub_dict[key]]
+            else:
+                data[new_key] = creator.nxs_config_object_factory(
+                    class_type, sub_dict[key])
+    if TYPE in data and data[TYPE] in creator.nexus_instance_name:
+        data[NAME] = creator.nexus_instance_name[data[TYPE]]
+        data[ATTRIBUTES] = [{NAME: NX_CLASS, DATA_TYPE: 'string',
+                             VALUES: data[TYPE]}]
+        data[TYPE] = GROUP
+    if parent is not LINK:
+        data.setdefault(CHILDREN, []).extend(
+            creator.get_stream_information(data[NAME]))
+    return data
+
+
+def _same_tree(first, second):
+    """
+    Compares nested dictionaries and lists without recursion, as the trees
+    can be deeper than the recursion limit.
+    """
+    stack = [(first, second)]
+    while stack:
+        first, second = stack.pop()
+        if isinstance(first, dict) and isinstance(second, dict):
+            if list(first) != list(second):
+                return False
+            stack.extend((first[key], second[key]) for key in first)
+        elif isinstance(first, list) and isinstance(second, list):
+            if len(first) != len(second):
+                return False
+            stack.extend(zip(first, second))
+        elif first != second:
+            return False
+    return True
+
+
+def _time(function, repeats):
+    best = float('inf')
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--nodes', type=int, default=10000,
+                        help='Number of groups in the synthetic definition')
+    parser.add_argument('--shape', choices=['wide', 'deep'], default='wide')
+    parser.add_argument('--fan-out', type=int, default=4,
+                        help='Child groups per group for the wide shape')
+    parser.add_argument('--repeats', type=int, default=5,
+                        help='Best time of this many runs is reported')
+    args = parser.parse_args()
+
+    definition, configuration = create_definition(args.nodes, args.shape,
+                                                  args.fan_out)
+    creator = FileWriterNexusConfigCreator(definition, None,
+                                           configuration=configuration)
+
+    iterative_time, iterative_result = _time(
+        lambda: creator.edit_dict_key_value_pair(definition), args.repeats)
+    print(f'{args.shape} definition with {args.nodes} groups')
+    print(f'iterative: {iterative_time * 1000:.1f} ms')
+    try:
+        recursive_time, recursive_result = _time(
+            lambda: recursive_edit_dict_key_value_pair(creator, definition),
+            args.repeats)
+    except RecursionError:
+        print(f'recursive: exceeded the recursion limit '
+              f'({sys.getrecursionlimit()})')
+    else:
+        print(f'recursive: {recursive_time * 1000:.1f} ms')
+        same = _same_tree(iterative_result, recursive_result)
+        print(f'identical output: {same}')
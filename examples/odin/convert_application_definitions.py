@@ -0,0 +1,104 @@
+import argparse
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from glob import glob
+from os import cpu_count, makedirs, path
+
+from examples.odin.generate_nxApplication_template import \
+    DeviceConfigurationFromXLS, NxApplicationXMLToJson
+
+"""
+Converts every NXDL application definition in a directory, for example
+applications/ from https://github.com/nexusformat/definitions, to a file writer
+template JSON file, in parallel.
+
+The device configuration is parsed once and shared with all the conversions.
+
+python convert_application_definitions.py -d definitions/applications -c config.xlsx -o templates
+"""
+
+# Device configuration shared by the conversions in a worker process
+_configuration = None
+
+
+def _init_worker(configuration):
+    global _configuration
+    _configuration = configuration
+
+
+def convert_definition(xml_path, output_dir, xls_path):
+    """
+    Converts one application definition to output_dir/<definition name>.json.
+
+    ::return:: dictionary with the name, duration and error (None on success)
+    of the conversion.
+    """
+    start = time.perf_counter()
+    name = path.basename(xml_path).split('.')[0]
+    error = None
+    try:
+        converter = NxApplicationXMLToJson(xml_path, xls_path,
+                                           configuration=_configuration)
+        if converter.xml_to_json():
+            converter.save_json_file(path.join(output_dir, f'{name}.json'))
+        else:
+            error = 'failed to parse XML'
+    except Exception as e:
+        # Report the failure and carry on with the other definitions
+        error = f'{type(e).__name__}: {e}'
+    return {'name': name,
+            'duration': time.perf_counter() - start,
+            'error': error}
+
+
+def print_summary(results, wall_time):
+    failures = [result for result in results if result['error'] is not None]
+    for result in sorted(results, key=lambda result: result['duration'],
+                         reverse=True):
+        status = 'OK' if result['error'] is None else 'FAILED'
+        print(f'{result["name"]:<30} {result["duration"]:8.3f} s  {status}')
+    print(f'Converted {len(results) - len(failures)} of {len(results)} '
+          f'definitions in {wall_time:.3f} s')
+    for result in failures:
+        print(f'{result["name"]} failed: {result["error"]}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-d', '--definitions-dir', type=str, required=True,
+                        help='Directory of NXDL application definitions '
+                             '(*.nxdl.xml or *.xml)')
+    parser.add_argument('-c', '--config', type=str, required=True,
+                        help='Device configuration file (.xlsx, .csv or '
+                             '.parquet)')
+    parser.add_argument('-o', '--output-dir', type=str, default='templates',
+                        help='Directory to write the template JSON files to')
+    parser.add_argument('--workers', type=int, default=cpu_count(),
+                        help='Number of definitions to convert in parallel')
+    args = parser.parse_args()
+
+    xml_paths = sorted(glob(path.join(args.definitions_dir, '*.xml')))
+    if not xml_paths:
+        sys.exit(f'No XML files found in {args.definitions_dir}')
+    makedirs(args.output_dir, exist_ok=True)
+
+    start_time = time.perf_counter()
+    configuration = DeviceConfigurationFromXLS(args.config).\
+        get_configuration_as_dict()
+    convert = partial(convert_definition, output_dir=args.output_dir,
+                      xls_path=args.config)
+    if args.workers == 1:
+        _init_worker(configuration)
+        results = [convert(xml_path) for xml_path in xml_paths]
+    else:
+        with ProcessPoolExecutor(max_workers=args.workers,
+                                 initializer=_init_worker,
+                                 initargs=(configuration,)) as executor:
+            results = list(executor.map(convert, xml_paths))
+
+    print_summary(results, time.perf_counter() - start_time)
+    if any(result['error'] is not None for result in results):
+        sys.exit(1)
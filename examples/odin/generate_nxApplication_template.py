@@ -1,10 +1,12 @@
+import hashlib
 import json
+import os
+import pickle
 import pandas as pd
-import xmltodict
 from enum import Enum
+from io import BytesIO
 from os import path
 from lxml import etree
-from xml.parsers.expat import ExpatError
 
 ARRAY_SIZE = 'array_size'
 ATTRIBUTES = 'attributes'
@@ -31,6 +33,8 @@ VALUES = 'values'
 VALUE_UNITS = 'value_units'
 WRITER_MODULE = 'module'
 
+CONFIGURATION_CACHE_DIR = '.configuration_cache'
+
 
 class DeviceConfigurationFromXLS:
 
@@ -38,18 +42,65 @@ class DeviceConfigurationFromXLS:
                        DATA_TYPE, VALUE_UNITS, ARRAY_SIZE, CUSTOM_FIELD,
                        STATIC_VALUE]
 
-    def __init__(self, file_path):
+    readers = {'.xlsx': pd.read_excel,
+               '.xls': pd.read_excel,
+               '.csv': pd.read_csv,
+               '.parquet': pd.read_parquet}
+
+    def __init__(self, file_path, cache_dir=None, use_cache=True):
+        """
+        ::param file_path:: configuration file, .xlsx, .csv or .parquet.
+        ::param cache_dir:: directory for the parsed configuration cache,
+        defaults to .configuration_cache next to the configuration file.
+        ::param use_cache:: always parse the file if False.
+        """
+        if cache_dir is None:
+            cache_dir = path.join(path.dirname(path.abspath(file_path)),
+                                  CONFIGURATION_CACHE_DIR)
+        self._cache_dir = cache_dir
+        self._use_cache = use_cache
         self._load_configuration_file(file_path)
 
     def _load_configuration_file(self, file_path):
         """
-        Loads excel configuration file to get device data stream information.
+        Loads configuration file to get device data stream information.
+        The parsed content is cached against a hash of the file content, so
+        the file is only parsed again when it has been edited.
         """
         try:
-            self.configuration = pd.read_excel(file_path)
+            with open(file_path, 'rb') as config_file:
+                content = config_file.read()
         except FileNotFoundError as err:
             self.configuration = None
             print(err)
+            return
+        extension = path.splitext(file_path)[1].lower()
+        if extension not in self.readers:
+            raise ValueError(f'Unsupported configuration file type: '
+                             f'{extension}')
+
+        cache_path = None
+        if self._use_cache:
+            digest = hashlib.sha256(content)
+            digest.update(f'{extension}{pd.__version__}'.encode())
+            cache_path = path.join(self._cache_dir,
+                                   f'{digest.hexdigest()}.pkl')
+            if path.isfile(cache_path):
+                try:
+                    self.configuration = pd.read_pickle(cache_path)
+                    # Caches written before empty cells were replaced
+                    self._replace_nans()
+                    return
+                except (OSError, EOFError, pickle.UnpicklingError):
+                    pass
+
+        self.configuration = self.readers[extension](BytesIO(content))
+        self._replace_nans()
+        if cache_path is not None:
+            os.makedirs(self._cache_dir, exist_ok=True)
+            tmp_path = f'{cache_path}.tmp'
+            self.configuration.to_pickle(tmp_path)
+            os.replace(tmp_path, cache_path)
 
     def get_configuration_as_dict(self):
         """
@@ -77,24 +128,18 @@ class DeviceConfigurationFromXLS:
         ::return:: returns the processed configuration data in a structured
         dictionary.
         """
-        data = self.configuration
+        records = self.configuration[self.list_excel_cols].to_dict('records')
         config_dict = {}
-        for idx, name in enumerate(data[NAME]):
-            tmp_dict = {}
-            for key in self.list_excel_cols:
-                tmp_dict[key] = data[key][idx]
-            if name in config_dict:
-                config_dict[name].append(tmp_dict)
-            else:
-                config_dict.update({name: [tmp_dict]})
+        for record in records:
+            config_dict.setdefault(record[NAME], []).append(record)
         return config_dict
 
     def _replace_nans(self):
-        for key in self.configuration:
-            for idx, item in enumerate(self.configuration[key]):
-                item = str(item)
-                if 'nan' in item or 'NaN' in item:
-                    self.configuration[key][idx] = None
+        """
+        Replaces empty (NaN) cells with None.
+        """
+        self.configuration = self.configuration.astype(object).where(
+            self.configuration.notna(), None)
 
 
 class FileWriterNexusConfigCreator:
@@ -115,11 +160,18 @@ class FileWriterNexusConfigCreator:
                            'NXdata': 'data',
                            'NXsource': 'source'}
 
-    def __init__(self, nxs_definition_xml, xls_path):
+    def __init__(self, nxs_definition_xml, xls_path, configuration=None):
+        """
+        ::param configuration:: device configuration dictionary already
+        loaded from xls_path, to share it between several definitions.
+        """
         self._nxs_definition_xml = nxs_definition_xml
         self.translator = self.get_translation()
-        self.configuration = DeviceConfigurationFromXLS(xls_path).\
-            get_configuration_as_dict()
+        if configuration is None:
+            configuration = DeviceConfigurationFromXLS(xls_path).\
+                get_configuration_as_dict()
+        self.configuration = configuration
+        self._stream_information = self._compile_stream_information()
         self._data = {}
         self._data_fields = None
 
@@ -164,40 +216,55 @@ class FileWriterNexusConfigCreator:
         """
         Edits XML key-value pair to comply with expected format for
         file writer nexus configuration file.
+        The tree is walked with an explicit stack rather than recursion, so
+        deep definitions cannot exceed the recursion limit. Each children
+        list is allocated once at its final size and filled in as the
+        children are taken off the stack.
 
         ::return:: returns modified sub dictionary.
         """
-        data = {}
-        for key in sub_dict:
-            if key in self.translator:
-                new_key = self.translator[key][0]
-                class_type = self.translator[key][1]
-                data[new_key] = self.nxs_config_object_factory(class_type,
-                                                               sub_dict[key])
+        translator = self.translator
+        get_stream_information = self.get_stream_information
+        result = [None]
+        stack = [(sub_dict, parent, result, 0)]
+        while stack:
+            node, node_parent, siblings, index = stack.pop()
+            data = {}
+            siblings[index] = data
+            for key in node:
+                if key not in translator:
+                    continue
+                new_key, class_type = translator[key]
+                items = node[key]
+                if isinstance(items, dict):
+                    # A single child element is a dictionary rather than a
+                    # list of one
+                    items = [items]
                 if new_key == CHILDREN:
-                    tmp_list = []
-                    for item in sub_dict[key]:
-                        tmp_list.append(self.edit_dict_key_value_pair(item,
-                                                                      new_key))
-                    data[new_key] = tmp_list
+                    children = [None] * len(items)
+                    data[CHILDREN] = children
+                    stack.extend((item, CHILDREN, children, item_index)
+                                 for item_index, item in enumerate(items))
                 elif new_key == LINK:
-                    tmp_list = []
-                    for item in sub_dict[key]:
-                        tmp_list.append(self.get_link(item))
-                    data[CHILDREN] = tmp_list
-                    del data[LINK]
-        if TYPE in data and data[TYPE] in self.nexus_instance_name:
-            data[NAME] = self.nexus_instance_name[data[TYPE]]
-            data[ATTRIBUTES] = [{NAME: NX_CLASS,
-                                 DATA_TYPE: 'string',
-                                 VALUES: data[TYPE]}]
-            data[TYPE] = GROUP
-        if CHILDREN not in data and parent is not LINK:
-            data[CHILDREN] = self.get_stream_information(data[NAME])
-        elif parent is not LINK:
-            for item in self.get_stream_information(data[NAME]):
-                data[CHILDREN].append(item)
-        return data
+                    data[CHILDREN] = [self.get_link(item) for item in items]
+                elif class_type == self.ClassTypes.RAW:
+                    data[new_key] = node[key]
+                else:
+                    data[new_key] = self.nxs_config_object_factory(class_type,
+                                                                   node[key])
+            if TYPE in data and data[TYPE] in self.nexus_instance_name:
+                data[NAME] = self.nexus_instance_name[data[TYPE]]
+                data[ATTRIBUTES] = [{NAME: NX_CLASS,
+                                     DATA_TYPE: 'string',
+                                     VALUES: data[TYPE]}]
+                data[TYPE] = GROUP
+            if node_parent is not LINK:
+                stream_information = get_stream_information(data[NAME])
+                if CHILDREN in data:
+                    data[CHILDREN].extend(stream_information)
+                else:
+                    data[CHILDREN] = stream_information
+        return result[0]
 
     def get_link(self, data):
         """
@@ -231,59 +298,68 @@ class FileWriterNexusConfigCreator:
         Get the stream information for the file writer to add in the
         file writer config json file.
         """
-        stream_info_aggr = []
-        if name in self.configuration:
-            for item in self.configuration[name]:
-                stream_info = {}
-                if item[KIND] == GROUP:
-                    stream_info = {
-                        WRITER_MODULE: '',
-                        CONFIG: {
-                            SOURCE: '',
-                            TOPIC: '',
-                            DATA_TYPE: '',
-                        },
-                    }
-                    if self._item_is_string(WRITER_MODULE, item):
-                        stream_info[WRITER_MODULE] = \
-                            item[WRITER_MODULE]
-                    if self._item_is_string(SOURCE, item):
-                        stream_info[CONFIG][SOURCE] = \
-                            item[SOURCE]
-                    if self._item_is_string(TOPIC, item):
-                        stream_info[CONFIG][TOPIC] = \
-                            item[TOPIC]
-                    if self._item_is_string(DATA_TYPE, item):
-                        stream_info[CONFIG][DATA_TYPE] = \
-                            item[DATA_TYPE]
-                    if self._item_is_string(VALUE_UNITS, item):
-                        stream_info[CONFIG][VALUE_UNITS] = \
-                            item[VALUE_UNITS]
-                    if self._item_is_string(ARRAY_SIZE, item):
-                        str_values = item[ARRAY_SIZE].split(',')
-                        int_values = [int(val) for val in str_values]
-                        stream_info[CONFIG][ARRAY_SIZE] = int_values
-                    if self._item_is_string(DATA_NAME, item):
-                        stream_info = {
-                            TYPE: GROUP,
-                            NAME: item[DATA_NAME],
-                            CHILDREN: [stream_info],
-                        }
-                elif item[KIND] == STATIC_DATA:
-                    config = {}
-                    if self._item_is_string(DATA_TYPE, item):
-                        config[DATA_TYPE] = item[DATA_TYPE]
-                    if self._item_is_string(STATIC_VALUE, item):
-                        config[VALUES] = item[STATIC_VALUE]
-                    if self._item_is_string(DATA_NAME, item):
-                        config[NAME] = item[DATA_NAME]
-                        stream_info = {
-                            WRITER_MODULE: DATASET,
-                            CONFIG: config
-                        }
-                if stream_info:
-                    stream_info_aggr.append(stream_info)
-        return stream_info_aggr
+        return list(self._stream_information.get(name, []))
+
+    def _compile_stream_information(self):
+        """
+        Converts every configuration row to its stream or static data entry
+        once, so that looking up the entries for a node is a dictionary access.
+
+        ::return:: dictionary of device name to list of entries.
+        """
+        stream_information = {}
+        for name, items in self.configuration.items():
+            entries = []
+            for item in items:
+                entry = self._compile_configuration_row(item)
+                if entry:
+                    entries.append(entry)
+            stream_information[name] = entries
+        return stream_information
+
+    def _compile_configuration_row(self, item):
+        """
+        ::return:: the stream or static data entry for a configuration row,
+        or an empty dictionary if the row does not describe one.
+        """
+        stream_info = {}
+        if item[KIND] == GROUP:
+            stream_info = {
+                WRITER_MODULE: '',
+                CONFIG: {
+                    SOURCE: '',
+                    TOPIC: '',
+                    DATA_TYPE: '',
+                },
+            }
+            if self._item_is_string(WRITER_MODULE, item):
+                stream_info[WRITER_MODULE] = item[WRITER_MODULE]
+            for key in (SOURCE, TOPIC, DATA_TYPE, VALUE_UNITS):
+                if self._item_is_string(key, item):
+                    stream_info[CONFIG][key] = item[key]
+            if self._item_is_string(ARRAY_SIZE, item):
+                str_values = item[ARRAY_SIZE].split(',')
+                int_values = [int(val) for val in str_values]
+                stream_info[CONFIG][ARRAY_SIZE] = int_values
+            if self._item_is_string(DATA_NAME, item):
+                stream_info = {
+                    TYPE: GROUP,
+                    NAME: item[DATA_NAME],
+                    CHILDREN: [stream_info],
+                }
+        elif item[KIND] == STATIC_DATA:
+            config = {}
+            if self._item_is_string(DATA_TYPE, item):
+                config[DATA_TYPE] = item[DATA_TYPE]
+            if self._item_is_string(STATIC_VALUE, item):
+                config[VALUES] = item[STATIC_VALUE]
+            if self._item_is_string(DATA_NAME, item):
+                config[NAME] = item[DATA_NAME]
+                stream_info = {
+                    WRITER_MODULE: DATASET,
+                    CONFIG: config
+                }
+        return stream_info
 
     @staticmethod
     def _item_is_string(kind, item):
@@ -291,13 +367,13 @@ class FileWriterNexusConfigCreator:
 
 
 class NxApplicationXMLToJson:
-    NAMESPACE = '{http://definition.nexusformat.org/nxdl/3.1}'
-
-    def __init__(self, xml_path, xls_path, nodes_to_remove=None):
+    def __init__(self, xml_path, xls_path, nodes_to_remove=None,
+                 configuration=None):
         if nodes_to_remove is None:
             nodes_to_remove = ['field']
         self._xml_path = xml_path
         self._config_xls_path = xls_path
+        self._configuration = configuration
         self.nx_tomo_dict = {}
         self.json_template = {}
         self.nodes_to_remove = nodes_to_remove
@@ -309,13 +385,13 @@ class NxApplicationXMLToJson:
         Templates are found on: https://github.com/nexusformat/definitions
         """
         try:
-            tree = etree.parse(self._xml_path)
-            xml_data = self._remove_nodes_from_tree(tree)
-            xml_str = etree.tostring(xml_data, encoding='utf-8',
-                                     method='xml')
-            self.nx_tomo_dict = dict(xmltodict.parse(xml_str))
+            tree_root = etree.parse(self._xml_path).getroot()
+            self.nx_tomo_dict = {
+                self._qualified_name(tree_root, tree_root.tag):
+                    self._element_to_dict(tree_root)
+            }
             return True
-        except (FileNotFoundError, ValueError, ExpatError) as e:
+        except (OSError, ValueError, etree.XMLSyntaxError) as e:
             print(e)
             return False
 
@@ -329,7 +405,8 @@ class NxApplicationXMLToJson:
         if status:
             dict_cont = self.nx_tomo_dict['definition']['group']
             nxs_config_creator = \
-                FileWriterNexusConfigCreator(dict_cont, self._config_xls_path)
+                FileWriterNexusConfigCreator(dict_cont, self._config_xls_path,
+                                             self._configuration)
             self.json_template = \
                 nxs_config_creator.generate_nexus_file_writer_config()
         return status
@@ -338,22 +415,64 @@ class NxApplicationXMLToJson:
         with open(save_path, 'w') as json_file:
             json.dump(self.json_template, json_file, indent=4)
 
-    def _remove_nodes_from_tree(self, tree):
+    def _element_to_dict(self, element):
         """
-        Removes occurrences of specific nodes from tree.
-        The undesired nodes are specified in self.nodes_to_remove.
+        Converts the lxml element to the same structure xmltodict would give:
+        attributes as '@name' keys, a single child element as a dictionary,
+        repeated child elements as a list and text as '#text', or only the
+        text if there are no attributes or children.
+        Nodes specified in self.nodes_to_remove are left out.
 
-        ::return:: Returns tree where undesired nodes are removed.
+        ::return:: returns the element content, or None if it is empty.
         """
-        properties = [f'{self.NAMESPACE}{list_item}'
-                      for list_item in self.nodes_to_remove]
-        tree_root = tree.getroot()
-        remove_nodes = [tree_root.findall(f'.//{prop}')
-                        for prop in properties]
-        for node in remove_nodes[0]:
-            node.getparent().remove(node)
+        content = {}
+        parent = element.getparent()
+        parent_nsmap = parent.nsmap if parent is not None else {}
+        for prefix, uri in element.nsmap.items():
+            if parent_nsmap.get(prefix) != uri:
+                key = '@xmlns' if prefix is None else f'@xmlns:{prefix}'
+                content[key] = uri
+        for name, value in element.attrib.items():
+            content[f'@{self._qualified_name(element, name)}'] = value
+
+        text = [element.text or '']
+        for child in element:
+            if not isinstance(child.tag, str):
+                # Comments and processing instructions
+                text.append(child.tail or '')
+                continue
+            if etree.QName(child).localname in self.nodes_to_remove:
+                continue
+            text.append(child.tail or '')
+            child_name = self._qualified_name(child, child.tag)
+            child_content = self._element_to_dict(child)
+            if child_name not in content:
+                content[child_name] = child_content
+            elif isinstance(content[child_name], list):
+                content[child_name].append(child_content)
+            else:
+                content[child_name] = [content[child_name], child_content]
+
+        text = ''.join(text).strip()
+        if text:
+            if not content:
+                return text
+            content['#text'] = text
+        return content if content else None
 
-        return tree_root
+    @staticmethod
+    def _qualified_name(element, name):
+        """
+        Replaces the namespace of a tag or attribute name with the prefix
+        used for it in the XML file.
+        """
+        qname = etree.QName(name)
+        if qname.namespace is None:
+            return qname.localname
+        for prefix, uri in element.nsmap.items():
+            if uri == qname.namespace and prefix is not None:
+                return f'{prefix}:{qname.localname}'
+        return qname.localname
 
 
 if __name__ == '__main__':
@@ -0,0 +1,227 @@
+import argparse
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from glob import glob
+
+import numpy as np
+from PIL import Image
+from streaming_data_types.area_detector_ADAr import serialise_ADAr
+from streaming_data_types.logdata_f142 import serialise_f142
+
+"""
+Pipelined version of kafka_stream_image.py, for load testing the file writer
+at detector rates.
+
+Images are read and decoded by a thread pool, ahead of when they are needed,
+serialised in a second stage and sent by a Kafka producer which batches the
+messages. Frames are sent at a fixed rate, or as fast as possible, and the
+achieved frames/s and MB/s are reported.
+
+python kafka_producer.py --rate 50 --repeat 10
+python kafka_producer.py --fake-broker  # measure without a Kafka broker
+"""
+
+projection = 0
+flat_field = 1
+dark_field = 2
+invalid = 3
+
+# Image key for each file name prefix in the image directory
+IMAGE_KEYS = {'tomo': projection, 'flat': flat_field, 'dark': dark_field}
+
+_END = object()
+
+
+class FakeProducer:
+    """
+    Stands in for KafkaProducer, it only counts messages,
+    to test the pipeline without a broker.
+    """
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+
+    def send(self, topic, value):
+        self.messages += 1
+        self.bytes += len(value)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def list_frames(image_dir, pattern, repeat=1):
+    """
+    ::return:: list of (path, image key, rotation angle) for each frame.
+    """
+    frames = []
+    for _ in range(repeat):
+        for angle, path in enumerate(sorted(glob(os.path.join(image_dir,
+                                                              pattern))),
+                                     start=1):
+            prefix = os.path.basename(path).split('_')[0]
+            frames.append((path, IMAGE_KEYS.get(prefix, invalid), angle))
+    return frames
+
+
+def read_image(path):
+    with Image.open(path) as image:
+        return np.array(image)
+
+
+def prefetch_images(frames, executor, prefetch):
+    """
+    Decodes the frames' images with the executor, keeping at most prefetch
+    images in flight, and yields them in order with their frame.
+    """
+    in_flight = deque()
+    frames = iter(frames)
+    for frame in frames:
+        in_flight.append((frame, executor.submit(read_image, frame[0])))
+        if len(in_flight) >= prefetch:
+            break
+    while in_flight:
+        frame, image = in_flight.popleft()
+        next_frame = next(frames, None)
+        if next_frame is not None:
+            in_flight.append((next_frame,
+                              executor.submit(read_image, next_frame[0])))
+        yield frame, image.result()
+
+
+def serialise_frames(images, first_id, source_name, output):
+    """
+    Serialises each image with its rotation angle and image key and puts
+    the messages for each frame on the output queue.
+    """
+    try:
+        for frame_number, ((_, image_key, angle), image) in enumerate(images):
+            output.put([
+                serialise_ADAr(source_name, first_id + frame_number,
+                               datetime.now(), image),
+                serialise_f142(angle, 'rotation_angle', time.time_ns()),
+                serialise_f142(image_key, 'image_key', time.time_ns()),
+            ])
+    except Exception as e:
+        output.put(e)
+    output.put(_END)
+
+
+def send_frames(producer, topic, messages, rate=None, report_interval=5.0):
+    """
+    Sends each frame's messages, at rate frames per second if given.
+
+    ::return:: number of frames and bytes sent and the time taken.
+    """
+    frames_sent = 0
+    bytes_sent = 0
+    start = time.perf_counter()
+    last_report = start
+    while True:
+        frame_messages = messages.get()
+        if frame_messages is _END:
+            break
+        if isinstance(frame_messages, Exception):
+            raise frame_messages
+        if rate:
+            # Keep to a fixed schedule, so a slow frame does not delay the rest
+            delay = start + frames_sent / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        for message in frame_messages:
+            producer.send(topic, message)
+            bytes_sent += len(message)
+        frames_sent += 1
+
+        now = time.perf_counter()
+        if report_interval and now - last_report >= report_interval:
+            print_rates(frames_sent, bytes_sent, now - start)
+            last_report = now
+    producer.flush()
+    return frames_sent, bytes_sent, time.perf_counter() - start
+
+
+def print_rates(frames, n_bytes, duration):
+    duration = max(duration, 1e-9)
+    print(f'{frames} frames in {duration:.1f} s: '
+          f'{frames / duration:.1f} frames/s, '
+          f'{n_bytes / duration / 1e6:.1f} MB/s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--broker', type=str, default='localhost:9092')
+    parser.add_argument('--topic', type=str, default='odin_topic')
+    parser.add_argument('--source-name', type=str, default='image_source')
+    parser.add_argument('--image-dir', type=str,
+                        default=os.path.join('..', 'Lego1'))
+    parser.add_argument('--pattern', type=str, default='tomo_*.tif',
+                        help='Glob pattern of the images to send')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Send the images this many times')
+    parser.add_argument('--first-id', type=int, default=151,
+                        help='Unique id of the first frame')
+    parser.add_argument('--rate', type=float, default=10.0,
+                        help='Frames per second, 0 to send as fast as '
+                             'possible')
+    parser.add_argument('--threads', type=int, default=4,
+                        help='Number of threads reading images')
+    parser.add_argument('--prefetch', type=int, default=32,
+                        help='Maximum number of frames read ahead of '
+                             'sending')
+    parser.add_argument('--linger-ms', type=int, default=5,
+                        help='Time the producer waits to fill a batch')
+    parser.add_argument('--batch-size', type=int, default=1048576,
+                        help='Producer batch size in bytes')
+    parser.add_argument('--compression', choices=['none', 'gzip', 'snappy',
+                                                  'lz4', 'zstd'],
+                        default='none')
+    parser.add_argument('--max-request-size', type=int, default=20000000,
+                        help='Must be larger than a serialised image')
+    parser.add_argument('--fake-broker', action='store_true',
+                        help='Do not connect to Kafka, only count messages')
+    parser.add_argument('--report-interval', type=float, default=5.0,
+                        help='Seconds between progress reports')
+    args = parser.parse_args()
+
+    frames = list_frames(args.image_dir, args.pattern, args.repeat)
+    if not frames:
+        raise FileNotFoundError(f'No images matching {args.pattern} '
+                                f'in {args.image_dir}')
+
+    if args.fake_broker:
+        kafka_producer = FakeProducer()
+    else:
+        from kafka import KafkaProducer
+        kafka_producer = KafkaProducer(
+            bootstrap_servers=args.broker,
+            linger_ms=args.linger_ms,
+            batch_size=args.batch_size,
+            compression_type=None if args.compression == 'none'
+            else args.compression,
+            max_request_size=args.max_request_size,
+            buffer_memory=max(33554432, 4 * args.max_request_size))
+
+    serialised = queue.Queue(maxsize=args.prefetch)
+    with ThreadPoolExecutor(max_workers=args.threads) as reader_pool:
+        images = prefetch_images(frames, reader_pool, args.prefetch)
+        serialiser = threading.Thread(
+            target=serialise_frames,
+            args=(images, args.first_id, args.source_name, serialised),
+            daemon=True)
+        serialiser.start()
+        frames_sent, bytes_sent, duration = send_frames(
+            kafka_producer, args.topic, serialised, args.rate,
+            args.report_interval)
+        serialiser.join()
+    kafka_producer.close()
+    print_rates(frames_sent, bytes_sent, duration)
@@ -1,31 +1,49 @@
+import argparse
 from collections import OrderedDict
 from nexusutils.nexusbuilder import NexusBuilder
 import numpy as np
-import nexusformat.nexus as nexus
-from nexusjson.nexus_to_json import NexusToDictConverter, create_writer_commands, object_to_json_file
+import h5py
+from nexusjson.nexus_to_json import create_writer_commands, object_to_json_file
+from examples.common.detspecmap import detspec_id_map
+from examples.common.eventidmap import CHUNK_SIZE, compose, copy_event_ids, scale_ids
+from examples.common.instrumentation import instrumented
+from examples.common.streamingjson import write_command_to_json_file
+from examples.common.streamtable import find_unresolved_streams, load_stream_table
+import os
 from datetime import datetime
 from typing import List
 
+# Stream definitions for the file-writer command, one row per stream
+STREAM_TABLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'V20_streams.csv')
 
-def __copy_and_transform_dataset(source_file, source_path, target_path, transformation=None, dtype=None):
-    source_data = source_file[source_path][...]
-    if transformation is not None:
-        transformed_data = transformation(source_data)
-    else:
-        transformed_data = source_data
+
+@instrumented
+def __copy_and_transform_dataset(source_file, source_path, target_path, transformation=None, dtype=None,
+                                 chunk_size=CHUNK_SIZE):
+    """
+    Copy a 1D dataset chunk by chunk, transformation is applied to each chunk so must work element-wise
+    """
+    source_dataset = source_file[source_path]
     if dtype is None:
-        dtype = transformed_data.dtype
-    target_dataset = builder.target_file.create_dataset(target_path, transformed_data.shape,
+        dtype = source_dataset.dtype if transformation is None else transformation(source_dataset[:1]).dtype
+    target_dataset = builder.target_file.create_dataset(target_path, source_dataset.shape,
                                                         dtype=dtype,
                                                         compression=builder.compress_type,
                                                         compression_opts=builder.compress_opts)
-    target_dataset[...] = transformed_data
+    for chunk_start in range(0, source_dataset.shape[0], chunk_size):
+        source_data = source_dataset[chunk_start:chunk_start + chunk_size]
+        if transformation is not None:
+            source_data = transformation(source_data)
+        target_dataset[chunk_start:chunk_start + chunk_size] = source_data
     return target_dataset
 
 
-def __copy_existing_data(downscale_detecter=False):
+@instrumented
+def __copy_existing_data(downscale_detecter=False, event_id_map=None):
     """
     Copy data from the existing NeXus file
+
+    :param event_id_map: remap event ids with this map from eventidmap, after downscaling if that is requested
     """
     raw_event_path = nx_entry_name + '/instrument/detector_1/raw_event_data/'
     builder.get_root()['instrument/detector_1'].create_group('raw_event_data')
@@ -46,18 +64,16 @@ def __copy_existing_data(downscale_detecter=False):
     event_time_zero_ds.attrs.create('units', np.array('ns').astype('|S2'))
     event_time_zero_ds.attrs.create('offset', np.array('1970-01-01T00:00:00').astype('|S19'))
 
-    def downscale_detector_resolution(ids):
-        original_res = (2 ** 16) ** 2
-        target_res = 150 ** 2
-        scale_factor = target_res / original_res
-        return (ids * scale_factor).astype(np.uint32)
-
+    id_maps = []
     if downscale_detecter:
-        __copy_and_transform_dataset(builder.source_file, 'entry-01/Delayline_events/event_id',
-                                     raw_event_path + 'event_id', downscale_detector_resolution)
-    else:
-        __copy_and_transform_dataset(builder.source_file, 'entry-01/Delayline_events/event_id',
-                                     raw_event_path + 'event_id')
+        # Raw DENEX ids are 2^16 x 2^16, downscale to 150 x 150
+        id_maps.append(scale_ids((2 ** 16) ** 2, 150 ** 2))
+    if event_id_map is not None:
+        id_maps.append(event_id_map)
+    copy_event_ids(builder.source_file['entry-01/Delayline_events/event_id'],
+                   builder.get_root()['instrument/detector_1/raw_event_data'], 'event_id',
+                   compose(*id_maps) if id_maps else None,
+                   compression=builder.compress_type, compression_opts=builder.compress_opts)
 
 
 def __copy_log(builder, source_group, destination_group, nx_component_class=None):
@@ -297,138 +313,20 @@ def __add_motion_devices(builder):
     builder.get_root()['instrument']['Slit3'].create_group('y_center_from_nicos_cache')
 
 
-def __create_file_writer_command(filepath):
+def __create_file_writer_command(nexus_file, array_encoding='json', stream_table=STREAM_TABLE):
+    # Detectors, HV supplies, monitors, choppers, readout timing, motion devices, slits and NICOS cache values
     streams = {}
+    for stream in load_stream_table(stream_table):
+        __add_data_stream(streams, stream['topic'], stream['source'], stream['path'], stream['module'],
+                          stream['type'])
 
-    # DENEX detector
-    detector_topic = 'denex_detector'
-    __add_data_stream(streams, detector_topic, 'delay_line_detector',
-                      '/entry/instrument/detector_1/raw_event_data', 'ev42')
-    detector_debug_topic = 'denex_debug'
-    for detector_channel in range(4):
-        __add_data_stream(streams, detector_debug_topic, f'Denex_Adc0_Ch{detector_channel}',
-                          f'/entry/instrument/detector_1/pulses_channel_{detector_channel}', 'ev42')
-        __add_data_stream(streams, detector_debug_topic, f'Denex_Adc0_Ch{detector_channel}_waveform',
-                          f'/entry/instrument/detector_1/waveforms_channel_{detector_channel}', 'senv')
-
-    # Detector HV supply
-    hv_supply_topic = 'V20_detectorPower'
-    for hv_power_supply_channel in range(4):
-        __add_data_stream(streams, hv_supply_topic, f'HZB-V20:Det-PwrC-01:02:00{hv_power_supply_channel}:VMon',
-                          f'/entry/instrument/detector_1/hv_supply_voltage_channel_{hv_power_supply_channel + 1}',
-                          'f142', 'double')
-        __add_data_stream(streams, hv_supply_topic, f'HZB-V20:Det-PwrC-01:02:00{hv_power_supply_channel}:IMon',
-                          f'/entry/instrument/detector_1/hv_supply_current_channel_{hv_power_supply_channel + 1}',
-                          'f142', 'double')
-        __add_data_stream(streams, hv_supply_topic, f'HZB-V20:Det-PwrC-01:02:00{hv_power_supply_channel}:Pw',
-                          f'/entry/instrument/detector_1/hv_supply_status_channel_{hv_power_supply_channel + 1}',
-                          'f142', 'int32')
-
-    # Monitors
-    monitor_topic = 'monitor'
-    for monitor_number in range(4):
-        __add_data_stream(streams, monitor_topic, f'Monitor_Adc0_Ch{monitor_number}',
-                          f'/entry/monitor_{monitor_number}/events', 'ev42')
-        __add_data_stream(streams, monitor_topic, f'Monitor_Adc0_Ch{monitor_number}',
-                          f'/entry/monitor_{monitor_number}/waveforms', 'senv')
-
-
-    # Choppers
-    chopper_topic = 'V20_choppers'
-    __add_data_stream(streams, chopper_topic, 'HZB-V20:Chop-Drv-0401:TDC_array',
-                      '/entry/instrument/chopper_1/top_dead_center', 'tdct')
-    __add_data_stream(streams, chopper_topic, 'HZB-V20:Chop-Drv-0402:TDC_array',
-                      '/entry/instrument/chopper_2/top_dead_center', 'tdct')
-    __add_data_stream(streams, chopper_topic, 'HZB-V20:Chop-Drv-0101:TDC_array',
-                      '/entry/instrument/chopper_3/top_dead_center', 'tdct')
-    __add_data_stream(streams, chopper_topic, 'HZB-V20:Chop-Drv-0102:TDC_array',
-                      '/entry/instrument/chopper_4/top_dead_center', 'tdct')
-    __add_data_stream(streams, chopper_topic, 'HZB-V20:Chop-Drv-0301:TDC_array',
-                      '/entry/instrument/chopper_5/top_dead_center', 'tdct')
-    __add_data_stream(streams, chopper_topic, 'HZB-V20:Chop-Drv-0501:TDC_array',
-                      '/entry/instrument/chopper_6/top_dead_center', 'tdct')
-    __add_data_stream(streams, chopper_topic, 'HZB-V20:Chop-Drv-0502:TDC_array',
-                      '/entry/instrument/chopper_7/top_dead_center', 'tdct')
-    __add_data_stream(streams, chopper_topic, 'HZB-V20:Chop-Drv-0302:TDC_array',
-                      '/entry/instrument/chopper_8/top_dead_center', 'tdct')
-    __add_data_stream(streams, chopper_topic, 'HZB-V20:Chop-Drv-0101:Ref_Unix_asub.VALF',
-                      '/entry/instrument/chopper_3/ntp_to_mrf_comparison', 'f142', 'int32')
-
-    # ESS Mini-Chopper
-    __add_data_stream(streams, chopper_topic, 'HZB-V20:Chop-Drv-0102:TDC_array',
-                      '/entry/instrument/chopper_9/top_dead_center', 'tdct')
-    __add_data_stream(streams, chopper_topic, 'HZB-V20:Chop-Drv-0103:TDC_array',
-                      '/entry/instrument/chopper_9/reference_pulse', 'tdct')
-    __add_data_stream(streams, chopper_topic, 'HZB-V20:Chop-Drv-0104:TDC_array',
-                      '/entry/instrument/chopper_9/neutron_pulse_arrival', 'tdct')
-
-    # Readout system timing status
-    timing_status_topic = 'V20_timingStatus'
-    for readout_system_number in ('1', '2'):
-        group_name = f'readout_system_{readout_system_number}'
-        __add_data_stream(streams, timing_status_topic, f'HZB-V20:TS-RO{readout_system_number}:TS-SDiff-RBV',
-                          f'/entry/instrument/detector_1/{group_name}/s_diff', 'f142', 'double')
-        __add_data_stream(streams, timing_status_topic, f'HZB-V20:TS-RO{readout_system_number}:TS-NDiff-RBV',
-                          f'/entry/instrument/detector_1/{group_name}/n_diff', 'f142', 'double')
-        __add_data_stream(streams, timing_status_topic, f'HZB-V20:TS-RO{readout_system_number}:STATUS2-RBV',
-                          f'/entry/instrument/detector_1/{group_name}/status', 'f142', 'int32')
-
-    # Motion devices
-    def _add_motion_dev(pv_root: str, group_names: List[str], start_index: int):
-        motion_topic = 'V20_motion'
-        for group_number, group_name in enumerate(group_names):
-            __add_data_stream(streams, motion_topic, pv_root + f"{group_number + start_index}.VAL",
-                              f'/entry/instrument/{group_name}/target_value', 'f142', 'double')
-            __add_data_stream(streams, motion_topic, pv_root + f"{group_number + start_index}.RBV",
-                              f'/entry/instrument/{group_name}/value', 'f142', 'double')
-            __add_data_stream(streams, motion_topic, pv_root + f"{group_number + start_index}.STAT",
-                              f'/entry/instrument/{group_name}/status', 'f142', 'int32')
-            __add_data_stream(streams, motion_topic, pv_root + f"{group_number + start_index}.VELO",
-                              f'/entry/instrument/{group_name}/velocity', 'f142', 'double')
-
-    motion_topic = 'V20_motion'
-    _add_motion_dev("TUD-SMI:MC-MCU-01:m", ['linear_stage', 'tilting_angle_1', 'tilting_angle_2'], start_index=1)
-    _add_motion_dev("HZB-V20:MC-MCU-01:m", ['Omega_1', 'Omega_2', 'Lin1'], start_index=10)
-
-    def _add_slit(slit_group_name: str, pv_names: List[str]):
-        nicos_device_name = slit_group_name.lower()
-        nicos_topic = "V20_nicosCacheHistory"
-        for pv_name in pv_names:
-            if "H-Gap" in pv_name:
-                value_name = "x_gap"
-                nicos_value_name = "h_gap"
-            elif "V-Gap" in pv_name:
-                value_name = "y_gap"
-                nicos_value_name = "v_gap"
-            elif "H-Center" in pv_name:
-                value_name = "x_center"
-                nicos_value_name = "h_center"
-            elif "V-Center" in pv_name:
-                value_name = "y_center"
-                nicos_value_name = "v_center"
-            else:
-                value_name = "value"
-                nicos_value_name = "value"
-            __add_data_stream(streams, motion_topic, f"{pv_name}.VAL",
-                              f'/entry/instrument/{slit_group_name}/{value_name}_target', 'f142', 'double')
-            __add_data_stream(streams, motion_topic, f"{pv_name}.RBV",
-                              f'/entry/instrument/{slit_group_name}/{value_name}', 'f142', 'double')
-            __add_data_stream(streams, motion_topic, f"{pv_name}.STAT",
-                              f'/entry/instrument/{slit_group_name}/{value_name}_status', 'f142', 'int32')
-            __add_data_stream(streams, motion_topic, f"{pv_name}.VELO",
-                              f'/entry/instrument/{slit_group_name}/{value_name}_velocity', 'f142', 'double')
-
-            __add_data_stream(streams, nicos_topic, f"nicos/{nicos_device_name}{nicos_value_name}/value",
-                              f'/entry/instrument/{slit_group_name}/{value_name}_from_nicos_cache', 'ns10')
-
-    _add_slit("Slit3", ["HZB-V20:MC-SLT-01:SltH-Center", "HZB-V20:MC-SLT-01:SltH-Gap", "HZB-V20:MC-SLT-01:SltV-Center",
-                        "HZB-V20:MC-SLT-01:SltV-Gap"])
+    unresolved_paths = find_unresolved_streams(nexus_file, streams)
+    if unresolved_paths:
+        print(f'Warning: no group in the NeXus file for {len(unresolved_paths)} streams, they are left out of '
+              f'the command: {", ".join(unresolved_paths)}')
 
     links = {}
 
-    converter = NexusToDictConverter()
-    nexus_file = nexus.nxload(filepath)
-    tree = converter.convert(nexus_file, streams, links)
     # The Kafka broker at V20 is v20-udder1, but due to the network setup at V20 we have to use the IP: 192.168.1.80
     # Use a timestamp in the output filename, but avoid characters "-" and ":"
     iso8601_str_seconds = datetime.now().isoformat().split('.')[0]
@@ -437,12 +335,14 @@ def __create_file_writer_command(filepath):
     start_time = 'STARTTIME'  # NICOS replaces STARTTIME
     stop_time = None
     file_name = 'FILENAME'  # NICOS replaces FILENAME
-    write_command, stop_command = create_writer_commands(tree,
+    # The nexus_structure is streamed into the start command directly from the NeXus file
+    write_command, stop_command = create_writer_commands({},
                                                          '/data/kafka-to-nexus/FILENAME',
                                                          broker='192.168.1.80:9092',
                                                          start_time=start_time,
                                                          stop_time=stop_time)
-    object_to_json_file(write_command, 'V20_file_write_start.json')
+    write_command_to_json_file(write_command, nexus_file, 'V20_file_write_start.json', streams, links,
+                               array_encoding=array_encoding)
     object_to_json_file(stop_command, 'V20_file_write_stop.json')
 
 
@@ -482,12 +382,34 @@ def __add_attributes(node, attributes):
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--json-only', action='store_true',
+                        help='Only generate the file-writer commands, the NeXus file is built in memory without '
+                             'copying the existing event data, and is not written to disk')
+    parser.add_argument('--array-encoding', choices=['json', 'base64', 'npz'], default='json',
+                        help='How large arrays are written in the start command: json numbers, inline base64 encoded '
+                             'compressed .npy data, or a reference into an .npz file written next to the JSON')
+    parser.add_argument('--stream-table', type=str, default=STREAM_TABLE,
+                        help='CSV or JSON table of the streams in the file-writer command')
+    parser.add_argument('--detspec-map', type=str,
+                        help='Detector-spectrum map file (.dat or .npy), event ids are replaced by the spectrum '
+                             'numbers it maps them to, events of detectors not in the map are masked')
+    args = parser.parse_args()
+
     output_filename = 'V20_example.nxs'
     input_filename = 'adc_test8_half_cover_w_waveforms.nxs'  # None
     nx_entry_name = 'entry'
+    compress_type = 'gzip'
+    compress_opts = 1
+    if args.json_only:
+        # Event data is replaced by a stream in the file-writer command so there is no need to copy it
+        input_filename = None
+        compress_type = None
+        compress_opts = None
     # compress_type=32001 for BLOSC, or don't specify compress_type and opts to get non-compressed datasets
     with NexusBuilder(output_filename, input_nexus_filename=input_filename, nx_entry_name=nx_entry_name,
-                      idf_file=None, compress_type='gzip', compress_opts=1) as builder:
+                      idf_file=None, compress_type=compress_type, compress_opts=compress_opts,
+                      file_in_memory=args.json_only) as builder:
         instrument_group = builder.add_instrument('V20', 'instrument')
         # builder.add_user('Person 1', 'ESS', number=1)
         # builder.add_user('Person 2', 'STFC', number=2)
@@ -513,7 +435,11 @@ if __name__ == '__main__':
         builder.add_dataset(builder.root, 'title', 'TITLE')  # NICOS replaces TITLE
 
         # Copy event data into detector
-        __copy_existing_data()
+        if not args.json_only:
+            __copy_existing_data(event_id_map=detspec_id_map(args.detspec_map) if args.detspec_map else None)
+        else:
+            # Placeholder for streamed data
+            builder.get_root()['instrument/detector_1'].create_group('raw_event_data')
 
         # Notes on geometry:
 
@@ -525,4 +451,9 @@ if __name__ == '__main__':
 
         # kafkacat -b 192.168.1.80 -t V20_writerCommand -X message.max.bytes=20000000 V20_file_write_stop.json -P
 
-    __create_file_writer_command(output_filename)
+        if args.json_only:
+            __create_file_writer_command(builder.target_file, args.array_encoding, args.stream_table)
+
+    if not args.json_only:
+        with h5py.File(output_filename, 'r') as nexus_file:
+            __create_file_writer_command(nexus_file, args.array_encoding, args.stream_table)
@@ -0,0 +1,238 @@
+import argparse
+import os
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+from examples.common.eventidmap import MASKED_ID
+from examples.common.instrumentation import instrumented
+
+"""
+Regroups raw event data, timestamped per readout message, by neutron pulse
+
+Each event's absolute time (event_time_zero of its message plus its event_time_offset) is
+mapped to the latest pulse time at or before it with np.searchsorted over the chopper TDC
+timestamps. The output NXevent_data has one event_time_zero per pulse and event_time_offset
+relative to the pulse, as Mantid expects.
+
+Events are read, mapped and written chunk by chunk, so memory use is bounded by the chunk
+size rather than the number of events.
+
+Run the throughput benchmark on synthetic data:
+python event_aggregation.py --events 100000000
+"""
+
+# Number of events read and written at a time
+CHUNK_SIZE = 4194304
+# Largest event_time_offset in the output, which is uint32 ns (about 4.29 s)
+MAX_TIME_OFFSET = np.iinfo(np.uint32).max
+
+
+def _string_attr(value: str) -> np.ndarray:
+    return np.array(value).astype(f'|S{len(value)}')
+
+
+def _check_ns(dataset: h5py.Dataset):
+    units = dataset.attrs.get('units', b'ns')
+    if isinstance(units, bytes):
+        units = units.decode('utf-8')
+    if units not in ('ns', 'nanosecond', 'nanoseconds'):
+        raise ValueError(f'Expected times in ns in {dataset.name}, not {units}')
+
+
+class _PulseEventWriter:
+    """
+    Appends events grouped by pulse to resizable NXevent_data datasets
+    """
+
+    def __init__(self, group: h5py.Group, pulse_times: np.ndarray, chunk_size: int, event_id_override=None):
+        self._pulse_times = pulse_times
+        self._event_id_override = event_id_override
+        group.attrs.create('NX_class', _string_attr('NXevent_data'))
+
+        def _create(name, dtype, chunk):
+            return group.create_dataset(name, (0,), maxshape=(None,), dtype=dtype, chunks=(chunk,))
+
+        pulse_chunk = min(max(pulse_times.size, 1), 65536)
+        self._event_time_zero = _create('event_time_zero', np.uint64, pulse_chunk)
+        self._event_time_zero.attrs.create('units', _string_attr('ns'))
+        self._event_time_zero.attrs.create('offset', _string_attr('1970-01-01T00:00:00'))
+        self._event_index = _create('event_index', np.uint64, pulse_chunk)
+        self._event_time_offset = _create('event_time_offset', np.uint32, chunk_size)
+        self._event_time_offset.attrs.create('units', _string_attr('ns'))
+        self._event_id = _create('event_id', np.uint32, chunk_size)
+        self.first_pulse = None
+        self.next_pulse = None
+        self.events_written = 0
+
+    @staticmethod
+    def _append(dataset: h5py.Dataset, data: np.ndarray):
+        start = dataset.shape[0]
+        dataset.resize((start + data.size,))
+        dataset[start:] = data
+
+    def write(self, pulses: np.ndarray, time_offsets: np.ndarray, event_ids: np.ndarray, last_pulse: int):
+        """
+        Write events sorted by pulse, and the index entries for every pulse up to and including last_pulse
+        """
+        if self.first_pulse is None:
+            self.first_pulse = int(pulses[0]) if pulses.size else last_pulse
+            self.next_pulse = self.first_pulse
+        if last_pulse >= self.next_pulse:
+            counts = np.bincount(pulses - self.next_pulse, minlength=last_pulse + 1 - self.next_pulse)
+            event_index = np.empty(counts.size, dtype=np.uint64)
+            event_index[0] = self.events_written
+            np.cumsum(counts[:-1], out=event_index[1:])
+            event_index[1:] += np.uint64(self.events_written)
+            self._append(self._event_index, event_index)
+            self._append(self._event_time_zero, self._pulse_times[self.next_pulse:last_pulse + 1])
+            self.next_pulse = last_pulse + 1
+        self._append(self._event_time_offset, time_offsets)
+        if self._event_id_override is not None:
+            event_ids = np.full(time_offsets.size, self._event_id_override, dtype=np.uint32)
+        self._append(self._event_id, event_ids)
+        self.events_written += time_offsets.size
+
+
+@instrumented(hdf5_argument='out_file')
+def aggregate_events_by_pulse(out_file: h5py.File, chopper_times_path: str, input_group_path: str,
+                              tdc_pulse_time_difference: int = 0, output_group_name: str = 'event_data',
+                              event_id_override=None, remove_input: bool = True, chunk_size: int = CHUNK_SIZE,
+                              event_id_map=None):
+    """
+    Write the events in input_group_path grouped by pulse to a new NXevent_data group called
+    output_group_name alongside it
+
+    :param chopper_times_path: dataset of chopper TDC timestamps in ns since the epoch
+    :param tdc_pulse_time_difference: pulse times are the TDC timestamps minus this (ns)
+    :param event_id_override: use this detector id for every event, for example for monitors, the input
+      group then needs no event_id dataset and event_id_map is not used
+    :param remove_input: delete the input group afterwards
+    :param event_id_map: remap event ids with this map from eventidmap, events it masks are left out
+    :return: number of events which were written, and which were dropped because they were before the first
+      pulse, out of order, or too long after their pulse for a 32 bit time offset in ns
+    """
+    input_group = out_file[input_group_path]
+    event_time_zero = input_group['event_time_zero']
+    _check_ns(event_time_zero)
+    _check_ns(out_file[chopper_times_path])
+    message_times = event_time_zero[...].astype(np.int64)
+    message_indices = input_group['event_index'][...].astype(np.int64)
+    event_time_offset = input_group['event_time_offset']
+    event_id = input_group['event_id'] if event_id_override is None else None
+    n_events = event_time_offset.shape[0]
+
+    pulse_times = np.sort(out_file[chopper_times_path][...].astype(np.int64)) - tdc_pulse_time_difference
+    output_group = input_group.parent.create_group(output_group_name)
+    writer = _PulseEventWriter(output_group, pulse_times.astype(np.uint64), min(chunk_size, max(n_events, 1)),
+                               event_id_override)
+
+    # Events of pulses which may still have events in the next chunk are held back
+    held = (np.empty(0, np.int64), np.empty(0, np.uint32), np.empty(0, np.uint32))
+    dropped = 0
+    too_late = 0
+    masked = 0
+    for chunk_start in range(0, n_events, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, n_events)
+        messages = np.searchsorted(message_indices, np.arange(chunk_start, chunk_end), side='right') - 1
+        event_times = message_times[messages] + event_time_offset[chunk_start:chunk_end].astype(np.int64)
+        pulses = np.searchsorted(pulse_times, event_times, side='right') - 1
+        valid = pulses >= 0
+        if writer.next_pulse is not None:
+            valid &= pulses >= writer.next_pulse
+        dropped += int(np.count_nonzero(~valid))
+        offsets = event_times - pulse_times[np.maximum(pulses, 0)]
+        late = valid & (offsets > MAX_TIME_OFFSET)
+        too_late += int(np.count_nonzero(late))
+        valid &= ~late
+        if event_id is None:
+            ids = np.full(chunk_end - chunk_start, event_id_override, dtype=np.uint32)
+        else:
+            ids = event_id[chunk_start:chunk_end]
+        if event_id_map is not None and event_id is not None:
+            ids = event_id_map(ids)
+            unmasked = ids != MASKED_ID
+            masked += int(np.count_nonzero(valid & ~unmasked))
+            valid &= unmasked
+        pulses = pulses[valid]
+        time_offsets = offsets[valid].astype(np.uint32)
+        ids = ids[valid].astype(np.uint32)
+
+        pulses = np.concatenate((held[0], pulses))
+        time_offsets = np.concatenate((held[1], time_offsets))
+        ids = np.concatenate((held[2], ids))
+        if not pulses.size:
+            continue
+        order = np.argsort(pulses, kind='stable')
+        pulses, time_offsets, ids = pulses[order], time_offsets[order], ids[order]
+        if chunk_end < n_events:
+            # Messages are in time order and offsets are positive, so no later event can be
+            # before the start of the message the next chunk starts in
+            next_message = np.searchsorted(message_indices, chunk_end, side='right') - 1
+            last_complete_pulse = np.searchsorted(pulse_times, message_times[next_message], side='right') - 2
+        else:
+            last_complete_pulse = pulses[-1]
+        split = np.searchsorted(pulses, last_complete_pulse, side='right')
+        if split:
+            writer.write(pulses[:split], time_offsets[:split], ids[:split], int(last_complete_pulse))
+        held = (pulses[split:], time_offsets[split:], ids[split:])
+    if dropped:
+        print(f'Dropped {dropped} events from {input_group_path} which were before the first pulse or out of order')
+    if too_late:
+        print(f'Dropped {too_late} events from {input_group_path} which were more than {MAX_TIME_OFFSET} ns after '
+              f'their pulse, for example because of a gap in the TDC times')
+    if masked:
+        print(f'Left out {masked} events from {input_group_path} with masked ids')
+    if remove_input:
+        del out_file[input_group_path]
+    return writer.events_written, dropped + too_late
+
+
+def create_benchmark_file(filename: str, n_events: int, events_per_message: int = 10000, pulse_rate: float = 14.0,
+                          seed: int = 0):
+    """
+    Raw event data of n_events events in messages of events_per_message, and chopper TDC timestamps
+    """
+    rng = np.random.default_rng(seed)
+    start_time = 1543584772000000000
+    pulse_period = int(1e9 / pulse_rate)
+    n_messages = max(n_events // events_per_message, 1)
+    # Messages every 10 ms, event times spread uniformly within each message's 10 ms
+    message_period = 10000000
+    n_pulses = n_messages * message_period // pulse_period + 2
+    with h5py.File(filename, 'w') as raw_file:
+        raw_group = raw_file.create_group('entry/instrument/detector_1/raw_event_data')
+        raw_group.attrs.create('NX_class', _string_attr('NXevent_data'))
+        raw_group['event_time_zero'] = start_time + np.arange(n_messages, dtype=np.int64) * message_period
+        raw_group['event_index'] = np.arange(n_messages, dtype=np.uint64) * events_per_message
+        chunks = (min(CHUNK_SIZE, n_events),)
+        event_time_offset = raw_group.create_dataset('event_time_offset', (n_events,), dtype=np.uint32, chunks=chunks)
+        event_id = raw_group.create_dataset('event_id', (n_events,), dtype=np.uint32, chunks=chunks)
+        for chunk_start in range(0, n_events, CHUNK_SIZE):
+            chunk_end = min(chunk_start + CHUNK_SIZE, n_events)
+            event_time_offset[chunk_start:chunk_end] = rng.integers(0, message_period, chunk_end - chunk_start,
+                                                                    dtype=np.uint32)
+            event_id[chunk_start:chunk_end] = rng.integers(0, 150 ** 2, chunk_end - chunk_start, dtype=np.uint32)
+        raw_file['entry/instrument/chopper_1/top_dead_center/time'] = \
+            start_time - pulse_period // 2 + np.arange(n_pulses, dtype=np.int64) * pulse_period
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='Benchmark event aggregation on synthetic raw event data')
+    parser.add_argument('--events', type=int, default=20000000, help='Number of events')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='Events processed at a time')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        filename = os.path.join(temporary_directory, 'raw_events.nxs')
+        create_benchmark_file(filename, args.events)
+        with h5py.File(filename, 'r+') as raw_file:
+            start = time.perf_counter()
+            written, _ = aggregate_events_by_pulse(raw_file, '/entry/instrument/chopper_1/top_dead_center/time',
+                                                   '/entry/instrument/detector_1/raw_event_data',
+                                                   chunk_size=args.chunk_size)
+            duration = time.perf_counter() - start
+    print(f'Aggregated {written} events in {duration:.2f} s: {written / duration / 1e6:.1f} million events/s')
@@ -6,9 +6,14 @@ import os
 from os.path import isfile, join
 import subprocess
 from shutil import copyfile
-from pulse_aggregator import aggregate_events_by_pulse, remove_data_not_used_by_mantid, patch_geometry
+from pulse_aggregator import remove_data_not_used_by_mantid, patch_geometry
+from examples.v20.event_aggregation import aggregate_events_by_pulse
+from examples.common.instrumentation import instrumented, stage
 import matplotlib.pylab as pl
 
+# Number of log timestamps converted at a time, bounds memory use for very long logs
+TIME_CONVERSION_CHUNK_SIZE = 1048576
+
 
 @attr.s
 class DatasetDetails(object):
@@ -59,6 +64,7 @@ filenames = [join(args.input_directory, f) for f in os.listdir(args.input_direct
              isfile(join(args.input_directory, f))]
 
 
+@instrumented
 def convert_to_fixed_length_strings():
     global datasets_to_convert
     datasets_to_convert = []
@@ -78,6 +84,7 @@ def add_attributes_to_node(node, attributes: dict):
             node.attrs.create(key, np.array(attributes[key]))
 
 
+@instrumented
 def _link_log(outfile, log_group, source_path, target_name):
     log_group[target_name] = outfile[source_path]
     try:
@@ -96,28 +103,52 @@ def _link_log(outfile, log_group, source_path, target_name):
 
     if log_group[f'{target_name}/time'].attrs.get('units') == b'ns':
         # Mantid doesn't know about nanoseconds, we'll have to reduce the precision to microseconds
-        microsecs = 'us'
-        log_group[f'{target_name}/time'].attrs.modify('units',
-                                                      np.array(microsecs).astype('|S' + str(len(microsecs))))
-        # Convert nanoseconds to microseconds and store as float not int
-        times = log_group[f'{target_name}/time'][...].astype(float) * 0.001
-        times_attrs = dict(log_group[f'{target_name}/time'].attrs)
-        del log_group[f'{target_name}/time']
-        log_group[target_name].create_dataset('time', dtype=float, data=times)
-        add_attributes_to_node(log_group[f'{target_name}/time'], times_attrs)
-
-
+        _convert_log_times_to_microseconds(log_group[target_name])
+
+
+def _convert_log_times_to_microseconds(log, chunk_size=TIME_CONVERSION_CHUNK_SIZE):
+    """
+    Replace the nanosecond time dataset of a log with one in microseconds, stored as float not int,
+    with the same chunk shape and filters.
+    Values are streamed chunk by chunk so that long logs, such as chopper TDCs, are never fully loaded into memory.
+    """
+    times_ns = log['time']
+    times_attrs = dict(times_ns.attrs)
+    times_us = log.create_dataset('time_us', shape=times_ns.shape, maxshape=times_ns.maxshape, dtype=float,
+                                  chunks=times_ns.chunks, compression=times_ns.compression,
+                                  compression_opts=times_ns.compression_opts, shuffle=times_ns.shuffle,
+                                  fletcher32=times_ns.fletcher32)
+    if times_ns.shape:
+        if times_ns.chunks is not None:
+            # Align reads with the HDF5 chunks so that each one is only decompressed once
+            chunk_size = max(chunk_size - chunk_size % times_ns.chunks[0], times_ns.chunks[0])
+        for start in range(0, times_ns.shape[0], chunk_size):
+            stop = min(start + chunk_size, times_ns.shape[0])
+            times_us[start:stop] = times_ns[start:stop].astype(float) * 0.001
+    else:
+        times_us[()] = float(times_ns[()]) * 0.001
+    del log['time']
+    log.move('time_us', 'time')
+    add_attributes_to_node(times_us, times_attrs)
+    microsecs = 'us'
+    times_us.attrs.modify('units', np.array(microsecs).astype('|S' + str(len(microsecs))))
+
+
+@instrumented
 def link_logs():
     log_group = output_file['/entry'].create_group('logs')
     add_nx_class_to_group(log_group, 'IXselog')
-    _link_log(output_file, log_group, '/entry/instrument/linear_axis_1/target_value', 'linear_axis_1_target_value')
-    _link_log(output_file, log_group, '/entry/instrument/linear_axis_1/value', 'linear_axis_1_value')
-    _link_log(output_file, log_group, '/entry/instrument/linear_axis_2/target_value', 'linear_axis_2_target_value')
-    _link_log(output_file, log_group, '/entry/instrument/linear_axis_2/value', 'linear_axis_2_value')
-    _link_log(output_file, log_group, '/NTP_MRF_time_diff', 'NTP_MRF_time_diff')
+    logs_to_link = [('/entry/instrument/linear_axis_1/target_value', 'linear_axis_1_target_value'),
+                    ('/entry/instrument/linear_axis_1/value', 'linear_axis_1_value'),
+                    ('/entry/instrument/linear_axis_2/target_value', 'linear_axis_2_target_value'),
+                    ('/entry/instrument/linear_axis_2/value', 'linear_axis_2_value'),
+                    ('/NTP_MRF_time_diff', 'NTP_MRF_time_diff')]
     for chopper_number in range(1, 9):
-        _link_log(output_file, log_group, f'/entry/instrument/chopper_{chopper_number}/top_dead_center',
-                  f'chopper_{chopper_number}_TDC')
+        logs_to_link.append((f'/entry/instrument/chopper_{chopper_number}/top_dead_center',
+                             f'chopper_{chopper_number}_TDC'))
+
+    for source_path, target_name in logs_to_link:
+        _link_log(output_file, log_group, source_path, target_name)
 
 
 for filename in filenames:
@@ -134,7 +165,8 @@ for filename in filenames:
     # First run pulse aggregation
     output_filename = f'{name}.nxs'
     print('Copying input file')
-    copyfile(filename, output_filename)
+    with stage('copy input file', hdf5_file=output_filename):
+        copyfile(filename, output_filename)
     with h5py.File(output_filename, 'r+') as output_file:
         # DENEX detector
         print('Aggregating DENEX detector events')
@@ -176,13 +208,15 @@ for filename in filenames:
     print('Running h5repack')
     name, extension = os.path.splitext(output_filename)
     repacked_filename = f'{name}_agg_with_monitor.nxs'
-    subprocess.run([os.path.join(args.format_convert, 'h5repack'), output_filename, repacked_filename])
+    with stage('h5repack', hdf5_file=repacked_filename):
+        subprocess.run([os.path.join(args.format_convert, 'h5repack'), output_filename, repacked_filename])
 
     print('Deleting intermediate file')
     os.remove(output_filename)
 
     # Run h5format_convert on each file to improve compatibility with HDF5 1.8.x used by Mantid
     print('Running h5format_convert')
-    subprocess.run([os.path.join(args.format_convert, 'h5format_convert'), repacked_filename])
+    with stage('h5format_convert'):
+        subprocess.run([os.path.join(args.format_convert, 'h5format_convert'), repacked_filename])
 
     pl.show()
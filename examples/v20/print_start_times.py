@@ -1,18 +1,51 @@
 import argparse
 import os
-import h5py
+from examples.common.filescanner import RunFileScanner, decode_string, list_files, write_index
+from examples.common.runcatalogue import RunCatalogue
 
-parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-parser.add_argument('-i', '--input-directory', type=str,
-                    help='Directory with .hdf files to print the start time of', required=True)
-args = parser.parse_args()
 
-filenames = [os.path.join(args.input_directory, f) for f in os.listdir(args.input_directory) if
-             os.path.isfile(os.path.join(args.input_directory, f))]
+def read_start_time(raw_file):
+    return {'start_time': decode_string(raw_file['/entry/start_time'][...])}
 
-for filename in sorted(filenames):
-    name, extension = os.path.splitext(filename)
-    if extension == '.hdf':
-        with h5py.File(filename, 'r+') as raw_file:
-            start_time = str(raw_file['/entry/start_time'][...])
-        print(f'{name.split("/")[-1]} start: {start_time}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-i', '--input-directory', type=str,
+                        help='Directory with .hdf files to print the start time of', required=True)
+    parser.add_argument('--index-file', type=str,
+                        help='Also write run number, start time and file size of each file to this .csv or .json file')
+    parser.add_argument('--cache-file', type=str,
+                        help='Start times are cached in this file and only re-read from files which have changed, '
+                             'defaults to .start_times_cache.json in the input directory')
+    parser.add_argument('--no-cache', action='store_true', help='Read every file, do not use or update the cache')
+    parser.add_argument('--catalogue', type=str,
+                        help='Also add new and changed files to this SQLite run catalogue, see runcatalogue.py. '
+                             'Start times are then taken from the catalogue, which is used instead of the cache file')
+    parser.add_argument('--threads', type=int, help='Number of threads used to open files', default=8)
+    args = parser.parse_args()
+
+    filenames = list_files(args.input_directory, '.hdf')
+    if args.catalogue:
+        # The catalogue only opens new and changed files and records their start times,
+        # so the files are not scanned a second time for the start times
+        with RunCatalogue(args.catalogue, max_workers=args.threads) as catalogue:
+            catalogue.update_directory(args.input_directory, '.hdf')
+            records = [run if run is not None else {'filename': filename, 'error': 'could not be indexed'}
+                       for filename, run in zip(filenames, catalogue.runs(filenames))]
+    else:
+        cache_filename = None
+        if not args.no_cache:
+            cache_filename = args.cache_file if args.cache_file else os.path.join(args.input_directory,
+                                                                                 '.start_times_cache.json')
+        scanner = RunFileScanner(read_start_time, cache_filename=cache_filename, max_workers=args.threads)
+        records = scanner.scan(filenames)
+
+    for record in records:
+        name = os.path.splitext(os.path.basename(record['filename']))[0]
+        if 'error' in record:
+            print(f'{name} failed: {record["error"]}')
+        else:
+            print(f'{name} start: {record["start_time"]}')
+
+    if args.index_file:
+        write_index(records, args.index_file, ['run_number', 'start_time', 'file_size', 'filename'])
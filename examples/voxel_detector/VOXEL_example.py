@@ -1,68 +1,99 @@
 from nexusutils.nexusbuilder import NexusBuilder
 import numpy as np
 import datetime
-import pandas as pd
+import argparse
+
+from examples.common.instrumentation import instrumented
 
 """
 Small example with detector described by an NXoff_geometry group where
 each pixel is a volume defined by multiple faces in the mesh
 
 Created to test loading such a geometry in Mantid 
+
+The voxels are tiled with numpy broadcasting, so large meshes can be generated
+to stress test loaders, for example
+python VOXEL_example.py --n-voxels 1000000 --no-off-file
 """
 
 
-def add_voxel_detector(nexus_builder: NexusBuilder, n_voxels: int = 3):
+# Vertices of a regular octahedron: top, the four equator vertices and bottom.
+# The bottom vertex of each voxel is the top vertex of the next, so voxel k
+# uses vertices 5k to 5k + 5
+OCTAHEDRON_VERTICES = np.array(
+    [
+        [0.0, 0.0, 1.0],
+        [1.0, 0.0, 0.0],
+        [0.0, 1.0, 0.0],
+        [-1.0, 0.0, 0.0],
+        [0.0, -1.0, 0.0],
+        [0.0, 0.0, -1.0],
+    ]
+)
+# Vertex indices of the faces of the first voxel
+OCTAHEDRON_FACES = np.array(
+    [
+        [1, 0, 4],
+        [4, 0, 3],
+        [3, 0, 2],
+        [2, 0, 1],
+        [1, 5, 2],
+        [2, 5, 3],
+        [3, 5, 4],
+        [4, 5, 1],
+    ]
+)
+VERTICES_PER_VOXEL = 5
+FACES_PER_VOXEL = OCTAHEDRON_FACES.shape[0]
+# Rows formatted at a time when writing the OFF file
+OFF_CHUNK_SIZE = 65536
+
+
+def create_octahedron_voxels(n_voxels: int):
+    """
+    Tile n_voxels regular octahedra along the -z axis, 2 m apart
+
+    :return: vertices, faces in OFF format (number of vertices followed by vertex indices)
+      and detector_faces (face index, detector number)
+    """
+    if n_voxels < 1:
+        raise ValueError(f"Need at least one voxel, got {n_voxels}")
+    voxel_numbers = np.arange(n_voxels)
+
+    vertices = np.empty((VERTICES_PER_VOXEL * n_voxels + 1, 3))
+    vertices[:-1, :] = (
+        OCTAHEDRON_VERTICES[np.newaxis, :VERTICES_PER_VOXEL, :]
+        - [0.0, 0.0, 2.0] * voxel_numbers[:, np.newaxis, np.newaxis]
+    ).reshape(-1, 3)
+    vertices[-1, :] = OCTAHEDRON_VERTICES[-1, :] - [0.0, 0.0, 2.0 * (n_voxels - 1)]
+
+    # Number of vertices followed by vertex indices for each face
+    # the first column doesn't end up in the NeXus file dataset
+    off_faces = np.empty((FACES_PER_VOXEL * n_voxels, 4), dtype=int)
+    off_faces[:, 0] = 3
+    off_faces[:, 1:] = (
+        OCTAHEDRON_FACES[np.newaxis, :, :]
+        + VERTICES_PER_VOXEL * voxel_numbers[:, np.newaxis, np.newaxis]
+    ).reshape(-1, 3)
+
+    # Map 8 faces to each detector number
+    detector_faces = np.column_stack(
+        (
+            np.arange(FACES_PER_VOXEL * n_voxels),
+            np.repeat(voxel_numbers, FACES_PER_VOXEL),
+        )
+    )
+    return vertices, off_faces, detector_faces
+
+
+@instrumented
+def add_voxel_detector(
+    nexus_builder: NexusBuilder, n_voxels: int = 3, write_off_file: bool = True
+):
     detector_group = nexus_builder.add_detector_minimal("voxel geometry detector", 1)
 
-    vertices = np.array([[0.0, 0.0, 0.0]])
-    off_faces = np.empty((0, 4), dtype=int)
     detector_numbers = np.arange(n_voxels)
-    detector_faces = np.empty((0, 2), dtype=int)
-    for voxel_number in range(n_voxels):
-        # Each voxel is a regular octahedron
-        new_vertices = np.array(
-            [
-                [0.0, 0.0, 1.0 - 2 * voxel_number],
-                [1.0, 0.0, 0.0 - 2 * voxel_number],
-                [0.0, 1.0, 0.0 - 2 * voxel_number],
-                [-1.0, 0.0, 0.0 - 2 * voxel_number],
-                [0.0, -1.0, 0.0 - 2 * voxel_number],
-                [0.0, 0.0, -1.0 - 2 * voxel_number],
-            ]
-        )
-        vertices = np.append(vertices[:-1, :], new_vertices, axis=0)
-
-        # Number of vertices followed by vertex indices for each face
-        # the first column doesn't end up in the NeXus file dataset
-        new_off_faces = np.array(
-            [
-                [3, 1 + 5 * voxel_number, 5 * voxel_number, 4 + 5 * voxel_number],
-                [3, 4 + 5 * voxel_number, 5 * voxel_number, 3 + 5 * voxel_number],
-                [3, 3 + 5 * voxel_number, 5 * voxel_number, 2 + 5 * voxel_number],
-                [3, 2 + 5 * voxel_number, 5 * voxel_number, 1 + 5 * voxel_number],
-                [3, 1 + 5 * voxel_number, 5 + 5 * voxel_number, 2 + 5 * voxel_number],
-                [3, 2 + 5 * voxel_number, 5 + 5 * voxel_number, 3 + 5 * voxel_number],
-                [3, 3 + 5 * voxel_number, 5 + 5 * voxel_number, 4 + 5 * voxel_number],
-                [3, 4 + 5 * voxel_number, 5 + 5 * voxel_number, 1 + 5 * voxel_number],
-            ]
-        )
-        off_faces = np.append(off_faces, new_off_faces, axis=0)
-
-        detector_number = detector_numbers[voxel_number]
-        # Map 8 faces to each detector number
-        new_detector_faces = np.array(
-            [
-                [detector_number * 8, detector_number],
-                [1 + detector_number * 8, detector_number],
-                [2 + detector_number * 8, detector_number],
-                [3 + detector_number * 8, detector_number],
-                [4 + detector_number * 8, detector_number],
-                [5 + detector_number * 8, detector_number],
-                [6 + detector_number * 8, detector_number],
-                [7 + detector_number * 8, detector_number],
-            ]
-        )
-        detector_faces = np.append(detector_faces, new_detector_faces, axis=0)
+    vertices, off_faces, detector_faces = create_octahedron_voxels(n_voxels)
 
     nexus_builder.add_shape(
         detector_group, "detector_shape", vertices, off_faces, detector_faces
@@ -90,9 +121,14 @@ def add_voxel_detector(nexus_builder: NexusBuilder, n_voxels: int = 3):
     nexus_builder.add_dataset(detector_group, "y_pixel_offset", y_offsets)
     nexus_builder.add_dataset(detector_group, "z_pixel_offset", z_offsets)
 
-    write_to_off_file(
-        f"{n_voxels}_voxels.off", vertices.shape[0], off_faces.shape[0], vertices, off_faces
-    )
+    if write_off_file:
+        write_to_off_file(
+            f"{n_voxels}_voxels.off",
+            vertices.shape[0],
+            off_faces.shape[0],
+            vertices,
+            off_faces,
+        )
 
 
 def write_to_off_file(
@@ -106,7 +142,7 @@ def write_to_off_file(
     Write mesh geometry to a file in the OFF format
     https://en.wikipedia.org/wiki/OFF_(file_format)
     """
-    with open(filename, "w") as f:
+    with open(filename, "w", buffering=1 << 20) as f:
         f.writelines(
             (
                 "OFF\n",
@@ -114,14 +150,39 @@ def write_to_off_file(
                 f"{number_of_vertices} {number_of_faces} 0\n",
             )
         )
-    with open(filename, "a") as f:
-        pd.DataFrame(vertices).to_csv(f, sep=" ", header=None, index=False)
-    with open(filename, "a") as f:
-        pd.DataFrame(voxels).to_csv(f, sep=" ", header=None, index=False)
+        _write_rows(f, vertices, "%.9g")
+        _write_rows(f, voxels, "%d")
+
+
+def _write_rows(f, array: np.ndarray, value_format: str):
+    """
+    Write the rows of a 2D array, space separated, formatting many rows at once
+    """
+    row_format = " ".join([value_format] * array.shape[1]) + "\n"
+    for chunk_start in range(0, array.shape[0], OFF_CHUNK_SIZE):
+        rows = array[chunk_start : chunk_start + OFF_CHUNK_SIZE]
+        f.write((row_format * rows.shape[0]) % tuple(rows.ravel().tolist()))
 
 
 if __name__ == "__main__":
-    for n_vox in [2]:
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "--n-voxels",
+        type=int,
+        nargs="+",
+        default=[2],
+        help="Numbers of voxels, for example --n-voxels 1000 1000000, a file is written for each",
+    )
+    parser.add_argument(
+        "--no-off-file",
+        action="store_true",
+        help="Do not write the mesh to an OFF file as well",
+    )
+    args = parser.parse_args()
+
+    for n_vox in args.n_voxels:
         output_filename = f"VOXEL_example_{n_vox}.nxs"
         with NexusBuilder(
             output_filename,
@@ -147,7 +208,7 @@ if __name__ == "__main__":
             builder.add_dataset(source_group, "depends_on", source_position.name)
             builder.add_dataset(builder.root, "name", "VOXEL", {"short_name": "VOXEL"})
 
-            add_voxel_detector(builder, n_vox)
+            add_voxel_detector(builder, n_vox, not args.no_off_file)
 
             # Add some event data and a start_time dataset so we can load with Mantid
             builder.add_fake_event_data(1, 100)